@@ -0,0 +1,53 @@
+"""
+Conversion of existing derivative trees between the .txt (indented json) and .npz formats.
+
+Only the feature derivatives (dicts with 'metadata' and 'values') are converted, the
+stats of the preprocessing and the .json sidecars are left as they are.
+"""
+import os
+from sovaharmony.preprocessing import DERIVATIVE_WRITERS
+from sovaharmony.utils import load_txt
+
+def convert_derivatives(input_path,extension='.npz',remove=False,pipeline='sovaharmony'):
+    '''
+    Rewrites every feature derivative of a bids dataset in the format of extension.
+
+    Parameters
+    ----------
+        input_path: str
+            Root of the bids dataset
+        extension: str
+            '.npz' or '.txt', format of the output
+        remove: bool
+            Remove the original file once the converted one is written
+        pipeline: str
+            Folder of the derivatives
+
+    Returns
+    -------
+        converted: list of the files written
+    '''
+    if extension not in DERIVATIVE_WRITERS:
+        raise ValueError(f'Unknown derivative format {extension}')
+    source = [x for x in DERIVATIVE_WRITERS if x != extension][0]
+    derivatives_root = os.path.join(input_path,'derivatives',pipeline)
+    converted = []
+    for folder, dirs, files in os.walk(derivatives_root):
+        dirs[:] = [d for d in dirs if d != 'code']
+        for fname in files:
+            if not fname.endswith(source) or fname.startswith('.tmp'):
+                continue
+            path = os.path.join(folder,fname)
+            try:
+                data = load_txt(path)
+            except ValueError: # not a json/npz file
+                continue
+            if not isinstance(data,dict) or 'metadata' not in data or 'values' not in data:
+                continue
+            output = os.path.splitext(path)[0] + extension
+            DERIVATIVE_WRITERS[extension](data,output)
+            converted.append(output)
+            if remove:
+                os.remove(path)
+    print(f'{len(converted)} derivatives converted to {extension}')
+    return converted
@@ -0,0 +1,86 @@
+"""
+Append-only columnar store of the feature derivatives.
+
+postprocessing.features writes, as each derivative is produced, its row of the wide
+table (see query_derivatives.derivative_row) as a parquet file partitioned by
+dataset/task/feature/space under derivatives/sovaharmony/code/feature_store:
+
+    database=<name>/task=<task>/feature=<feature>/space=<space>/part-<hash>.parquet
+
+The part file of a derivative is named after its path, so recomputing a derivative
+replaces its row. The wide tables of query_derivatives are then a read of one
+partition, and the long tables a reshape of it, instead of loading every derivative.
+"""
+import hashlib
+import os
+import glob
+import pandas as pd
+
+# Columns of the store that are not part of the wide tables
+STORE_COLUMNS = ['norm','derivative_path','derivative_mtime']
+
+def store_root(input_path,pipeline='sovaharmony'):
+    return os.path.join(input_path,'derivatives',pipeline,'code','feature_store')
+
+class FeatureStore:
+    """Partitioned parquet store of the rows of the wide feature tables.
+
+    Parameters
+    ----------
+        input_path: str
+            Root of the bids dataset
+    """
+    def __init__(self, input_path, pipeline='sovaharmony'):
+        self.input_path = input_path
+        self.root = store_root(input_path,pipeline)
+
+    def partition(self, database, task, feature, space):
+        return os.path.join(self.root,f'database={database}',f'task={task}',f'feature={feature}',f'space={space}')
+
+    def append(self, row, database, task, feature, space, norm, derivative_path):
+        """Writes the row (dict) of a derivative, replacing the previous row of the same derivative."""
+        folder = self.partition(database,task,feature,space)
+        os.makedirs(folder,exist_ok=True)
+        key = os.path.relpath(derivative_path,self.input_path).replace('\\','/')
+        row = dict(row)
+        row['database'] = database
+        row['norm'] = str(norm)
+        row['derivative_path'] = key
+        row['derivative_mtime'] = os.stat(derivative_path).st_mtime_ns
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        path = os.path.join(folder,f'part-{name}.parquet')
+        tmp_path = os.path.join(folder,f'.tmp{os.getpid()}_part-{name}.parquet')
+        pd.DataFrame([row]).to_parquet(tmp_path,index=False)
+        os.replace(tmp_path,path)
+        return path
+
+    def read(self, database, task, feature, space, norm=None):
+        """All the rows of a partition (with the store columns), one per derivative, sorted by path."""
+        files = sorted(glob.glob(os.path.join(glob.escape(self.partition(database,task,feature,space)),'*.parquet')))
+        if not files:
+            return pd.DataFrame()
+        df = pd.concat([pd.read_parquet(x) for x in files],ignore_index=True)
+        df = df.sort_values(['derivative_path','derivative_mtime']).drop_duplicates('derivative_path',keep='last')
+        if norm is not None:
+            df = df[df['norm']==str(norm)]
+        return df.reset_index(drop=True)
+
+    def wide(self, database, task, feature, space, norm=None):
+        """Wide table of query_derivatives (demographic columns, feature columns, database)."""
+        df = self.read(database,task,feature,space,norm)
+        columns = [x for x in df.columns if x not in STORE_COLUMNS and x != 'database']
+        return df[columns+['database']] if len(df) else df
+
+    def compact(self, database, task, feature, space):
+        """Merges the part files of a partition into a single one, keeping the last row of each derivative."""
+        folder = self.partition(database,task,feature,space)
+        files = glob.glob(os.path.join(glob.escape(folder),'*.parquet'))
+        if len(files) < 2:
+            return
+        df = self.read(database,task,feature,space)
+        tmp_path = os.path.join(folder,f'.tmp{os.getpid()}_compacted.parquet')
+        df.to_parquet(tmp_path,index=False)
+        os.replace(tmp_path,os.path.join(folder,'part-compacted.parquet'))
+        for x in files:
+            if os.path.basename(x) != 'part-compacted.parquet':
+                os.remove(x)
@@ -7,7 +7,7 @@
 
 import re
 import pandas as pd 
-from bids import BIDSLayout
+from sovaharmony.layout import get_layout
 from bids.layout import parse_file_entities
 #from pydantic import NoneBytes
 from .createDataframes import get_metrics_prep
@@ -20,7 +20,7 @@ from .createDataframes import get_data_mean_roi_sl_format_long
 import pandas as pd
 import os
 
-def get_information_data(THE_DATASET):
+def get_information_data(THE_DATASET,layout=None):
   '''
   Function to extract information about data
   
@@ -38,6 +38,7 @@ def get_information_data(THE_DATASET):
     'channels': list, channel labels to keep for analysis in the order wanted. Use standard 1005 names in UPPER CASE
     'spatial_filter': str, spatial filter to be used for component analysis. Should correspond to those in sovaflow. One of '53x53', '58x25', '62x19'
     }
+    layout: BIDSLayout with derivatives, if None it is obtained with sovaharmony.layout.get_layout (cached)
      
   Returns:
   -------------- 
@@ -61,7 +62,8 @@ def get_information_data(THE_DATASET):
   runlabel = THE_DATASET.get('run-label','')
   session_set = THE_DATASET.get('session',None)
   data_path = input_path
-  layout = BIDSLayout(data_path,derivatives=True)
+  if layout is None:
+    layout = get_layout(data_path,derivatives=True)
   return layout,task,runlabel,name,group_regex,session_set
    
 def get_dataframe_powers(THE_DATASET,mode="channels",stage=None):
@@ -2,7 +2,7 @@ import json
 import ast
 import os
 import errno
-from bids import BIDSLayout
+from sovaharmony.layout import get_layout
 import numpy as np
 import re
 import pandas as pd
@@ -10,168 +10,233 @@ from bids.layout import parse_file_entities
 #from sovaharmony.datasets import DUQUEVHI 
 from sovaharmony.utils import load_txt
 
-def get_dataframe_columnsIC(THE_DATASET,feature,spatial_matrix='54x10',norm='False'):  
-    '''Obtain data frames with powers of Components in different columns'''
-    input_path = THE_DATASET.get('input_path',None)
-    task = THE_DATASET.get('layout',None).get('task',None)
-    group_regex = THE_DATASET.get('group_regex',None)
-    name = THE_DATASET.get('name',None)
-    runlabel = THE_DATASET.get('run-label','')
-    data_path = input_path
-    layout = BIDSLayout(data_path,derivatives=True)
-    layout.get(scope='derivatives', return_type='file')
-    paths= layout.get(extension='.txt',task=task,suffix=feature, return_type='filename')
-    if spatial_matrix=='54x10' and norm=='False':
-        paths = [x for x in paths if f'space-ics[54x10]_norm-False' in x]
-    elif spatial_matrix=='54x10' and norm=='True':
-        paths = [x for x in paths if f'space-ics[54x10]_norm-True' in x]
-    elif spatial_matrix=='58x25' and norm=='False':
-        paths = [x for x in paths if f'space-ics[58x25]_norm-False' in x]
-    elif spatial_matrix=='58x25' and norm=='True':
-        paths = [x for x in paths if f'space-ics[58x25]_norm-True' in x]
-    elif spatial_matrix=='cresta' and norm=='False':
-        paths = [x for x in paths if f'space-ics[cresta]_norm-False' in x]
-    elif spatial_matrix=='cresta' and norm=='True':
-        paths = [x for x in paths if f'space-ics[cresta]_norm-True' in x]
-    elif spatial_matrix=='paper' and norm=='False':
-        paths = [x for x in paths if f'space-ics[paper]_norm-False' in x]
-    elif spatial_matrix=='paper' and norm=='True':
-        paths = [x for x in paths if f'space-ics[paper]_norm-True' in x]
-    elif spatial_matrix=='openBCI' and norm=='False':
-        paths = [x for x in paths if f'space-ics[openBCI]_norm-False' in x]
-    elif spatial_matrix=='openBCI' and norm=='True':
-        paths = [x for x in paths if f'space-ics[openBCI]_norm-True' in x]
+DERIVATIVE_EXTENSIONS = ['.txt','.npz'] # see preprocessing.write_json and write_npz
 
-    list_subjects = []
-    for i in range(len(paths)):
-        data=load_txt(paths[i])
-        # if 'spaces' in data['metadata']['axes'].keys():
-        #     comp_labels = data['metadata']['axes']['spaces']
-            
-        # elif 'spaces1' in data['metadata']['axes'].keys():
-        #     comp_labels = data['metadata']['axes']['spaces1']
-        if spatial_matrix=='58x25':
-            comp_labels =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16', 'C17', 'C18', 'C19', 'C20', 'C21', 'C22', 'C23', 'C24', 'C25']
-        elif spatial_matrix=='54x10':
-            comp_labels =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10']
-        elif spatial_matrix=='cresta' or spatial_matrix=='openBCI' or spatial_matrix=='paper':
-            comp_labels =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
-
-        icvalues = np.array(data['values'])
-        bandas = data['metadata']['axes']['bands']
-        datos_1_sujeto = {}
-        info_bids_sujeto = parse_file_entities(paths[i])
-        datos_1_sujeto['participant_id'] = 'sub-'+info_bids_sujeto['subject']   
-        if group_regex:
-            regex = re.search('(.+).{3}',info_bids_sujeto['subject'])
-            datos_1_sujeto['group'] = regex.string[regex.regs[-1][0]:regex.regs[-1][1]]
-        else:
-            datos_1_sujeto['group'] = 'Control'
-        try:
-            datos_1_sujeto['visit'] = info_bids_sujeto['session']
-        except:
-            datos_1_sujeto['visit']='V0'
-        datos_1_sujeto['condition'] = info_bids_sujeto['task']
-
-        for b,band in enumerate(bandas):
-            for c in range(len(comp_labels)):
-                if data['metadata']['type']=='crossfreq':
-                    for b1,band1 in enumerate(bandas):
-                        datos_1_sujeto[f'{feature}_{comp_labels[c]}_M{band1}_{band.title()}']=icvalues[c][b][b1]
-                elif data['metadata']['type']=='sl' or data['metadata']['type']=='coherence-bands':
-                    datos_1_sujeto[f'{feature}_{comp_labels[c]}_{band.title()}']=np.mean(icvalues[b][c])
-                elif data['metadata']['type']=='entropy' or data['metadata']['type']=='power':
-                    datos_1_sujeto[f'{feature}_{comp_labels[c]}_{band.title()}']=icvalues[b,c]
-        list_subjects.append(datos_1_sujeto)
-    df = pd.DataFrame(list_subjects)
-    df['database']=[name]*len(list_subjects)
+def _unique_derivatives(paths):
+    '''Keeps one file per derivative, the .npz when both formats exist (e.g. a tree being converted)'''
+    stems = {os.path.splitext(x)[0] for x in paths if x.endswith('.npz')}
+    return [x for x in paths if x.endswith('.npz') or os.path.splitext(x)[0] not in stems]
+
+COMPONENT_LABELS = {
+    '58x25':['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16', 'C17', 'C18', 'C19', 'C20', 'C21', 'C22', 'C23', 'C24', 'C25'],
+    '54x10':['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10'],
+    'cresta':['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8'],
+    'openBCI':['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8'],
+    'paper':['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8'],
+}
+
+F = ['FP1', 'FPZ', 'FP2', 'AF3', 'AF4', 'F7', 'F5', 'F3', 'F1', 'FZ', 'F2', 'F4', 'F6', 'F8'] 
+T = ['FT7', 'FC5', 'FC6', 'FT8', 'T7', 'C5', 'C6', 'T8', 'TP7', 'CP5', 'CP6', 'TP8']
+C = ['FC3', 'FC1', 'FCZ', 'FC2', 'FC4', 'C3', 'C1', 'CZ', 'C2', 'C4', 'CP3', 'CP1', 'CPZ', 'CP2', 'CP4'] 
+PO = ['P7', 'P5', 'P3', 'P1', 'PZ', 'P2', 'P4', 'P6', 'P8', 'PO7', 'PO5', 'PO3', 'POZ', 'PO4', 'PO6', 'PO8', 'CB1', 'O1', 'OZ', 'O2', 'CB2']
+ROIS = [F,C,PO,T]
+ROI_LABELS = ['F','C','PO','T']
+
+def subject_info(path,group_regex=None):
+    '''Demographic columns (participant_id, group, visit, condition) of a derivative from its bids entities'''
+    datos_1_sujeto = {}
+    info_bids_sujeto = parse_file_entities(path)
+    datos_1_sujeto['participant_id'] = 'sub-'+info_bids_sujeto['subject']   
+    if group_regex:
+        regex = re.search('(.+).{3}',info_bids_sujeto['subject'])
+        datos_1_sujeto['group'] = regex.string[regex.regs[-1][0]:regex.regs[-1][1]]
+    else:
+        datos_1_sujeto['group'] = 'Control'
     try:
-        path="{input_path}\derivatives\data_columns\IC".format(input_path=input_path).replace('\\','/')
+        datos_1_sujeto['visit'] = info_bids_sujeto['session']
+    except:
+        datos_1_sujeto['visit']='V0'
+    datos_1_sujeto['condition'] = info_bids_sujeto['task']
+    return datos_1_sujeto
+
+def ic_columns(data,feature,spatial_matrix='54x10'):
+    '''Feature columns of a derivative in component space, one per component and band'''
+    comp_labels = COMPONENT_LABELS.get(spatial_matrix,None)
+    if comp_labels is None:
+        axes = data['metadata']['axes']
+        comp_labels = [f'C{c+1}' for c in range(len(axes.get('spaces',axes.get('spaces1',[]))))]
+    icvalues = np.array(data['values'])
+    bandas = data['metadata']['axes']['bands']
+    columns = {}
+    for b,band in enumerate(bandas):
+        for c in range(len(comp_labels)):
+            if data['metadata']['type']=='crossfreq':
+                for b1,band1 in enumerate(bandas):
+                    columns[f'{feature}_{comp_labels[c]}_M{band1}_{band.title()}']=icvalues[c][b][b1]
+            elif data['metadata']['type']=='sl' or data['metadata']['type']=='coherence-bands':
+                columns[f'{feature}_{comp_labels[c]}_{band.title()}']=np.mean(icvalues[b][c])
+            elif data['metadata']['type']=='entropy' or data['metadata']['type']=='power':
+                columns[f'{feature}_{comp_labels[c]}_{band.title()}']=icvalues[b,c]
+    return columns
+
+def roi_columns(data,feature):
+    '''Feature columns of a derivative in sensor space, averaged by ROI for each band'''
+    new_rois = []
+    if 'spaces' in data['metadata']['axes'].keys():
+        sensors = data['metadata']['axes']['spaces']
+
+    elif 'spaces1' in data['metadata']['axes'].keys():
+        sensors = data['metadata']['axes']['spaces1']
+        
+    elif 'spaces2' in data['metadata']['axes'].keys():
+        sensors = data['metadata']['axes']['spaces2']
+    
+    for roi in ROIS:
+        channels = set(sensors).intersection(roi)
+        new_roi = []
+        for channel in channels:
+            index=sensors.index(channel)
+            new_roi.append(index)
+        new_rois.append(new_roi)
+
+    icvalues = np.array(data['values'])
+    bandas = data['metadata']['axes']['bands']
+    columns = {}
+    for b,band in enumerate(bandas):
+        for r,roi in enumerate(new_rois):
+            if data['metadata']['type']=='crossfreq':
+                for b1,band1 in enumerate(bandas):
+                    columns[f'{feature}_{ROI_LABELS[r]}_M{band1}_{band.title()}']= icvalues[roi][b][b1][np.nonzero(icvalues[roi][b][b1])].mean()
+            elif data['metadata']['type']=='sl' or data['metadata']['type']=='coherence-bands':
+                columns[f'{feature}_{ROI_LABELS[r]}_{band.title()}']=np.mean(icvalues[b][roi])
+            elif data['metadata']['type']=='entropy' or data['metadata']['type']=='power':
+                columns[f'{feature}_{ROI_LABELS[r]}_{band.title()}']=np.mean(icvalues[b,roi])
+    return columns
+
+def derivative_row(data,path,feature,group_regex=None,spatial_matrix=None):
+    '''Row of the wide table of a derivative, ROI columns if spatial_matrix is None (sensors) else component columns'''
+    row = subject_info(path,group_regex)
+    if spatial_matrix is None:
+        row.update(roi_columns(data,feature))
+    else:
+        row.update(ic_columns(data,feature,spatial_matrix))
+    return row
+
+def _columns_path(input_path,folder,filename):
+    try:
+        path="{input_path}\\derivatives\\data_columns\\{folder}".format(input_path=input_path,folder=folder).replace('\\','/')
         os.makedirs(path)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    df.to_feather(r'{path}\data_{name}_{task}_columns_{feature}_{spatial_matrix}_components.feather'.format(name=name,path=path,task=task,feature=feature,spatial_matrix=spatial_matrix).replace('\\','/'))
-    print('Done!')
-    return df 
+    return os.path.join(path,filename)
+
+def _index_path(feather_path):
+    '''Sidecar of an incremental table with the derivative_path and derivative_mtime of each of its rows'''
+    return os.path.splitext(feather_path)[0]+'_index.feather'
+
+_INDEX_COLUMNS = ['derivative_path','derivative_mtime']
+
+def _write_columns(df,feather_path,index=None):
+    '''Writes the wide table and the index of its rows (see _load_rows), or removes the index of a previous
+    incremental call if index is None. The index is written last, so a partial write only forces a full load.'''
+    index_path = _index_path(feather_path)
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    df.to_feather(feather_path)
+    if index is not None:
+        index.reset_index(drop=True).to_feather(index_path)
+
+def _load_rows(paths,input_path,name,build_row,feather_path=None,incremental=False):
+    '''
+    Wide table with the row of each derivative in paths.
 
-def get_dataframe_columnsROI(THE_DATASET,feature):  
-    '''Obtain data frames with powers of Components in different columns'''
+    If incremental the table in feather_path (written by a previous incremental call) is reused:
+    only the derivatives that are new or whose mtime changed are loaded, the rows of the
+    derivatives that no longer exist are dropped. The derivative_path and derivative_mtime of
+    each row are kept in a sidecar index (see _index_path), not in the table.
+
+    Returns the table and its index (None if not incremental).
+    '''
+    keys = [os.path.relpath(x,input_path).replace('\\','/') for x in paths]
+    mtimes = [os.stat(x).st_mtime_ns for x in paths] if incremental else None
+    previous = None
+    if incremental and feather_path is not None and os.path.isfile(feather_path) and os.path.isfile(_index_path(feather_path)):
+        previous = pd.read_feather(feather_path)
+        index = pd.read_feather(_index_path(feather_path))
+        if len(index) == len(previous) and list(index.columns) == _INDEX_COLUMNS:
+            previous = pd.concat([previous.drop(columns=_INDEX_COLUMNS,errors='ignore'),index],axis=1)
+        else:
+            previous = None # not written by an incremental call
+    current = pd.DataFrame({'derivative_path':keys,'derivative_mtime':mtimes}) if incremental else None
+    kept = None
+    if previous is not None:
+        kept = previous.merge(current,on=_INDEX_COLUMNS,how='inner')
+        done = set(kept['derivative_path'])
+        todo = [i for i,key in enumerate(keys) if key not in done]
+    else:
+        todo = list(range(len(paths)))
+
+    list_subjects = []
+    for i in todo:
+        data=load_txt(paths[i])
+        list_subjects.append(build_row(data,paths[i]))
+    df = pd.DataFrame(list_subjects)
+    df['database']=[name]*len(list_subjects)
+    if not incremental:
+        return df,None
+    df['derivative_path'] = [keys[i] for i in todo]
+    df['derivative_mtime'] = [mtimes[i] for i in todo]
+    print(f'{len(todo)} of {len(paths)} derivatives loaded')
+    if kept is not None and len(kept):
+        df = pd.concat([kept,df],ignore_index=True) if len(df) else kept
+        df = current[['derivative_path']].merge(df,on='derivative_path',how='left') # order of paths
+    return df.drop(columns=_INDEX_COLUMNS),df[_INDEX_COLUMNS]
+
+def get_dataframe_columnsIC(THE_DATASET,feature,spatial_matrix='54x10',norm='False',layout=None,from_store=False,incremental=False):  
+    '''Obtain data frames with powers of Components in different columns
+
+    If from_store the table is read from the feature store written by postprocessing.features
+    (see data_structure.feature_store) instead of loading every derivative file.
+    If incremental only the derivatives added or modified since the last incremental call are loaded.'''
     input_path = THE_DATASET.get('input_path',None)
     task = THE_DATASET.get('layout',None).get('task',None)
     group_regex = THE_DATASET.get('group_regex',None)
     name = THE_DATASET.get('name',None)
     runlabel = THE_DATASET.get('run-label','')
-    data_path = input_path
-    layout = BIDSLayout(data_path,derivatives=True)
-    layout.get(scope='derivatives', return_type='file')
-    paths= layout.get(extension='.txt',task=task,suffix=feature, return_type='filename')
-    paths = [x for x in paths if f'space-sensors_norm-True' in x]
-    list_subjects = []
-    F = ['FP1', 'FPZ', 'FP2', 'AF3', 'AF4', 'F7', 'F5', 'F3', 'F1', 'FZ', 'F2', 'F4', 'F6', 'F8'] 
-    T = ['FT7', 'FC5', 'FC6', 'FT8', 'T7', 'C5', 'C6', 'T8', 'TP7', 'CP5', 'CP6', 'TP8']
-    C = ['FC3', 'FC1', 'FCZ', 'FC2', 'FC4', 'C3', 'C1', 'CZ', 'C2', 'C4', 'CP3', 'CP1', 'CPZ', 'CP2', 'CP4'] 
-    PO = ['P7', 'P5', 'P3', 'P1', 'PZ', 'P2', 'P4', 'P6', 'P8', 'PO7', 'PO5', 'PO3', 'POZ', 'PO4', 'PO6', 'PO8', 'CB1', 'O1', 'OZ', 'O2', 'CB2']
-    rois = [F,C,PO,T]
-    roi_labels = ['F','C','PO','T']
-
-    for i in range(len(paths)):
-        # with open(paths[i],'r', encoding='utf-8', errors='ignore') as f:
-        #     data=ast.literal_eval(f.read())
-        data=load_txt(paths[i])
-        new_rois = []
+    feather_path = _columns_path(input_path,'IC',f'data_{name}_{task}_columns_{feature}_{spatial_matrix}_components.feather')
+    if from_store:
+        from sovaharmony.data_structure.feature_store import FeatureStore
+        df,index = FeatureStore(input_path).wide(name,task,feature,f'ics[{spatial_matrix}]',norm=norm),None
+    else:
+        data_path = input_path
+        if layout is None:
+            layout = get_layout(data_path,derivatives=True)
+        layout.get(scope='derivatives', return_type='file')
+        paths= layout.get(extension=DERIVATIVE_EXTENSIONS,task=task,suffix=feature, return_type='filename')
+        paths = _unique_derivatives(paths)
+        paths = [x for x in paths if f'space-ics[{spatial_matrix}]_norm-{norm}' in x]
+        build_row = lambda data,path: derivative_row(data,path,feature,group_regex,spatial_matrix)
+        df,index = _load_rows(paths,input_path,name,build_row,feather_path,incremental)
+    _write_columns(df,feather_path,index)
+    print('Done!')
+    return df 
 
-        if 'spaces' in data['metadata']['axes'].keys():
-            sensors = data['metadata']['axes']['spaces']
+def get_dataframe_columnsROI(THE_DATASET,feature,layout=None,from_store=False,incremental=False):  
+    '''Obtain data frames with powers of Components in different columns
 
-        elif 'spaces1' in data['metadata']['axes'].keys():
-            sensors = data['metadata']['axes']['spaces1']
-            
-        elif 'spaces2' in data['metadata']['axes'].keys():
-            sensors = data['metadata']['axes']['spaces2']
-        
-        for roi in rois:
-            channels = set(sensors).intersection(roi)
-            new_roi = []
-            for channel in channels:
-                index=sensors.index(channel)
-                new_roi.append(index)
-            new_rois.append(new_roi)
-
-        icvalues = np.array(data['values'])
-        bandas = data['metadata']['axes']['bands']
-        datos_1_sujeto = {}
-        info_bids_sujeto = parse_file_entities(paths[i])
-        datos_1_sujeto['participant_id'] = 'sub-'+info_bids_sujeto['subject']   
-        if group_regex:
-            regex = re.search('(.+).{3}',info_bids_sujeto['subject'])
-            datos_1_sujeto['group'] = regex.string[regex.regs[-1][0]:regex.regs[-1][1]]
-        else:
-            datos_1_sujeto['group'] = 'Control'
-        try:
-            datos_1_sujeto['visit'] = info_bids_sujeto['session']
-        except:
-            datos_1_sujeto['visit']='V0'
-        datos_1_sujeto['condition'] = info_bids_sujeto['task']
-
-        for b,band in enumerate(bandas):
-            for r,roi in enumerate(new_rois):
-                if data['metadata']['type']=='crossfreq':
-                    for b1,band1 in enumerate(bandas):
-                        datos_1_sujeto[f'{feature}_{roi_labels[r]}_M{band1}_{band.title()}']= icvalues[roi][b][b1][np.nonzero(icvalues[roi][b][b1])].mean()
-                elif data['metadata']['type']=='sl' or data['metadata']['type']=='coherence-bands':
-                    datos_1_sujeto[f'{feature}_{roi_labels[r]}_{band.title()}']=np.mean(icvalues[b][roi])
-                elif data['metadata']['type']=='entropy' or data['metadata']['type']=='power':
-                    datos_1_sujeto[f'{feature}_{roi_labels[r]}_{band.title()}']=np.mean(icvalues[b,roi])
-        list_subjects.append(datos_1_sujeto)
-    df = pd.DataFrame(list_subjects)
-    df['database']=[name]*len(list_subjects)
-    try:
-        path="{input_path}\derivatives\data_columns\ROI".format(input_path=input_path).replace('\\','/')
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-    df.to_feather(r'{path}\data_{name}_{task}_columns_{feature}_ROI.feather'.format(name=name,path=path,task=task,feature=feature))
+    If from_store the table is read from the feature store written by postprocessing.features
+    (see data_structure.feature_store) instead of loading every derivative file.
+    If incremental only the derivatives added or modified since the last incremental call are loaded.'''
+    input_path = THE_DATASET.get('input_path',None)
+    task = THE_DATASET.get('layout',None).get('task',None)
+    group_regex = THE_DATASET.get('group_regex',None)
+    name = THE_DATASET.get('name',None)
+    runlabel = THE_DATASET.get('run-label','')
+    feather_path = _columns_path(input_path,'ROI',f'data_{name}_{task}_columns_{feature}_ROI.feather')
+    if from_store:
+        from sovaharmony.data_structure.feature_store import FeatureStore
+        df,index = FeatureStore(input_path).wide(name,task,feature,'sensors',norm='True'),None
+    else:
+        data_path = input_path
+        if layout is None:
+            layout = get_layout(data_path,derivatives=True)
+        layout.get(scope='derivatives', return_type='file')
+        paths= layout.get(extension=DERIVATIVE_EXTENSIONS,task=task,suffix=feature, return_type='filename')
+        paths = _unique_derivatives(paths)
+        paths = [x for x in paths if f'space-sensors_norm-True' in x]
+        build_row = lambda data,path: derivative_row(data,path,feature,group_regex)
+        df,index = _load_rows(paths,input_path,name,build_row,feather_path,incremental)
+    _write_columns(df,feather_path,index)
     print('Done!')
     return df 
@@ -0,0 +1,101 @@
+"""
+Cached BIDS layouts shared across the entry points of sovaharmony.
+
+Building a BIDSLayout crawls the whole dataset. get_layout keeps one layout per
+(dataset, derivatives) in the process, returned as is unless refresh=True, and persists
+the pybids index on disk under derivatives/sovaharmony/code/layout_index. The index on
+disk is rebuilt when the fingerprint of the dataset changed: the top-level entries, the
+json sidecars of the raw data and, for the derivatives, the top-level entries and run
+manifest of each pipeline. Data files added to an existing folder without a sidecar are
+not seen, get_layout(..., refresh=True) then forces the rebuild.
+"""
+import hashlib
+import json
+import os
+from bids import BIDSLayout
+from sovaharmony.manifest import MANIFEST_NAME
+
+# Folders not indexed by pybids, they are not walked for the fingerprint either
+_IGNORED_FOLDERS = ['code', 'stimuli', 'sourcedata', 'models']
+
+_LAYOUTS = {}
+
+def _entries(folder, rel=''):
+    """(name, mtime, size) of the entries of a folder, sorted by name."""
+    entries = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            st = entry.stat()
+            entries.append((rel + entry.name, st.st_mtime_ns, st.st_size))
+    return sorted(entries)
+
+def _fingerprint(root, derivatives=False):
+    """Hash of the top-level entries and json sidecars of a bids dataset (see the module docstring)."""
+    sha = hashlib.sha1()
+    for entry in _entries(root):
+        if entry[0] not in _IGNORED_FOLDERS and entry[0] != 'derivatives' and not entry[0].startswith('.'):
+            sha.update(repr(entry).encode('utf-8'))
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in _IGNORED_FOLDERS and d != 'derivatives' and not d.startswith('.'))
+        rel = os.path.relpath(folder, root).replace('\\', '/')
+        for fname in sorted(files):
+            if fname.endswith('.json'):
+                st = os.stat(os.path.join(folder, fname))
+                sha.update(f'{rel}/{fname}:{st.st_mtime_ns}:{st.st_size};'.encode('utf-8'))
+    derivatives_path = os.path.join(root, 'derivatives')
+    if derivatives and os.path.isdir(derivatives_path):
+        for pipeline in sorted(os.listdir(derivatives_path)):
+            pipeline_path = os.path.join(derivatives_path, pipeline)
+            if not os.path.isdir(pipeline_path):
+                continue
+            for entry in _entries(pipeline_path, pipeline + '/'):
+                sha.update(repr(entry).encode('utf-8'))
+            manifest = os.path.join(pipeline_path, 'code', MANIFEST_NAME)
+            if os.path.isfile(manifest): # changes every time a derivative is recorded
+                st = os.stat(manifest)
+                sha.update(f'{pipeline}/manifest:{st.st_mtime_ns}:{st.st_size};'.encode('utf-8'))
+    return sha.hexdigest()
+
+def get_layout(input_path, derivatives=False, refresh=False):
+    """
+    Returns the BIDSLayout of a dataset, reusing the one of this process or the index on disk when possible.
+
+    Parameters
+    ----------
+        input_path: str
+            Path of the bids dataset
+        derivatives: bool
+            Index the derivatives too, as BIDSLayout(input_path,derivatives=True)
+        refresh: bool
+            Do not reuse the layout of this process, check the fingerprint again and rebuild
+            the index on disk if it changed. Use it after files were written in this process.
+
+    Returns
+    -------
+        layout: BIDSLayout
+    """
+    root = os.path.abspath(input_path)
+    key = (root, bool(derivatives))
+    cached = _LAYOUTS.get(key)
+    if cached is not None and not refresh:
+        return cached[1]
+
+    index_path = os.path.join(root, 'derivatives', 'sovaharmony', 'code', 'layout_index',
+                              'derivatives' if derivatives else 'raw')
+    os.makedirs(index_path, exist_ok=True)
+    fingerprint = _fingerprint(root, derivatives)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    fingerprint_file = os.path.join(index_path, 'fingerprint.json')
+    stored = None
+    if os.path.isfile(fingerprint_file):
+        with open(fingerprint_file, 'r') as f:
+            stored = json.load(f).get('fingerprint', None)
+    reset = stored != fingerprint
+    layout = BIDSLayout(root, derivatives=derivatives, database_path=index_path, reset_database=reset)
+    if reset:
+        with open(fingerprint_file, 'w') as f:
+            json.dump({'fingerprint': fingerprint}, f)
+    _LAYOUTS[key] = (fingerprint, layout)
+    return layout
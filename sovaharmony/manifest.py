@@ -0,0 +1,133 @@
+"""
+Run manifest of the derivatives produced by sovaharmony.
+
+A sqlite database under derivatives/sovaharmony/code records, for each stage and file,
+the hash of the input, the hash of the configuration, the output size and the duration.
+Resume decisions are taken from the manifest instead of checking the existence of the
+derivative files, so a truncated output left by a crash is never taken as done and a
+change in the configuration triggers the recomputation.
+
+The database uses the default sqlite rollback journal: WAL needs shared memory between
+the processes and does not work on network filesystems. Concurrent workers (n_jobs > 1)
+serialize their writes through the sqlite file locks, which are not reliable on network
+filesystems (NFS, SMB), so run them with the derivatives on a local disk or use n_jobs=1.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+MANIFEST_NAME = 'manifest.sqlite'
+
+def hash_config(*args):
+    """Hash of any json-serializable configuration (dict keys are sorted)."""
+    text = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def hash_file(path, chunk_size=2**20):
+    """Hash of the content of a file, read in chunks."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class RunManifest:
+    """Per-dataset manifest of the stages already computed.
+
+    Parameters
+    ----------
+        derivatives_root: str
+            Path of derivatives/sovaharmony, the manifest lives in its code folder.
+        bids_root: str
+            Root of the bids dataset, keys are stored relative to it so the dataset can be moved.
+
+    Each process should open its own RunManifest, sqlite handles the concurrent access
+    (on a local filesystem, see the module docstring).
+    """
+    def __init__(self, derivatives_root, bids_root=None):
+        code_path = os.path.join(derivatives_root, 'code')
+        os.makedirs(code_path, exist_ok=True)
+        self.path = os.path.join(code_path, MANIFEST_NAME)
+        self.bids_root = bids_root
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS stages (
+                stage TEXT, file TEXT, input_hash TEXT, config_hash TEXT,
+                output TEXT, output_size INTEGER, output_hash TEXT,
+                duration REAL, date REAL, PRIMARY KEY (stage, file))''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)''')
+
+    def _key(self, path):
+        if self.bids_root is not None:
+            path = path.replace(self.bids_root, '')
+        return path.replace('\\', '/')
+
+    def file_hash(self, path):
+        """Content hash of a file, only recomputed when its size or mtime changed."""
+        st = os.stat(path)
+        key = self._key(path)
+        row = self.conn.execute('SELECT size, mtime, hash FROM files WHERE path=?', (key,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        digest = hash_file(path)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)', (key, st.st_size, st.st_mtime_ns, digest))
+        return digest
+
+    def get(self, stage, file):
+        """Record of a stage for a file as a dict, None if it was never computed."""
+        cur = self.conn.execute('SELECT * FROM stages WHERE stage=? AND file=?', (stage, self._key(file)))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([x[0] for x in cur.description], row))
+
+    def output_hash(self, stage, file):
+        """Hash of the output recorded for a stage, None if there is no record."""
+        record = self.get(stage, file)
+        if record is None:
+            return None
+        return record['output_hash']
+
+    def is_done(self, stage, file, input_hash, config_hash, output=None, reader=None):
+        """True if the stage was completed for this file with the same input and configuration.
+
+        If the stage was never recorded and output is given, an existing output is adopted (see adopt).
+        """
+        record = self.get(stage, file)
+        if record is None:
+            return output is not None and self.adopt(stage, file, input_hash, config_hash, output, reader)
+        return record['input_hash'] == input_hash and record['config_hash'] == config_hash
+
+    def adopt(self, stage, file, input_hash, config_hash, output, reader=None):
+        """Register an output written without the manifest (e.g. by a previous version of sovaharmony).
+
+        The output is taken as done if it exists and reader(output) does not fail, it is recorded
+        with its hash and the given input and configuration hashes so the next stages chain on it.
+        Returns True if the output was adopted.
+        """
+        if input_hash is None or not os.path.isfile(output):
+            return False
+        if reader is not None:
+            try:
+                reader(output)
+            except Exception:
+                return False
+        self.record(stage, file, input_hash, config_hash, output, None)
+        return True
+
+    def record(self, stage, file, input_hash, config_hash, output, duration):
+        """Register a completed stage, output must be already written (atomically) to disk."""
+        output_size = os.path.getsize(output)
+        output_hash = hash_file(output)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO stages VALUES (?,?,?,?,?,?,?,?,?)',
+                (stage, self._key(file), input_hash, config_hash, self._key(output),
+                 output_size, output_hash, duration, time.time()))
+        return output_hash
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,290 @@
+"""
+Band-decomposition cache shared by the features that work over band-limited signals
+(sl, entropy and crossfreq).
+
+Each band-limited array is computed once and kept, in memory or memory-mapped on disk,
+under the key (file, space, band, design) with LRU eviction. The design identifies the
+filter applied:
+    'epochs': FIR filter over each epoch, as mne.Epochs.filter (used by sl and entropy).
+    'continuous': FIR filter over the concatenated epochs, as pme.SubBands_Decomposition.
+Both designs give different values (the edges of each epoch), crossfreq uses 'continuous'
+unless it is asked for design='epochs', then it reuses the bands of sl and entropy.
+The filters are applied through FilterBank, the kernels are designed once per process.
+Float32 data is filtered in float32 and its bands are cached under keys with the dtype.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+import mne
+from scipy.fft import rfft,irfft,next_fast_len
+
+_PADS = {'epochs':'edge', 'continuous':'reflect_limited'}
+
+@lru_cache(maxsize=None)
+def fir_kernel(sfreq, fmin, fmax):
+    """FIR band-pass kernel of mne.filter.filter_data (firwin, hamming, auto lengths), designed once per process."""
+    h = mne.filter.create_filter(None, sfreq, fmin, fmax, fir_design='firwin', verbose=False)
+    h.flags.writeable = False
+    return h
+
+def _pad(x, n_pad, mode):
+    """Pads the last axis of a 2-D array by n_pad samples at each side, as mne ('edge' or 'reflect_limited')."""
+    if mode == 'edge':
+        return np.pad(x, ((0, 0), (n_pad, n_pad)), mode='edge')
+    n = x.shape[1]
+    left = 2 * x[:, :1] - x[:, min(n_pad, n - 1):0:-1]
+    right = 2 * x[:, -1:] - x[:, -2:-min(n_pad, n - 1) - 2:-1]
+    zeros = np.zeros((x.shape[0], max(n_pad - n + 1, 0)), dtype=x.dtype)
+    return np.concatenate([zeros, left, x, right, zeros], axis=1)
+
+class FilterBank:
+    """Bank of zero-phase FIR band-pass filters applied in a single FFT pass.
+
+    The kernels are the ones of mne.filter.filter_data and are designed once per process
+    (fir_kernel), the bank is cached by (sfreq, bands, design) with FilterBank.get. The
+    signal is padded once with the largest edge of the bank, transformed once, and each
+    band is obtained with one inverse FFT. The result equals filter_data up to rounding.
+
+    Parameters
+    ----------
+        sfreq: float
+        bands: list of (fmin,fmax)
+        design: 'epochs' (edge padding, as mne.Epochs.filter) or 'continuous' (reflect_limited, filter_data default)
+    """
+    _banks = {}
+
+    def __init__(self, sfreq, bands, design='continuous'):
+        if design not in _PADS:
+            raise ValueError(f'Unknown filter design {design}')
+        self.sfreq = float(sfreq)
+        self.bands = [tuple(float(f) for f in band) for band in bands]
+        self.design = design
+        self.kernels = [fir_kernel(self.sfreq, fmin, fmax) for fmin, fmax in self.bands]
+
+    @classmethod
+    def get(cls, sfreq, bands, design='continuous'):
+        """FilterBank of (sfreq, bands, design), shared by every call of the process."""
+        key = (float(sfreq), tuple(tuple(float(f) for f in band) for band in bands), design)
+        if key not in cls._banks:
+            cls._banks[key] = cls(sfreq, bands, design)
+        return cls._banks[key]
+
+    def apply(self, data, index=None, chunk_size=2**24):
+        """
+        Filters data (..., times) with every band of the bank, or only with the bands in index.
+        The padding and FFT length are always those of the whole bank, so a band gives the
+        same values whether it is computed alone or with the rest.
+
+        Returns an array (bands, ..., times), float32 if data is float32 and float64 otherwise.
+        """
+        data = np.asarray(data)
+        data = data.astype(np.float32 if data.dtype == np.float32 else np.float64, copy=False)
+        shape = data.shape
+        x = data.reshape((-1, shape[-1]))
+        n = x.shape[1]
+        lengths = [len(h) for h in self.kernels]
+        n_pad = max(min(max(lengths), n) - 1, 0)
+        n_fft = next_fast_len(n + 2 * n_pad + max(lengths) - 1, real=True)
+        if index is None:
+            index = range(len(self.kernels))
+        kernels = [self.kernels[k] for k in index]
+        H = [rfft(h.astype(data.dtype), n_fft) for h in kernels]
+        out = np.empty((len(kernels), x.shape[0], n), dtype=data.dtype)
+        rows = max(1, chunk_size // n_fft)
+        for start in range(0, x.shape[0], rows):
+            X = rfft(_pad(x[start:start + rows], n_pad, _PADS[self.design]), n_fft, axis=-1)
+            for k, h in enumerate(kernels):
+                shift = (len(h) - 1) // 2 + n_pad
+                out[k, start:start + rows] = irfft(X * H[k], n_fft, axis=-1)[:, shift:shift + n]
+        return out.reshape((len(kernels),) + shape)
+
+    def iter_apply(self, data):
+        """
+        Generator of the filtered data (..., times) of each band of the bank, in order. The
+        spectrum of data is computed once and each band is obtained when it is requested, so
+        only one filtered array is alive at a time. Same values as apply.
+        """
+        data = np.asarray(data)
+        data = data.astype(np.float32 if data.dtype == np.float32 else np.float64, copy=False)
+        shape = data.shape
+        x = data.reshape((-1, shape[-1]))
+        n = x.shape[1]
+        lengths = [len(h) for h in self.kernels]
+        n_pad = max(min(max(lengths), n) - 1, 0)
+        n_fft = next_fast_len(n + 2 * n_pad + max(lengths) - 1, real=True)
+        X = rfft(_pad(x, n_pad, _PADS[self.design]), n_fft, axis=-1)
+        for h in self.kernels:
+            shift = (len(h) - 1) // 2 + n_pad
+            out = irfft(X * rfft(h.astype(data.dtype), n_fft), n_fft, axis=-1)[:, shift:shift + n]
+            yield out.reshape(shape)
+
+def filter_band(data, sfreq, fmin, fmax, design='epochs'):
+    """
+    Band-limited copy of data.
+
+    data: numpy array (epochs, spaces, times)
+    design: 'epochs' or 'continuous', see the module docstring
+
+    Returns the filtered data with the same shape as data.
+    """
+    return filter_bands(data, sfreq, [(fmin, fmax)], design)[0]
+
+def filter_bands(data, sfreq, bands, design='epochs', index=None):
+    """
+    Band-limited copies of data for several bands in one pass of the FilterBank.
+
+    data: numpy array (epochs, spaces, times)
+    index: list of positions in bands, only those bands are filtered (with the geometry of the whole bank)
+    Returns an array (bands, epochs, spaces, times).
+    """
+    bank = FilterBank.get(sfreq, bands, design)
+    if design == 'epochs':
+        return bank.apply(data, index=index)
+    epochs,spaces,times = data.shape
+    signal = np.reshape(np.transpose(data,(1,2,0)),(spaces,times*epochs),order='F') # spaces times*epochs
+    filtered = bank.apply(signal, index=index)
+    return np.transpose(np.reshape(filtered,(filtered.shape[0],spaces,times,epochs),order='F'),(0,3,1,2))
+
+class BandCache:
+    """LRU cache of band-limited signals.
+
+    Parameters
+    ----------
+        max_bytes: int
+            Size above which the least recently used arrays are evicted. If None it is sized from
+            the recording: n_bands times the largest array stored since the last clear.
+        memmap_dir: str
+            If given the arrays are memory-mapped from .npy files in this folder instead of held in RAM.
+        n_bands: int
+            Number of band-limited copies of the recording kept when max_bytes is None.
+    """
+    def __init__(self, max_bytes=None, memmap_dir=None, n_bands=8):
+        self.max_bytes = max_bytes
+        self.n_bands = n_bands
+        self._largest = 0
+        self.memmap_dir = memmap_dir
+        if memmap_dir is not None:
+            os.makedirs(memmap_dir, exist_ok=True)
+        self._items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.memmap_dir, f'band_{os.getpid()}_{name}.npy')
+
+    def _store(self, key, array):
+        if self.memmap_dir is None:
+            stored = np.asarray(array)
+        else:
+            path = self._filename(key)
+            mm = np.lib.format.open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+            mm[...] = array
+            mm.flush()
+            del mm
+            stored = np.load(path, mmap_mode='r')
+        stored.flags.writeable = False
+        return stored
+
+    def _drop(self, key):
+        array = self._items.pop(key)
+        self.nbytes -= array.nbytes
+        if self.memmap_dir is not None:
+            del array
+            try:
+                os.remove(self._filename(key))
+            except OSError: # still mapped by a consumer
+                pass
+
+    def get(self, key, compute):
+        """Array of key, compute() is only called (and its result stored) if it is not in the cache."""
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+        self.misses += 1
+        array = self._store(key, compute())
+        self._items[key] = array
+        self.nbytes += array.nbytes
+        self._largest = max(self._largest, array.nbytes)
+        while self.nbytes > self.limit() and len(self._items) > 1:
+            self._drop(next(iter(self._items)))
+        return array
+
+    def limit(self):
+        """Size in bytes above which arrays are evicted."""
+        if self.max_bytes is not None:
+            return self.max_bytes
+        return self.n_bands * self._largest
+
+    def contains(self, key):
+        return key in self._items
+
+    def scope(self, *prefix):
+        """View of the cache where every key is prefixed, e.g. scope(file,space)."""
+        return _ScopedBandCache(self, prefix)
+
+    def clear(self):
+        for key in list(self._items.keys()):
+            self._drop(key)
+        self._largest = 0
+
+class _ScopedBandCache:
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+
+    def get(self, key, compute):
+        return self.cache.get(self.prefix + key, compute)
+
+    def contains(self, key):
+        return self.cache.contains(self.prefix + key)
+
+    def scope(self, *prefix):
+        return _ScopedBandCache(self.cache, self.prefix + prefix)
+
+def _band_key(band, design, dtype):
+    if dtype is None or np.dtype(dtype) == np.float64:
+        return (band, design)
+    return (band, design, np.dtype(dtype).name)
+
+def iter_bands(signal_epoch, bands, design='epochs', band_cache=None, dtype=None):
+    """
+    Generator of the band-limited data (epochs, spaces, times) of each band of a mne.Epochs.
+    A band missing in band_cache is filtered alone, with the padding and FFT length of the
+    FilterBank of all the bands, and stored before the next one is computed, so only one
+    band is held outside the cache at a time.
+    dtype: np.float32 to filter and keep the bands in single precision (def float64)
+    """
+    bands = [tuple(band) for band in bands]
+    data = None
+    for k, b in enumerate(bands):
+        key = _band_key(b, design, dtype)
+        if band_cache is not None and band_cache.contains(key):
+            yield band_cache.get(key, None)
+            continue
+        if data is None:
+            data = signal_epoch.get_data()
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+        compute = lambda k=k: filter_bands(data, signal_epoch.info['sfreq'], bands, design, index=[k])[0]
+        yield compute() if band_cache is None else band_cache.get(key, compute)
+
+def get_bands(signal_epoch, bands, design='epochs', band_cache=None, dtype=None):
+    """
+    List with the band-limited data (epochs, spaces, times) of each band of a mne.Epochs (see iter_bands).
+    """
+    return list(iter_bands(signal_epoch, bands, design, band_cache, dtype))
+
+def get_band(signal_epoch, fmin, fmax, design='epochs', band_cache=None):
+    """
+    Band-limited data (epochs, spaces, times) of a mne.Epochs, the signal is not modified.
+    If band_cache (BandCache or one of its scopes) is given the data is taken from it or stored in it.
+    """
+    compute = lambda: filter_band(signal_epoch.get_data(), signal_epoch.info['sfreq'], fmin, fmax, design)
+    if band_cache is None:
+        return compute()
+    return band_cache.get(((fmin, fmax), design), compute)
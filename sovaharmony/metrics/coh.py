@@ -2,12 +2,64 @@
 @autor: Verónica Henao Isaza, Universidad de Antioquia, 2022
 '''
 
-from scipy.signal import coherence
+from scipy.signal import get_window
 import numpy as np
 from sovaharmony.utils import _verify_epochs_axes,_verify_epoch_continuous
 import itertools
 # Why not use https://mne.tools/mne-connectivity/stable/generated/mne_connectivity.spectral_connectivity_epochs.html???
 
+def welch_segments(data,nperseg,noverlap=None):
+    '''
+    FFT of the Welch segments of all the channels at once, as scipy.signal.welch/csd
+    with a hann window, constant detrend and one-sided spectrum.
+
+    Parameters
+    ----------
+        data: numpy array (spaces, times)
+        nperseg: samples per segment
+        noverlap: overlapping samples (def nperseg//2)
+    Returns
+    -------
+        X: complex numpy array (spaces, segments, freqs)
+    '''
+    if noverlap is None:
+        noverlap = nperseg//2
+    step = nperseg - noverlap
+    segments = np.lib.stride_tricks.sliding_window_view(data,nperseg,axis=-1)[:,::step,:]
+    segments = segments - np.mean(segments,axis=-1,keepdims=True)
+    return np.fft.rfft(segments*get_window('hann',nperseg).astype(segments.dtype),axis=-1)
+
+def coherence_matrix(X,freqs_idxs=None,block=16):
+    '''
+    Magnitude squared coherence between every pair of channels from their Welch segments.
+    Only the cross-spectra of the upper triangle are computed, in blocks of rows, and the
+    lower triangle is its mirror, so the matrix of each frequency is exactly symmetric.
+
+    Parameters
+    ----------
+        X: complex numpy array (spaces, segments, freqs), see welch_segments
+        freqs_idxs: indexes of the frequencies to compute (def all)
+        block: rows of the cross-spectral matrix computed per matmul
+    Returns
+    -------
+        Cfxy: numpy array (freqs, spaces, spaces)
+    '''
+    if freqs_idxs is not None:
+        X = X[:,:,freqs_idxs]
+    Xf = np.transpose(X,(2,0,1)) # freqs spaces segments
+    Xh = np.conj(np.transpose(Xf,(0,2,1)))
+    freqs,spaces,_ = Xf.shape
+    Sxx = np.real(np.einsum('fcs,fsc->fc',Xf,Xh))
+    Cfxy = np.empty((freqs,spaces,spaces),dtype=Sxx.dtype)
+    for start in range(0,spaces,block):
+        stop = min(start+block,spaces)
+        Sxy = np.matmul(Xf[:,start:stop,:],Xh[:,:,start:]) # rows start:stop, columns start:
+        Cfxy[:,start:stop,start:] = np.abs(Sxy)**2/(Sxx[:,start:stop,None]*Sxx[:,None,start:])
+        Cfxy[:,stop:,start:stop] = np.swapaxes(Cfxy[:,start:stop,stop:],1,2)
+        rows,cols = np.triu_indices(stop-start,1)
+        Cfxy[:,start+cols,start+rows] = Cfxy[:,start+rows,start+cols]
+    return Cfxy
+
 def get_coherence_epochs(signal,window=3):
     '''
     Parameters
@@ -19,21 +71,13 @@ def get_coherence_epochs(signal,window=3):
         fc:
         Cxyc:
     '''
-    ch_names = signal.info['ch_names']
     data = signal.get_data()
     (e, c, t) = data.shape
     new_data = np.concatenate(data,axis=1)
     nperseg = int(np.floor(window*signal.info['sfreq']))
     _verify_epoch_continuous(data,new_data,('epochs','spaces','times'))
-    fc, Cxyc = coherence(new_data[0,:], new_data[0,:], signal.info['sfreq'], 'hann', nperseg = nperseg)
-    Cfxy =np.empty((len(fc),c,c))
-    pairs = itertools.product(ch_names,ch_names)
-    for x,y in pairs:
-        a = ch_names.index(x)
-        b = ch_names.index(y)
-        fc2, Cxy = coherence(new_data[a,:], new_data[b,:], signal.info['sfreq'], 'hann', nperseg = nperseg)
-        assert np.all(fc==fc2)
-        Cfxy[:,a,b]=Cxy
+    fc = np.fft.rfftfreq(nperseg,1/signal.info['sfreq'])
+    Cfxy = coherence_matrix(welch_segments(new_data,nperseg))
     return fc, Cfxy
 
 def get_coherence_continuous(signal,bands,window=3,freqs=None,Cfxy=None):
@@ -50,7 +94,25 @@ def get_coherence_continuous(signal,bands,window=3,freqs=None,Cfxy=None):
 
     return bands,Cbxy
 
-def get_coherence(signal,bands,window):
-    freqs,Cfxy = get_coherence_epochs(signal,window)
-    _,Cbxy = get_coherence_continuous(signal,bands,freqs=freqs,Cfxy=Cfxy,window=None)
-    return _,Cbxy
\ No newline at end of file
+def get_coherence(signal,bands,window,dtype=None):
+    '''
+    Coherence averaged in each band (bands, spaces, spaces). The Welch segments of all
+    the channels are computed once and only the frequencies of each band are formed,
+    without the (freqs, spaces, spaces) intermediate.
+    dtype: np.float32 to compute in single precision (def float64)
+    '''
+    data = signal.get_data()
+    if dtype is not None:
+        data = data.astype(dtype,copy=False)
+    new_data = np.concatenate(data,axis=1)
+    nperseg = int(np.floor(window*signal.info['sfreq']))
+    freqs = np.fft.rfftfreq(nperseg,1/signal.info['sfreq'])
+    X = welch_segments(new_data,nperseg)
+    blist = list(bands.keys())
+    nchans = new_data.shape[0]
+    Cbxy = np.empty((len(blist),nchans,nchans),dtype=X.real.dtype)
+    for b,brange in bands.items():
+        bidx = blist.index(b)
+        band_freqs_idxs = np.where(np.logical_and(brange[0]<=freqs, freqs<=brange[1]))[0]
+        Cbxy[bidx,:,:] = np.mean(coherence_matrix(X,band_freqs_idxs),axis=0)
+    return bands,Cbxy
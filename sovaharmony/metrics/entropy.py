@@ -1,5 +1,6 @@
 import numpy as np
 import itertools #Usado para ver las posibles permutaciones
+import math
 
 
 def Entropia_Permutacion(senal,D):
@@ -79,6 +80,68 @@ def Entropia_Permutacion(senal,D):
 
 
 
+def codigos_Lehmer(patrones):
+  """
+  Codifica vectores permutacion (ultimo eje de tamaño D) como enteros entre 0 y D!-1.
+  El codigo de Lehmer es el rango lexicografico de la permutacion, es decir la posicion
+  que tiene en list(itertools.permutations(np.arange(0,D,1))).
+  """
+  D = patrones.shape[-1]
+  codigos = np.zeros(patrones.shape[:-1], dtype=np.int64)
+  for i in range(D):
+    menores = np.zeros(patrones.shape[:-1], dtype=np.int64)
+    for j in range(i+1,D):
+      menores += patrones[...,j] < patrones[...,i]
+    codigos += menores*math.factorial(D-1-i)
+  return codigos
+
+def permutation_entropy(data,D=3,tau=1,axis=1,normalize=True,chunk_size=2**22):
+  """
+  Entropia de permutacion vectorizada de todas las series de tiempo de un arreglo.
+
+  Entradas:  data> ndarray con el tiempo en el eje axis, por ejemplo (canales, puntos, epocas).
+
+             D> Dimension embebida.
+
+             tau> Retardo de tiempo de incrustacion.
+
+             normalize> Si es True se divide por log2(D!).
+
+             chunk_size> Numero aproximado de vectores embebidos procesados a la vez (limita la memoria).
+
+  Salida:    ndarray con la forma de data sin el eje axis.
+
+  Los vectores embebidos se construyen con stride tricks (sin copiar la señal), cada vector
+  permutacion (argsort) se codifica como un entero con su codigo de Lehmer y los patrones se
+  cuentan con np.bincount. Para D=3 y tau=1 da el mismo valor que Entropia_Permutacion.
+  """
+  data = np.moveaxis(np.asarray(data),axis,-1)
+  forma = data.shape[:-1]
+  tamano = data.shape[-1]
+  series = data.reshape((-1,tamano))
+  numero_vectores = tamano-(D-1)*_tao_valido(tau)
+  num_patrones = math.factorial(D)
+  PE = np.empty(series.shape[0])
+  filas = max(1,chunk_size//max(1,numero_vectores))
+  for inicio in range(0,series.shape[0],filas):
+    bloque = series[inicio:inicio+filas]
+    matriz = np.lib.stride_tricks.sliding_window_view(bloque,(D-1)*tau+1,axis=-1)[...,::tau] # series, vectores, D
+    codigos = codigos_Lehmer(np.argsort(matriz,axis=-1))
+    desplazamiento = np.arange(bloque.shape[0])[:,None]*num_patrones
+    p_i = np.bincount((codigos+desplazamiento).ravel(),minlength=bloque.shape[0]*num_patrones).reshape((-1,num_patrones))
+    Pis = p_i/numero_vectores
+    with np.errstate(divide='ignore',invalid='ignore'):
+      PE[inicio:inicio+filas] = np.sum(np.where(Pis>0,-Pis*np.log2(Pis),0),axis=-1)
+  if normalize:
+    PE = PE/np.log2(num_patrones)
+  return PE.reshape(forma)
+
+def _tao_valido(tau):
+  if int(tau) != tau or tau < 1:
+    raise ValueError('tau must be a positive integer')
+  return int(tau)
+
+
 #### PRUEBA DOS ENTROPIAS
 #import mne
 #from sovaharmony.p_entropy import p_entropy
@@ -1,26 +1,25 @@
 from sovaharmony.metrics.coh import get_coherence
-from sovaharmony.metrics.sl import get_sl_1band
-from sovaharmony.metrics.p_entropy import get_entropy_freq
+from sovaharmony.metrics.sl import sl_config,sl_task
+from sovaharmony.metrics.p_entropy import get_entropy_freq,get_entropy_variant_freq
 
 #from sovaharmony.metrics.pme import get_pme_freq
 #from sovaharmony.metrics.pme import Modulation_Bands_Decomposition,Modulation_Bands_Spectrum,Modulation_Bands_Decomposition_Hamming
 from sovaharmony.metrics.pme import Amplitude_Modulation_Analysis
+from sovaharmony.metrics.bands import iter_bands
 import numpy as np
-from sovaflow.flow import fit_spatial_filter
+from sovaharmony.spatial import channels_reduction,adapted_demixing
 from sovaflow.utils import createRaw
 from sovachronux.qeeg_psd_chronux import qeeg_psd_chronux
-from sovaharmony.utils import _verify_epoch_continuous,_verify_epochs_axes
+from sovaharmony.metrics.multitaper import qeeg_psd_multitaper
+from sovaharmony.utils import _verify_epochs_axes,bounded_map
 import mne
 import yasa
+import inspect
+import os
+import time
+from functools import partial
 import numpy as np
 
-channels_reduction={'cresta':['F3','F4','C3','C4','P3','P4','O1','O2'],
-                    'openBCI':['FP1','FP2','C3','C4','P7','P8','O2','O1'],# #https://docs.openbci.com/Deprecated/UltracortexMark3_NovaDep/
-                    'paper':['F3','F4','C3','C4','TP7','TP8','O1','O2'] # En el paper esta T3 y T4, lo cambiamos por TP7 y TP8
-                    # Quantitative electroencephalography in mild cognitive impairment: longitdinal changes and possible prediction of ALzheimer's disease
-                    }
-
-
 ## USE PYTHON >3.7 , fundamental to guarantee dict order
 
 # each metric has an internal function that is executed internally in get_derivative
@@ -30,7 +29,7 @@ channels_reduction={'cresta':['F3','F4','C3','C4','P3','P4','O1','O2'],
 ### INTERNAL FEATURES FUNCTIONS ###
 def qeeg_psd_irasa(data, sf,bands,ch_names,descomposition,fmin=1,fmax=45,win_sec=5):
     power = {}
-    freqs, psd_aperiodic, psd_osc,fit_params = yasa.irasa(data, sf, ch_names=None, band=(fmin, fmax), win_sec=win_sec, return_fit=True)
+    freqs, psd_aperiodic, psd_osc,fit_params = yasa.irasa(data, sf=sf, ch_names=None, band=(fmin, fmax), win_sec=win_sec, return_fit=True)
     if descomposition:
         psd=psd_osc
     else: 
@@ -49,33 +48,69 @@ def qeeg_psd_irasa(data, sf,bands,ch_names,descomposition,fmin=1,fmax=45,win_sec
 
     return power_normalized,fit_params
 
+def _irasa_chunk(task):
+    """yasa.irasa over a (spaces, times) chunk, returns freqs, aperiodic psd, oscillatory psd and fit params array."""
+    data,sf,fmin,fmax,win_sec = task
+    freqs, psd_aperiodic, psd_osc, fit_params = yasa.irasa(data, sf=sf, ch_names=None, band=(fmin, fmax), win_sec=win_sec, return_fit=True)
+    fit_axes = list(fit_params.keys())[1:]
+    return freqs, np.atleast_2d(psd_aperiodic), np.atleast_2d(psd_osc), fit_params[fit_axes].to_numpy(), fit_axes
+
+def qeeg_psd_irasa_batch(data,sf,bands,descomposition,fmin=1,fmax=45,win_sec=5,n_jobs=1,chunk_size=None):
+    """
+    qeeg_psd_irasa over all the spaces at once.
+
+    data: numpy array (spaces, times)
+    n_jobs: int, worker processes used over chunks of spaces (def 1, all the spaces in one call)
+    chunk_size: int, spaces per call to yasa.irasa (def all of them, or split evenly over n_jobs)
 
-def _get_power(signal_epoch,bands,irasa=False,descomposition=True):
-    signal = np.transpose(signal_epoch.get_data(),(1,2,0)) # epochs spaces times -> spaces times epochs
-    _verify_epochs_axes(signal_epoch.get_data(),signal)
+    Returns the normalized band powers (bands, spaces), the fit params (spaces, params) and the names of the params.
+    """
+    spaces = data.shape[0]
+    if chunk_size is None:
+        workers = os.cpu_count() if n_jobs is not None and n_jobs < 0 else max(1,n_jobs or 1)
+        chunk_size = int(np.ceil(spaces/workers))
+    tasks = ((data[start:start+chunk_size],sf,fmin,fmax,win_sec) for start in range(0,spaces,chunk_size))
+    results = list(bounded_map(_irasa_chunk,tasks,n_jobs=n_jobs))
+    freqs = results[0][0]
+    if descomposition:
+        psd = np.concatenate([r[2] for r in results],axis=0)
+    else:
+        psd = np.concatenate([r[1]+r[2] for r in results],axis=0)
+    fit_values = np.concatenate([r[3] for r in results],axis=0)
+    masks = np.array([np.logical_and(vals[0] <= freqs, freqs < vals[1]) for vals in bands.values()],dtype=float) # bands freqs
+    power = masks @ psd.T # bands spaces
+    power_normalized = power/np.sum(power,axis=0)
+    return power_normalized,fit_values,results[0][4]
+
+def _get_power(signal_epoch,bands,irasa=False,descomposition=True,n_jobs=1,multitaper=False,dtype=np.float64):
+    """
+    Relative power per band (bands, spaces). With irasa the oscillatory (descomposition) or full
+    IRASA spectrum is used; otherwise the chronux multitaper spectrum, computed per space by
+    sovachronux or, with multitaper=True, for all the spaces at once (see metrics.multitaper).
+    """
+    data = signal_epoch.get_data().astype(dtype,copy=False)
+    signal = np.transpose(data,(1,2,0)) # epochs spaces times -> spaces times epochs
+    _verify_epochs_axes(data,signal)
     space_names = signal_epoch.info['ch_names']
     spaces,times,epochs = signal.shape
     output = {}
     output['metadata'] = {'type':'power','kwargs':{'bands':bands}}
     bands_list = list(bands.keys())
-    values = np.empty((len(bands_list),spaces))
+    values = np.empty((len(bands_list),spaces),dtype=dtype)
     output['metadata']['axes']={'bands':bands_list,'spaces':space_names}
     nchans,points,epochs = signal.shape
     signalCont = np.reshape(signal,(nchans,points*epochs),order='F')
     
     if irasa:
+        # all the spaces in one yasa.irasa call (or n_jobs chunks of them)
+        values,fit_values,fit_axes = qeeg_psd_irasa_batch(signalCont,signal_epoch.info['sfreq'],bands,descomposition,fmin=1,fmax=45,n_jobs=n_jobs)
         output['fit_params']={}
-        output['fit_params']['values']=[]
-        for space in space_names:
-            space_idx = space_names.index(space)
-            dummy,fit_params = qeeg_psd_irasa(signalCont[space_idx,:], signal_epoch.info['sfreq'],bands,signal_epoch.ch_names,descomposition,fmin=1,fmax=45)
-            output['fit_params']['axes']=list(fit_params.keys())[1:]
-            output['fit_params']['values']+=[[fit_params['Intercept'][0],fit_params['Slope'][0],fit_params['R^2'][0],fit_params['std(osc)'][0]]]
-            for b in bands.keys():
-                band_idx = bands_list.index(b)
-                values[band_idx,space_idx]=dummy[b] #if there is an error in this line update sovachornux
+        output['fit_params']['values']=fit_values.tolist()
+        output['fit_params']['axes']=fit_axes
         output['values'] = values
         
+    elif multitaper:
+        output['values'] = qeeg_psd_multitaper(signal,signal_epoch.info['sfreq'],bands)
     else:
         for space in space_names:
             space_idx = space_names.index(space)
@@ -88,7 +123,11 @@ def _get_power(signal_epoch,bands,irasa=False,descomposition=True):
 
 
 
-def _get_sl(signal_epoch,bands):
+def _get_sl(signal_epoch,bands,band_cache=None,n_jobs=1,executor=None,dtype=np.float64):
+    """
+    Synchronization likelihood per band. The (band, trial) pairs are independent, they run
+    serially or over n_jobs processes / an executor with a bounded number of pending tasks.
+    """
     space_names = signal_epoch.info['ch_names']
     epochs,spaces,times = signal_epoch.get_data().shape
 
@@ -99,17 +138,26 @@ def _get_sl(signal_epoch,bands):
     values = np.empty((len(bands_list),spaces,spaces))
     output['metadata']['axes']={'bands':bands_list,'spaces1':space_names,'spaces2':space_names}
 
-    for b,brange in bands.items():
-        dummy = get_sl_1band(signal_epoch,brange[0],brange[1])
+    config = sl_config()
+    band_data = iter_bands(signal_epoch,list(bands.values()),'epochs',band_cache,dtype=dtype)
+    def tasks():
+        for data in band_data:
+            for trial in range(epochs):
+                yield data[trial].T,config # times spaces
+    results = bounded_map(sl_task,tasks(),n_jobs=n_jobs,executor=executor)
+    for b in bands.keys():
         band_idx = bands_list.index(b)
-        values[band_idx,:,:]=dummy
+        sl_output = np.ones((spaces,spaces,epochs))
+        for trial in range(epochs):
+            sl_output[:,:,trial] = next(results)
+        values[band_idx,:,:]=np.mean(sl_output,2)
     output['values'] = values
     return output
 
-def _get_coh(signal_epoch,window,bands):
+def _get_coh(signal_epoch,window,bands,dtype=np.float64):
     chs = signal_epoch.info['ch_names']
     blist=list(bands.keys())
-    _,Cfxy = get_coherence(signal_epoch,bands,window)
+    _,Cfxy = get_coherence(signal_epoch,bands,window,dtype=dtype)
     axes = {'bands':blist,'spaces1':chs,'spaces2':chs}
     output = {}
     dim0 = list(axes.keys())[0]
@@ -118,34 +166,56 @@ def _get_coh(signal_epoch,window,bands):
     output['values']=Cfxy
     return output
 
-def _get_pme(signal_epoch,bands):
-    signal = np.transpose(signal_epoch.get_data(),(1,2,0)) # epochs spaces times -> spaces times epochs
-    _verify_epochs_axes(signal_epoch.get_data(),signal)
+def _get_pme(signal_epoch,bands,band_cache=None,design='continuous',dtype=np.float64):
+    """
+    Power of the amplitude modulation (crossfreq) per band and m-band.
+    design: 'continuous' filters the concatenated epochs (as pme.SubBands_Decomposition),
+    'epochs' filters each epoch and reuses the bands of sl and entropy (see metrics.bands).
+    """
+    data = signal_epoch.get_data().astype(dtype,copy=False)
+    signal = np.transpose(data,(1,2,0)) # epochs spaces times -> spaces times epochs
+    _verify_epochs_axes(data,signal)
     space_names = signal_epoch.info['ch_names']
     spaces,times,epochs = signal.shape
     output = {}
     output['metadata'] = {'type':'crossfreq','kwargs':{'bands':bands}}
+    if design != 'continuous':
+        output['metadata']['kwargs']['design']=design
     bands_list = list(bands.keys())
     values = np.empty((len(bands_list),spaces))
     output['metadata']['axes']={'spaces':space_names,'bands':bands_list,'bands':bands_list}
-    values = Amplitude_Modulation_Analysis(signal,signal_epoch.info['sfreq'],Bands=list(bands.values()))
+    SubBands_Signal = None
+    if band_cache is not None or design != 'continuous':
+        # generator of (spaces, times, epochs) views, each band is fetched when the streaming analysis needs it
+        SubBands_Signal = (np.transpose(x,(1,2,0)) for x in iter_bands(signal_epoch,list(bands.values()),design,band_cache,dtype=dtype))
+    values = Amplitude_Modulation_Analysis(signal,signal_epoch.info['sfreq'],Bands=list(bands.values()),SubBands_Signal=SubBands_Signal,Streaming=True)
     output['values'] = values
     return output
 
-def _get_entropy(signal_epoch,bands,D):
+def _get_entropy(signal_epoch,bands,D,band_cache=None,variant='pe',dtype=np.float64):
+    """
+    Permutation entropy per band. variant: 'pe' (permutation entropy), 'wpe' (weighted
+    permutation entropy) or 'complexity' (Jensen-Shannon complexity).
+    """
     space_names = signal_epoch.info['ch_names']
     epochs,spaces,times = signal_epoch.get_data().shape
 
     output = {}
     output['metadata'] = {'type':'entropy','kwargs':{'bands':bands,'D':D}}
+    if variant != 'pe':
+        output['metadata']['kwargs']['variant']=variant
 
     bands_list = list(bands.keys())
     values = np.empty((len(bands_list),spaces))
     output['metadata']['axes']={'bands':bands_list,'spaces':space_names}
 
-    for b,brange in bands.items():
+    band_data = iter_bands(signal_epoch,list(bands.values()),'epochs',band_cache,dtype=dtype)
+    for (b,brange),data in zip(bands.items(),band_data):
         fmin,fmax=brange
-        dummy = get_entropy_freq(signal_epoch,fmin=fmin,fmax=fmax,D=D)
+        if variant == 'pe':
+            dummy = get_entropy_freq(signal_epoch,fmin=fmin,fmax=fmax,D=D,data=data)
+        else:
+            dummy = get_entropy_variant_freq(signal_epoch,fmin=fmin,fmax=fmax,D=D,data=data,variant=variant,band_cache=band_cache)
         band_idx = bands_list.index(b)
         values[band_idx,:]=dummy
     output['values'] = values
@@ -161,64 +231,118 @@ foo_map={
     'sl':_get_sl,
     'cohfreq':_get_coh,
     'crossfreq':_get_pme,
-    'entropy':_get_entropy
+    'entropy':_get_entropy,
+    'entropy_wpe':partial(_get_entropy,variant='wpe'),
+    'entropy_complexity':partial(_get_entropy,variant='complexity'),
+}
+
+# Version of the values of each feature (1 if missing), it is part of the configuration hash
+# of the derivatives so a change of the values makes the manifest recompute them.
+# sl and entropy: 2, each band is filtered from the projected signal instead of cumulatively.
+FEATURE_VERSIONS = {
+    'sl':2,
+    'entropy':2,
 }
-def get_derivative(in_signal,feature,kwargs,spatial_filter=None,portables=False):
+def project_signal(in_signal,spatial_filter=None,portables=False):
     """
-    Returns derivative
-    If spatial_filter is not None, it will be computed over ics, otherwise over channels
+    Returns the signal in the space where the features are computed and the metadata of that space.
+    If spatial_filter is not None the signal is projected to the ics, otherwise it stays over channels
 
-    signal: mne.Epochs object
-    feature: str, the feature you want
-    kwargs: arguments for the fuction that calculates that feature
-    spatial_filter: tuple (A,W,spatial_filter_chs)
+    in_signal: mne.Epochs object, it is not modified
+    spatial_filter: dict with keys A,W,ch_names,name (see sovaharmony.spatial.get_spatial_filter)
+
+    The ics are computed with a single matmul of the demixing matrix (zero for the channels
+    out of the spatial filter) over the (epochs, channels, times) data of in_signal, written
+    into the array wrapped by the returned mne.EpochsArray, so the data is not copied.
     """
-    signal = in_signal.copy()
-    
+    space = {}
     if spatial_filter is not None:
         # ICs powers
         A,W,spatial_filter_chs,sf_name = spatial_filter['A'],spatial_filter['W'],spatial_filter['ch_names'],spatial_filter['name']
-        intersection_chs = list(set(spatial_filter_chs).intersection(signal.ch_names))
-        W_adapted = fit_spatial_filter(W,spatial_filter_chs,intersection_chs,mode='demixing')
-        signal.reorder_channels(intersection_chs)
-        signal2 = np.transpose(signal.get_data(),(1,2,0)) # epochs spaces times -> spaces times epochs
-        _verify_epochs_axes(signal.get_data(),signal2)
-        nchans,points,epochs = signal2.shape
-        signalCont = np.reshape(signal2,(nchans,points*epochs),order='F')
-        _verify_epoch_continuous(signal.get_data(),signalCont,('epochs','spaces','times'))
+        W_adapted,intersection_chs = adapted_demixing(spatial_filter,in_signal.ch_names)
+        data = in_signal.get_data(copy=False) # epochs spaces times
         if portables:
-            resample= signal.info['sfreq']/4 
-            signal_resample=signalCont[:,::4] # Signal chx resample- continue
-            ics = W_adapted @ signal_resample
-            comps = ics.shape[0]
-            ics_epoch = np.reshape(ics,(comps,int(points/4),epochs),order='F')
-            
-        else:
-            ics = W_adapted @ signalCont
-            comps = ics.shape[0]
-            ics_epoch = np.reshape(ics,(comps,points,epochs),order='F')
-        
-        _verify_epoch_continuous(ics_epoch,ics,('spaces','times','epochs'))
-        ics_epoch2 = np.transpose(ics_epoch,(2,0,1))
-        _verify_epochs_axes(ics_epoch2,ics_epoch)
-        del ics_epoch
-        del ics
-        del signalCont
-        del signal2
+            data = data[:,:,::4] # resample, as the continuous signal[:,::4] when the epochs have a multiple of 4 points
+        comps = W_adapted.shape[0]
+        W_full = np.zeros((comps,data.shape[1]))
+        W_full[:,[in_signal.ch_names.index(ch) for ch in intersection_chs]] = W_adapted
+        ics_epoch = np.empty((data.shape[0],comps,data.shape[2]))
+        np.matmul(W_full,data,out=ics_epoch)
         info_epochs=mne.create_info(['C'+str(x+1) for x in range(comps)], in_signal.info['sfreq'], ch_types='eeg')
-        signal = mne.EpochsArray(ics_epoch2,info_epochs)
+        signal = mne.EpochsArray(ics_epoch,info_epochs,verbose=False)
+        space['space']='ics'
+        space['W'] = W_adapted
+        space['W_channels']=intersection_chs
+        space['spatial_filter_name']=sf_name
+    else:
+        signal = in_signal.copy()
+        space['space']='sensors'
     
     if spatial_filter==None and portables:
        signal.get_data()[2][channels_reduction]
-    
-    output=foo_map[feature](signal,**kwargs)
+    return signal,space
 
-    if spatial_filter is not None:
-        output['metadata']['space']='ics'
-        output['metadata']['W'] = W_adapted
-        output['metadata']['W_channels']=intersection_chs
-        output['metadata']['spatial_filter_name']=sf_name
-    else:
-        output['metadata']['space']='sensors'
+def compute_derivative(signal,feature,kwargs,space,band_cache=None,dtype=None):
+    """
+    Computes a feature over an already projected signal (see project_signal)
+
+    signal: mne.Epochs object, it is not modified so it can be shared by several features
+    feature: str, the feature you want
+    kwargs: arguments for the fuction that calculates that feature
+    space: dict, metadata of the space returned by project_signal
+    band_cache: BandCache (or a scope of it), band-filtered data shared by sl, entropy and crossfreq
+    dtype: precision of the computation (e.g. np.float32), None for float64. The mne containers
+        stay in float64, the data is cast when it enters the _get_ function.
+    """
+    foo = foo_map[feature]
+    parameters = inspect.signature(foo).parameters
+    if band_cache is not None and 'band_cache' in parameters:
+        kwargs = dict(kwargs,band_cache=band_cache)
+    if dtype is not None and 'dtype' in parameters:
+        kwargs = dict(kwargs,dtype=dtype)
+    output=foo(signal,**kwargs)
+    output['metadata'].update(space)
+    if dtype is not None and np.dtype(dtype) != np.float64:
+        output['metadata']['dtype'] = np.dtype(dtype).name
     return output
-    
\ No newline at end of file
+
+def get_derivative(in_signal,feature,kwargs,spatial_filter=None,portables=False,dtype=None):
+    """
+    Returns derivative
+    If spatial_filter is not None, it will be computed over ics, otherwise over channels
+
+    signal: mne.Epochs object
+    feature: str, the feature you want
+    kwargs: arguments for the fuction that calculates that feature
+    spatial_filter: tuple (A,W,spatial_filter_chs)
+    dtype: precision of the computation, None for float64 (see compute_derivative)
+    """
+    signal,space = project_signal(in_signal,spatial_filter,portables)
+    return compute_derivative(signal,feature,kwargs,space,dtype=dtype)
+
+def benchmark_dtype(in_signal,features_tuples,spatial_filter=None,portables=False,dtype=np.float32):
+    """
+    Deviation of the features computed in dtype from the float64 reference, and the time of both.
+
+    features_tuples: list of (feature,kwargs) as in postprocessing.features
+    Returns a list with a dict per feature: feature, max_abs, max_rel (over the largest
+    reference value), time_float64 and time_dtype (seconds).
+    """
+    signal,space = project_signal(in_signal,spatial_filter,portables)
+    report = []
+    for feature,kwargs in features_tuples:
+        start = time.perf_counter()
+        reference = compute_derivative(signal,feature,kwargs,space)
+        time_reference = time.perf_counter() - start
+        start = time.perf_counter()
+        output = compute_derivative(signal,feature,kwargs,space,dtype=dtype)
+        time_dtype = time.perf_counter() - start
+        reference = np.asarray(reference['values'],dtype=np.float64)
+        deviation = np.abs(np.asarray(output['values'],dtype=np.float64) - reference)
+        row = {'feature':feature,'max_abs':float(np.nanmax(deviation)),
+               'max_rel':float(np.nanmax(deviation)/np.nanmax(np.abs(reference))),
+               'time_float64':time_reference,'time_dtype':time_dtype}
+        print(f"{feature}: max deviation {row['max_abs']:.3e} (relative {row['max_rel']:.3e}), "
+              f"float64 {time_reference:.2f}s, {np.dtype(dtype).name} {time_dtype:.2f}s")
+        report.append(row)
+    return report
@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 from scipy.spatial.distance import euclidean
 from sovaharmony.metrics.sl import segment_signal
-from sovaharmony.metrics.entropy import Entropia_Permutacion
+from sovaharmony.metrics.entropy import Entropia_Permutacion,permutation_entropy,codigos_Lehmer
 from sovaharmony.utils import _verify_epochs_axes
 
 def s_entropy(freq_list):
@@ -89,27 +89,105 @@ def weighted_ordinal_patterns(ts, embdim, embdelay):
         wop.append(np.sum(result.loc[result['pattern']==pat,'weights'].values))
     return(wop)
 
-def get_entropy_freq(signal,D=3,fmin=None,fmax=None):
-    if fmin and fmax:
-        new_signal =signal.filter(fmin,fmax)
+def _embedding_series(data, embdim, embdelay, axis):
+    ''' Time series of data (time in axis) as rows of a 2-D array, and the shape of the rest of axes.'''
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    return data.reshape((-1, data.shape[-1])), data.shape[:-1]
+
+def ordinal_patterns_array(data, embdim, embdelay, axis=-1, weighted=False, chunk_size=2**22):
+    ''' Array-native ordinal_patterns / weighted_ordinal_patterns.
+    USAGE: ordinal_patterns_array(data, embdim, embdelay, axis=1) for data (channels, times, epochs)
+    ARGS: data = 1-D, 2-D or 3-D numeric array with the time in axis, embdim = embedding dimension,
+    embdelay = embedding delay, weighted = sum the variance of each embedded vector instead of counting it,
+    chunk_size = approximate number of embedded vectors processed at once
+    OUTPUT: Array with the shape of data without axis plus a last axis of length embdim!, the frequency
+    (or weight) of each ordinal pattern in the order of itertools.permutations(range(embdim))'''
+    series, shape = _embedding_series(data, embdim, embdelay, axis)
+    n_vectors = series.shape[-1] - embdelay * (embdim - 1)
+    n_patterns = int(np.prod(np.arange(1, embdim + 1)))
+    op = np.empty((series.shape[0], n_patterns))
+    rows = max(1, chunk_size // max(1, n_vectors))
+    for start in range(0, series.shape[0], rows):
+        block = series[start:start + rows]
+        vectors = np.lib.stride_tricks.sliding_window_view(block, embdelay * (embdim - 1) + 1, axis=-1)[..., ::embdelay]
+        codes = codigos_Lehmer(np.argsort(vectors, axis=-1))
+        codes = codes + np.arange(block.shape[0])[:, None] * n_patterns
+        weights = np.var(vectors, axis=-1).ravel() if weighted else None
+        op[start:start + rows] = np.bincount(codes.ravel(), weights=weights,
+                                             minlength=block.shape[0] * n_patterns).reshape((-1, n_patterns))
+    return op.reshape(shape + (n_patterns,))
+
+def weighted_ordinal_patterns_array(data, embdim, embdelay, axis=-1, chunk_size=2**22):
+    ''' Array-native weighted_ordinal_patterns, see ordinal_patterns_array.'''
+    return ordinal_patterns_array(data, embdim, embdelay, axis=axis, weighted=True, chunk_size=chunk_size)
+
+def s_entropy_array(p):
+    ''' Shannon entropy (natural log) of distributions in the last axis, zeros are ignored.'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(np.where(p > 0, p * np.log(p), 0), axis=-1)
+
+def p_entropy_array(op):
+    ''' Array-native p_entropy of the ordinal patterns (or weights) in the last axis of op.'''
+    op = np.asarray(op, dtype=float)
+    p = op / np.sum(op, axis=-1, keepdims=True)
+    return s_entropy_array(p) / np.log(op.shape[-1])
+
+def complexity_array(op):
+    ''' Array-native complexity (Jensen-Shannon) of the ordinal patterns in the last axis of op.'''
+    op = np.asarray(op, dtype=float)
+    n = op.shape[-1]
+    pe = p_entropy_array(op)
+    constant1 = (0.5+((1 - 0.5)/n))* np.log(0.5+((1 - 0.5)/n))
+    constant2 = ((1 - 0.5)/n)*np.log((1 - 0.5)/n)*(n - 1)
+    constant3 = 0.5*np.log(n)
+    Q_o = -1/(constant1+constant2+constant3)
+
+    temp_op_prob = op / np.sum(op, axis=-1, keepdims=True)
+    temp_op_prob2 = (0.5*temp_op_prob)+(0.5*(1/n))
+    JSdivergence = (s_entropy_array(temp_op_prob2) - 0.5 * s_entropy_array(temp_op_prob) - 0.5 * np.log(n))
+    return Q_o * JSdivergence * pe
+
+def get_entropy_variant_freq(signal,D=3,fmin=None,fmax=None,data=None,variant='wpe',band_cache=None):
+    """
+    Weighted permutation entropy (variant='wpe') or Jensen-Shannon complexity (variant='complexity')
+    per channel of a mne.Epochs in a band, averaged over the epochs. signal is not modified.
+    data: band-limited data (epochs, spaces, times) of signal if it was already filtered.
+    band_cache: the ordinal patterns are shared through it by the variants of the same band.
+    """
+    if data is None:
+        if fmin and fmax:
+            data = signal.copy().filter(fmin,fmax).get_data()
+        else:
+            data = signal.get_data()
+    weighted = variant == 'wpe'
+    compute = lambda: ordinal_patterns_array(data,D,1,axis=-1,weighted=weighted) # epochs spaces patterns
+    if band_cache is not None:
+        op = band_cache.get(((fmin,fmax),'epochs','weighted_ordinal' if weighted else 'ordinal',D,1,data.dtype.name),compute)
     else:
-        new_signal =signal.copy()
+        op = compute()
+    if variant == 'wpe':
+        values = p_entropy_array(op)
+    elif variant == 'complexity':
+        values = complexity_array(op)
+    else:
+        raise ValueError(f'Unknown entropy variant {variant}')
+    return np.mean(values,axis=0)
 
-    data = new_signal.get_data()
-    del new_signal
+def get_entropy_freq(signal,D=3,fmin=None,fmax=None,data=None):
+    """
+    Permutation entropy per channel of a mne.Epochs in a band, signal is not modified.
+    data: band-limited data (epochs, spaces, times) of signal if it was already filtered.
+    """
+    if data is None:
+        if fmin and fmax:
+            data = signal.copy().filter(fmin,fmax).get_data()
+        else:
+            data = signal.get_data()
     (e, c, t) = data.shape
     new_data = np.transpose(data.copy(),(1,2,0))
     _verify_epochs_axes(data,new_data)
     del data
-    mean_channels = []
-    for channel in range(c):
-        segment = []
-        for epoch in range(e):
-            # Por segmento
-            # O usar p_entropy(new_data[channel,:,epoch]) ??
-            entropy_segment = Entropia_Permutacion(new_data[channel,:,epoch],D=3)
-            segment.append(entropy_segment)
-            # Por canal
-        mean_channels.append(np.mean(segment))
-    return np.array(mean_channels)
+    # Por segmento (channels, epochs), luego por canal
+    entropy_segments = permutation_entropy(new_data,D=D,tau=1,axis=1)
+    return np.mean(entropy_segments,axis=1)
 
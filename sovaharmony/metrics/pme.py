@@ -14,6 +14,8 @@ from sovaflow.utils import createRaw
 ####################### Internal libraries #####################################
 #import sovaharmony.linear_FIR_filter_v2 as lfir
 import mne
+from functools import lru_cache
+from sovaharmony.metrics.bands import FilterBank
 
 ########################## My exception classes ###############################
 class Error(Exception):
@@ -46,6 +48,18 @@ def Order_Hamming_Window(Cutoff_Hz, Fs):
         Order += 1
     return Order
 
+@lru_cache(maxsize=None)
+def Hamming_Window_Kernel(Order, Cutoff_Low, Cutoff_High, Fs):
+    """
+    Coeficientes del filtro pasabanda FIR de ventana Hamming, se diseñan una sola vez
+    por proceso para cada (orden, frecuencias de corte, frecuencia de muestreo).
+    """
+    Nyq_Rate = Fs/2  
+    Cutoff_Norm = [Cutoff_Low/Nyq_Rate, Cutoff_High/Nyq_Rate]
+    a = signal.firwin(Order, Cutoff_Norm, window = 'hamming', pass_zero = False)
+    a.flags.writeable = False
+    return a
+
 def BandPass_Filter_Hamming_Window(Signal, Cutoff_Hz, Fs, Order):
     """
     Calcula y aplica un filtro pasabanda tipo FIR de ventana Hamming a una señal de entrada.
@@ -72,9 +86,7 @@ def BandPass_Filter_Hamming_Window(Signal, Cutoff_Hz, Fs, Order):
                 aceptables (1 o 2).
     """
     if (type(Signal) == np.ndarray):
-        Nyq_Rate = Fs/2  
-        Cutoff_Norm = [Cutoff_Hz[0]/Nyq_Rate, Cutoff_Hz[1]/Nyq_Rate]
-        a = signal.firwin(Order, Cutoff_Norm, window = 'hamming', pass_zero = False)
+        a = Hamming_Window_Kernel(Order, Cutoff_Hz[0], Cutoff_Hz[1], Fs)
         Delay = int(round(0.5 * (Order-1))) 
         if (Signal.ndim == 2): 
             Filtered_Signal = signal.filtfilt(a,1,Signal)[:,Delay:]
@@ -123,24 +135,22 @@ def SubBands_Decomposition(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],[10.5,1
         Num_Bands = len(Bands)
         if (Filt  == 'FIR_filter'):
             if (Signal.ndim == 2):
-                Signal_raw = createRaw(Signal,Fs)
                 Num_Signals, Values = Signal.shape
                 SubBand_Signal = np.zeros((Num_Signals, Num_Bands, Values))
+                Filtered = FilterBank.get(Fs, Bands).apply(Signal)
                 for j, Band in enumerate(Bands):
-                    SubBand_Signal[:,j,:] = mne.filter.filter_data(Signal, Fs, Band[0],Band[1])
+                    SubBand_Signal[:,j,:] = Filtered[j]
             elif (Signal.ndim == 1): 
                  
-                SubBand_Signal = np.zeros((Num_Bands, Signal.shape[0]))
-                for i, Band in enumerate(Bands):
-                    SubBand_Signal[i] = mne.filter.filter_data(Signal, Fs, Band[0],Band[1])
+                SubBand_Signal = FilterBank.get(Fs, Bands).apply(Signal)
             elif (Signal.ndim == 3):
                 
                 Num_Signals, Values, Epochs = Signal.shape
                 Temp_Signal = np.reshape(Signal, (Num_Signals,Values*Epochs), order='F')
                 SubBand_Signal = np.zeros((Num_Signals, Num_Bands, Values, Epochs))
+                Filtered = FilterBank.get(Fs, Bands).apply(Temp_Signal)
                 for j, Band in enumerate(Bands):
-                    SubBand_Signal[:,j,:,:] = np.reshape(mne.filter.filter_data(Temp_Signal, Fs, Band[0],Band[1]),
-                                           (Num_Signals, Values, Epochs), order='F')
+                    SubBand_Signal[:,j,:,:] = np.reshape(Filtered[j], (Num_Signals, Values, Epochs), order='F')
             else:
                 raise DoingError('The signal variable can only have 1, 2 or 3 dimensions!!')
         elif (Filt  == 'Hamming'):
@@ -257,23 +267,25 @@ def Modulation_Bands_Decomposition(SubBand_Signal, Fs, M_Bands = [[1.5,6],[6,8.5
             if (SubBand_Signal.ndim == 2):
                 Num_Bands, Values = SubBand_Signal.shape
                 MBand_Signal = np.zeros((Num_M_Bands, Num_Bands, Values))
-                for i, M_Band in enumerate(M_Bands):
-                    for j in range(0,i+1):
-                        MBand_Signal[i,j,:] = mne.filter.filter_data(SubBand_Signal[j], Fs, M_Band[0],M_Band[1])
+                for j in range(0,min(Num_Bands,Num_M_Bands)):
+                    Filtered = FilterBank.get(Fs, M_Bands[j:]).apply(SubBand_Signal[j])
+                    for i in range(j,Num_M_Bands):
+                        MBand_Signal[i,j,:] = Filtered[i-j]
             elif (SubBand_Signal.ndim == 3):
                 Num_Signals, Num_Bands, Values = SubBand_Signal.shape
                 MBand_Signal = np.zeros((Num_Signals, Num_M_Bands, Num_Bands, Values))
-                for i, M_Band in enumerate(M_Bands):
-                    for j in range(0,i+1):
-                        MBand_Signal[:,i,j,:] = mne.filter.filter_data(SubBand_Signal[:,j,:], Fs, M_Band[0],M_Band[1])
+                for j in range(0,min(Num_Bands,Num_M_Bands)):
+                    Filtered = FilterBank.get(Fs, M_Bands[j:]).apply(SubBand_Signal[:,j,:])
+                    for i in range(j,Num_M_Bands):
+                        MBand_Signal[:,i,j,:] = Filtered[i-j]
             elif (SubBand_Signal.ndim == 4):
                 Num_Signals, Num_Bands, Values, Epochs = SubBand_Signal.shape
                 Temp_Signal = np.reshape(SubBand_Signal, (Num_Signals, Num_Bands, Values*Epochs), order='F')
                 MBand_Signal = np.zeros((Num_Signals, Num_M_Bands, Num_Bands, Values, Epochs))
-                for i, M_Band in enumerate(M_Bands):
-                    for j in range(0,i+1):
-                        MBand_Signal[:,i,j,:,:] = np.reshape(mne.filter.filter_data(Temp_Signal[:,j,:], Fs, M_Band[0],M_Band[1]), 
-                                    (Num_Signals, Values, Epochs), order='F')
+                for j in range(0,min(Num_Bands,Num_M_Bands)):
+                    Filtered = FilterBank.get(Fs, M_Bands[j:]).apply(Temp_Signal[:,j,:])
+                    for i in range(j,Num_M_Bands):
+                        MBand_Signal[:,i,j,:,:] = np.reshape(Filtered[i-j], (Num_Signals, Values, Epochs), order='F')
             else:
                 raise DoingError('The signal variable can only have 2, 3 or 4 dimensions!!')
         elif (Filt  == 'Hamming'):
@@ -564,7 +576,75 @@ def Percentage_Modulation_Energy(Energy):
     else:
         raise DoingError('The signal variable is not an array!!')
     
-def Amplitude_Modulation_Analysis(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],[10.5,12.5],[12.5,18.5],[18.5,21],[21,30],[30,45]], Method='filter' , Filt='FIR_filter'):
+def Modulation_Energy_Streaming(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],[10.5,12.5],[12.5,18.5],[18.5,21],[21,30],[30,45]], SubBands_Signal=None):
+    """
+    Calcula la energia de cada descomposicion (M_banda, banda) de una señal de 3 dimensiones
+    sin guardar las descomposiciones completas. Equivale a aplicar SubBands_Decomposition,
+    Temporal_Envelopes, Modulation_Bands_Decomposition, Modulation_Bands_Spectrum y
+    Parseval_Theorem_Modulation_Bands con Filt='FIR_filter' y M_Bands=Bands, pero cada
+    sub-banda y cada m-banda se procesan por separado y la energia de cada m-banda se acumula
+    inmediatamente, por lo que la memoria maxima es un numero pequeño de arreglos
+    (Señales, Muestras, Epocas) que no depende del numero de bandas.
+    Si la señal es float32 todo el calculo se hace en float32.
+
+    Parámetros:
+        Signal: tipo numpy.ndarray
+                -> 3 dimensiones (Señales, Muestras, Epocas)
+                
+        Fs: tipo int 
+                Valor de la frecuencia de muestreo de la señal.
+        
+        Opcionales:
+            
+        Bands: tipo list
+                Una lista con las tuplas de cada una de las bandas (y m-bandas).
+                
+        SubBands_Signal: tipo numpy.ndarray, list o generador
+                Descomposicion en sub-bandas ya calculada, como arreglo (Señales, Bandas, Muestras, Epocas)
+                o como lista/generador con un arreglo (Señales, Muestras, Epocas) por banda, en el orden
+                de Bands. Con un generador cada sub-banda se pide cuando se necesita y se libera despues
+                de usarla. Si es None se calcula cada sub-banda cuando se necesita.
+                
+    Devuelve:
+        Energy: tipo numpy.ndarray
+                Arreglo de energias (Señales, M_Bandas, Bandas, Epocas)
+    """
+    if (type(Signal) == np.ndarray) and (Signal.ndim == 3):
+        Num_Signals, Values, Epochs = Signal.shape
+        Num_Bands = len(Bands)
+        dtype = np.float32 if Signal.dtype == np.float32 else np.float64
+        Energy = np.zeros((Num_Signals, Num_Bands, Num_Bands, Epochs), dtype=dtype)
+        if SubBands_Signal is None:
+            Temp_Signal = np.reshape(Signal, (Num_Signals,Values*Epochs), order='F')
+        elif type(SubBands_Signal) != np.ndarray:
+            SubBands_Signal = iter(SubBands_Signal)
+        for j, Band in enumerate(Bands):
+            if SubBands_Signal is None:
+                SubBand = np.reshape(FilterBank.get(Fs, Bands).apply(Temp_Signal, index=[j])[0],
+                                     (Num_Signals, Values, Epochs), order='F')
+            elif type(SubBands_Signal) == np.ndarray:
+                SubBand = SubBands_Signal[:,j,:,:]
+            else:
+                SubBand = next(SubBands_Signal)
+            # mismo orden en memoria que las descomposiciones completas (C), asi las sumas dan lo mismo
+            Envelope = np.absolute(signal.hilbert(np.ascontiguousarray(SubBand), axis=1)).astype(dtype, copy=False)
+            del SubBand
+            Temp_Envelope = np.reshape(Envelope, (Num_Signals, Values*Epochs), order='F')
+            del Envelope
+            # una m-banda a la vez, con la geometria del banco Bands[j:] de Modulation_Bands_Decomposition
+            MBands = FilterBank.get(Fs, Bands[j:]).iter_apply(Temp_Envelope)
+            for i in range(j, len(Bands)):
+                MBand_Signal = np.reshape(next(MBands), (Num_Signals, Values, Epochs), order='F')
+                Spectrum = Signal_Spectrum(np.ascontiguousarray(MBand_Signal))
+                del MBand_Signal
+                Energy[:, i, j, :] = Parseval_Theorem(Spectrum)
+                del Spectrum
+            del Temp_Envelope, MBands
+        return Energy
+    else:
+        raise DoingError('The signal variable must be an array of 3 dimensions!!')
+
+def Amplitude_Modulation_Analysis(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],[10.5,12.5],[12.5,18.5],[18.5,21],[21,30],[30,45]], Method='filter' , Filt='FIR_filter', SubBands_Signal=None, Streaming=False):
     """
     Aplica el analisis de modulacion de amplitud a una señal
     (por defecto a Delta, Theta, Alpha, Beta, Gamma).
@@ -594,6 +674,15 @@ def Amplitude_Modulation_Analysis(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],
                 Un string que indica el tipo de filtro a utilizar para la descomposicion.
                 -> 'FIR_filter': Filtro FIR 
                 -> 'Hamming': filtro tipo FIR de ventana Hamming
+        
+        SubBands_Signal: tipo numpy.ndarray
+                Descomposicion en sub-bandas ya calculada (ver SubBands_Decomposition),
+                por ejemplo tomada de metrics.bands.BandCache. Si es None se calcula.
+                Con Streaming puede ser una lista o un generador con un arreglo (Señales, Muestras, Epocas) por banda.
+        
+        Streaming: tipo bool
+                Para señales de 3 dimensiones con Method='filter' y Filt='FIR_filter' calcula las
+                energias con Modulation_Energy_Streaming (mismo resultado, memoria acotada).
                 
     Devuelve:
         pme: tipo numpy.ndarray
@@ -603,8 +692,15 @@ def Amplitude_Modulation_Analysis(Signal, Fs, Bands=[[1.5,6],[6,8.5],[8.5,10.5],
                 -> 3 dimensiones (Señales, M_Bandas, Bandas) 
     """
     if (type(Signal) == np.ndarray):
-        if ((Signal.ndim == 1) or (Signal.ndim == 2) or (Signal.ndim == 3)):
-            SubBands_Signal = SubBands_Decomposition(Signal, Fs, Bands=Bands, Filt=Filt)
+        if Streaming and (Signal.ndim == 3) and (Method == 'filter') and (Filt == 'FIR_filter'):
+            Energy = Modulation_Energy_Streaming(Signal, Fs, Bands=Bands, SubBands_Signal=SubBands_Signal)
+            del Signal, SubBands_Signal
+            pme = Percentage_Modulation_Energy(Energy)
+            del Energy
+            return pme
+        elif ((Signal.ndim == 1) or (Signal.ndim == 2) or (Signal.ndim == 3)):
+            if SubBands_Signal is None:
+                SubBands_Signal = SubBands_Decomposition(Signal, Fs, Bands=Bands, Filt=Filt)
             del Signal
             Envelope = Temporal_Envelopes(SubBands_Signal)
             del SubBands_Signal
@@ -31,11 +31,11 @@ from numpy import diag
 from numpy import split
 from math import ceil as math_ceil
 import numpy as np
-from sovaharmony.utils import _verify_epochs_axes,_verify_epoch_continuous
+from sovaharmony.utils import _verify_epochs_axes,_verify_epoch_continuous,bounded_map
 
 #Create the funtions
 
-def get_sl(data, fs, time_delay=None, w1=None, w2=None, pref=None):
+def get_sl(data, fs, time_delay=None, w1=None, w2=None, pref=None, n_jobs=1, executor=None):
     '''
     Function responsible for configuring and executing the calculation of the 
     synchronization likelihood of a set of signals.
@@ -63,6 +63,14 @@ def get_sl(data, fs, time_delay=None, w1=None, w2=None, pref=None):
     :param pref: float, optional.
         Default is: None.
 
+    :param n_jobs: int, optional.
+        Number of worker processes used to spread the trials, -1 uses all
+        the cores. Default is: 1 (serial).
+
+    :param executor: concurrent.futures.Executor, optional.
+        Executor used for the trials instead of creating one.
+        Default is: None.
+
     :return sl_output: numpy array.
         Matrix with dimensions channels*channels that contained the average of 
         the measure of the sinchronization likelihood between each of the 
@@ -82,6 +90,18 @@ def get_sl(data, fs, time_delay=None, w1=None, w2=None, pref=None):
               %len(size))
         exit()
 
+    config = sl_config(time_delay, w1, w2, pref)
+
+    #Execute the routine.
+    sl_output = sl_methods(data, config, n_jobs=n_jobs, executor=executor)
+    
+    return mean(sl_output, 2)
+
+def sl_config(time_delay=None, w1=None, w2=None, pref=None):
+    '''
+    Configuration passed to sl(), None takes the default value.
+    config = (time_delay, dimensions, window_1, window_2, pref, measures)
+    '''
     #Default values.
     if time_delay == None: time_delay = 4
     
@@ -93,12 +113,7 @@ def get_sl(data, fs, time_delay=None, w1=None, w2=None, pref=None):
     
     measure = "SL"
     
-    config = (time_delay, 3, w1, w2, pref, measure)
-
-    #Execute the routine.
-    sl_output = sl_methods(data, config)
-    
-    return mean(sl_output, 2)
+    return (time_delay, 3, w1, w2, pref, measure)
 
 def segment_signal(signal, fs):
     '''
@@ -127,7 +142,7 @@ def segment_signal(signal, fs):
     data = data.transpose((1,2,0))
     return data 
 
-def sl_methods(data,config):
+def sl_methods(data,config,n_jobs=1,executor=None):
     '''
     Function responsible for preparing the input data to calculate the 
     sinchronization likelihood throungh the sl() function.
@@ -145,6 +160,13 @@ def sl_methods(data,config):
         config = [time_delay, dimensions, window_1, window_2, pref, measures]
         
         Default is: config = (4, 3, 16, 215, 0.05, "SL") 
+
+    :param n_jobs: int, optional.
+        Number of worker processes used to spread the trials (see
+        sovaharmony.utils.bounded_map). Default is: 1 (serial).
+
+    :param executor: concurrent.futures.Executor, optional.
+        Default is: None.
         
     :returns: numpy array with the mean of the calculate of sinchronization 
         likelihood. It's a matrix of channels*channels.
@@ -160,14 +182,20 @@ def sl_methods(data,config):
         #Reserves the needed memory.
         sl_output = ones((channels, channels, trials), dtype=float64)
 
-    #Iterate over trials of the data.   
-    for trial in arange(0, trials, dtype=int):
-        #Calculate synchronization likelihood with the sl() funtion to each matrix
-        #of data.
-        sl_output[:, :, trial] = sl(data[:, :, trial], config)
+    #Iterate over trials of the data.
+    #Calculate synchronization likelihood with the sl() funtion to each matrix
+    #of data.
+    tasks = ((data[:, :, trial], config) for trial in arange(0, trials, dtype=int))
+    for trial, trial_sl in enumerate(bounded_map(sl_task, tasks, n_jobs=n_jobs, executor=executor)):
+        sl_output[:, :, trial] = trial_sl
     #Return the average of the data.
     return sl_output
  
+def sl_task(task):
+    '''sl() over a (data, config) tuple, the unit of work of the parallel SL.'''
+    data, config = task
+    return sl(data, config)
+
 def sl(data, config):
     '''
     This function takes the input data and return the synchronization
@@ -210,11 +238,8 @@ def sl(data, config):
     num_iterations = int(floor((samples - time_delay * (dimensions - 1)) / 
                                SPEED) - ceil(1 / SPEED) + 1)
 
-    #calculate the synchronization likelihood matrix.
-    hit_matrix = synchronization(data,config, num_iterations, SPEED)    
-
-    #sum the hit matrix across time i, size (num_chan, num_chan).
-    s_k1_temp = npsum(hit_matrix, 2)
+    #calculate the hit matrix summed across time i, size (num_chan, num_chan).
+    s_k1_temp = synchronization(data,config, num_iterations, SPEED)
     #at a (k,l) position, s_kl_temp contains the number of hits occuring at both 
     #channels k & l,cover all i & j
     #at a (k,k) position, s_kl_temp contains the number of hits at channel k, 
@@ -232,11 +257,17 @@ def sl(data, config):
     
     return s_k1_matrix
 
-def synchronization(data, config, num_it, speed):
+def synchronization(data, config, num_it, speed, batch_size=None):
     '''
     This function takes the input data and calculate the synchronization
     likelihood. Continuation of sl() function.
 
+    All the reference points of a batch are processed at once: the distances to
+    every valid j are computed as arrays (invalid positions near the borders are
+    set to inf), epsilon is selected with np.partition and the hits are
+    accumulated as counts, so the (channels, channels, num_it) hit matrix is
+    never materialized.
+
     :param data: numpy array
         The input data file must contain M columns and N rows of numbers. These 
         numbers correspond to the N samples for each of the M channels.
@@ -250,16 +281,21 @@ def synchronization(data, config, num_it, speed):
         
         Default is: config = (4, 3, 16, 215, 0.05, "SL")
         
-    :param num_it: numpy array.
-        Is the number iterations.
+    :param num_it: int.
+        Is the number iterations (reference points).
 
     :param speed: int.
         It works as a third resolution window when calculating the synchronization
         likelihood.
+
+    :param batch_size: int, optional.
+        Number of reference points processed at once. Default keeps each batch
+        around 32 MB.
     
     :return: numpy array.
-        Numpy array with synchronization likelihood to the input data. The 
-        dimensions of de array are channels*channels. 
+        Numpy array with the number of hits occuring at both channels summed
+        over all the reference points. The dimensions of de array are
+        channels*channels. 
     '''
     #Get the size of the input matrix
     (samples, channels) = data.shape
@@ -271,70 +307,66 @@ def synchronization(data, config, num_it, speed):
     w2 = config[3]
     pref = config[4]
 
-    #Reserves the needed memory.
-    epsilon = ones((channels, 1), dtype=float64)
-    hit_matrix = zeros((channels, channels, num_it), dtype=float64)
-    counter = 0
-
-    #Get the range of iterations.
-    range = arange(1, (samples - time_delay*(dimensions - 1) + 1), dtype=int)
-    
-    for i in range:
-        if i % speed == 0 and i!=0:
-            #Calculate the vector of valid range positions
-            valid_range = logical_and(fabs(i - range) > w1,
-                                      fabs(i - range) < w2).astype(int)
-            num_validj = npsum(valid_range)#Number of valid range positions
-
-            #Construct compressed table of euclidean distances.
-            euclid_table = zeros((channels, num_validj), dtype = float64)
-            #Get positions where the valid range is 1.
-            valid_values = array(where(valid_range == 1))
-            #Get the size of the array valid_values
-            (row, col) = valid_values.shape
-            col_position = arange(0, col, dtype=int)
-            
-            row_data1 = array(time_delay * arange(0, dimensions, dtype=int)
-                              ) + (i - 1)
-            row_data2 = zeros((dimensions, col), dtype=int)
-            row_data2[:, :] = valid_values[:]
-            row_data2 = row_data2.transpose() + array(
-                time_delay * arange(0, dimensions, dtype=int))
-            k_values = arange(0, channels, dtype=int)
-            for k in k_values:
-                #euclid4 not explicity called; saves about 25% of time
-                euclid_table[k, col_position] = sqrt(sum(((data[
-                    row_data1, k]-data[row_data2, k]).transpose()) ** 2))
-
-            
-            #construct table of epsilons
-            #epsilon(k): the actual threshold distance such that the fraction
-            #of all distances |X_{k,i} - X_{k,j}| less than epsilon[k, i] is Pref
-            for k in k_values:
-                sorted_table = sort(euclid_table[k, :])                
-                epsilon[k] = sorted_table[(math_ceil(pref * num_validj) - 1)]
-            #construct 'hit' table, determine if
-            #|X_{k,i} - X_{k,j}| <= epsilon_x for each k & i. 
-            hit_table = (euclid_table <= (epsilon * 
-                                           ones(1, num_validj))).astype(int)
-            #Determine the number of hits occuring at both channels
-            hit_table = dot(hit_table, hit_table.transpose())
-            #store hit_table in a 3-D array
-            hit_matrix[:, :, counter] = hit_table
-            #Increase the counter.
-            counter += 1
-            
-    return hit_matrix
-
-
-
-def get_sl_1band(signal,fmin=None,fmax=None):
-    if fmin and fmax:
-        new_signal = signal.filter(fmin,fmax)
-    else:
-        new_signal = signal.copy()
-    data = new_signal.get_data()
+    #Number of embedding vectors, reference points are the multiples of speed.
+    num_vectors = samples - time_delay*(dimensions - 1)
+    references = arange(speed, num_vectors + 1, speed, dtype=int)[:num_it]
+    #Offsets j - i of the valid range positions.
+    span = arange(-int(ceil(w2)), int(ceil(w2)) + 1, dtype=int)
+    offsets = span[logical_and(fabs(span) > w1, fabs(span) < w2)]
+    num_offsets = len(offsets)
+    delays = time_delay * arange(0, dimensions, dtype=int)
+
+    if batch_size is None:
+        batch_size = max(1, int(2**22 // max(1, channels * num_offsets)))
+
+    #float32 data is processed in float32 (the counts are exact up to 2**24).
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    hits = zeros((channels, channels), dtype=dtype)
+    for start in range(0, len(references), batch_size):
+        #0-based positions of the reference and compared vectors.
+        t_i = references[start:start + batch_size] - 1
+        t_j = t_i[:, None] + offsets[None, :]
+        valid = logical_and(t_j >= 0, t_j < num_vectors)
+        t_j = np.clip(t_j, 0, num_vectors - 1)
+
+        #Euclidean distances (batch, num_offsets, channels), the squares are
+        #summed dimension by dimension as in the per-channel version.
+        euclid_table = None
+        for delay in delays:
+            diff = (data[t_i + delay, :][:, None, :] - data[t_j + delay, :]) ** 2
+            euclid_table = diff if euclid_table is None else euclid_table + diff
+        euclid_table = sqrt(euclid_table).transpose((0, 2, 1)) #batch, channels, offsets
+        euclid_table[~np.broadcast_to(valid[:, None, :], euclid_table.shape)] = np.inf
+
+        #epsilon(k): the actual threshold distance such that the fraction
+        #of all distances |X_{k,i} - X_{k,j}| less than epsilon[k, i] is Pref
+        num_validj = npsum(valid, 1)
+        kth = np.ceil(pref * num_validj).astype(int) - 1
+        epsilon = np.empty(euclid_table.shape[:2], dtype=euclid_table.dtype)
+        for k in np.unique(kth):
+            group = kth == k
+            epsilon[group] = np.partition(euclid_table[group], k, axis=2)[:, :, k]
+
+        #'hit' table, |X_{k,i} - X_{k,j}| <= epsilon_x, and the number of hits
+        #occuring at both channels accumulated over the reference points.
+        hit_table = (euclid_table <= epsilon[:, :, None]).transpose((1, 0, 2)).reshape(channels, -1)
+        hit_table = hit_table.astype(dtype)
+        hits += dot(hit_table, hit_table.transpose())
+    return hits
+
+
+
+def get_sl_1band(signal,fmin=None,fmax=None,data=None):
+    '''
+    Synchronization likelihood of a mne.Epochs in a band, signal is not modified.
+    data: band-limited data (epochs, spaces, times) of signal if it was already filtered.
+    '''
+    if data is None:
+        if fmin and fmax:
+            data = signal.copy().filter(fmin,fmax).get_data()
+        else:
+            data = signal.get_data()
     new_data = np.transpose(data.copy(),(1,2,0))
     _verify_epochs_axes(data,new_data)
-    sl = get_sl(new_data, new_signal.info['sfreq'])
+    sl = get_sl(new_data, signal.info['sfreq'])
     return sl
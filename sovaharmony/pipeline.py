@@ -5,10 +5,11 @@ from sovaharmony.data_structure.getDataframes import get_dataframe_wica
 from sovaharmony.data_structure.getDataframes import get_dataframe_reject
 from sovaharmony.data_structure.query_derivatives import get_dataframe_columnsIC
 from sovaharmony.data_structure.query_derivatives import get_dataframe_columnsROI
+from sovaharmony.layout import get_layout
 from sovaharmony.utils import * 
 import time 
 
-def pipeline (THE_DATASETS=list,portables=False, prepdf=False,propdf=False,spatial_matrix=list,metrics=list,IC=False, Sensors=False,OVERWRITE= False,bands=dict):
+def pipeline (THE_DATASETS=list,portables=False, prepdf=False,propdf=False,spatial_matrix=list,metrics=list,IC=False, Sensors=False,OVERWRITE= False,bands=dict,n_jobs=1,fused=False,derivative_format='.txt',dtype=None):
     '''
     
     Input
@@ -22,12 +23,21 @@ def pipeline (THE_DATASETS=list,portables=False, prepdf=False,propdf=False,spati
             ['cohfreq','entropy','power','sl','crossfreq','osc','irasa']
         - IC: boolean 
         - Sensors: boolean
+        - n_jobs: int
+            Number of worker processes used by the preprocessing (harmonize), -1 for all the cores
+        - fused: boolean
+            Hand the in-memory signals between the preprocessing stages (see harmonize)
+        - derivative_format: str
+            '.txt' or '.npz', format of the features written by postprocessing.features
+        - dtype: numpy dtype
+            Precision of the features, e.g. np.float32 (def None, float64)
     '''
     for dataset in THE_DATASETS:
         path=dataset['input_path']+'/derivatives'
+        layout = get_layout(dataset['input_path']) # indexed once and shared by all the stages
         ## Preprocessing pipeline
         start = time.perf_counter()
-        process=harmonize(dataset,fast_mode=False)
+        process=harmonize(dataset,fast_mode=False,n_jobs=n_jobs,fused=fused,layout=layout)
         final = time.perf_counter()
         print('TIME PREPROCESSING:::::::::::::::::::'+ dataset['input_path']+ dataset['layout']['task'], final-start)
 
@@ -36,11 +46,11 @@ def pipeline (THE_DATASETS=list,portables=False, prepdf=False,propdf=False,spati
             montages_portatil=['openBCI','paper','cresta']
             for tmontage in montages_portatil:
                 start = time.perf_counter()
-                features(dataset,def_spatial_filter='54x10',portables=portables,montage_select=tmontage,OVERWRITE = OVERWRITE,bands=bands)
+                features(dataset,def_spatial_filter='54x10',portables=portables,montage_select=tmontage,OVERWRITE = OVERWRITE,bands=bands,layout=layout,derivative_format=derivative_format,dtype=dtype)
                 final = time.perf_counter()
                 print('TIME POSTPROCESSING:::::::::::::::::::'+ dataset['input_path']+ dataset['layout']['task'], final-start)
         else:
-            features(dataset,def_spatial_filter='58x25',portables=portables,montage_select=None,OVERWRITE = OVERWRITE,bands=bands)
+            features(dataset,def_spatial_filter='58x25',portables=portables,montage_select=None,OVERWRITE = OVERWRITE,bands=bands,layout=layout,derivative_format=derivative_format,dtype=dtype)
         
         if prepdf:
             ## Preprocessing dataframes 
@@ -51,16 +61,17 @@ def pipeline (THE_DATASETS=list,portables=False, prepdf=False,propdf=False,spati
             final = time.perf_counter()
 
         if propdf:
+            layout_derivatives = get_layout(dataset['input_path'],derivatives=True,refresh=True) # the features were just written
             for m in metrics:
                 for j in spatial_matrix:
                     if IC: 
                         start = time.perf_counter()
-                        data_IC=get_dataframe_columnsIC(dataset,feature=i,spatial_matrix=j ,norm='False')
+                        data_IC=get_dataframe_columnsIC(dataset,feature=i,spatial_matrix=j ,norm='False',layout=layout_derivatives)
                         final = time.perf_counter()
                         print('TIME FEATHER IC:::::::::::::::::::'+ dataset['input_path']+ m + dataset['layout']['task'], final-start)
                     if Sensors:
                         start = time.perf_counter()
-                        data_ROI=get_dataframe_columnsROI(dataset,feature=i)
+                        data_ROI=get_dataframe_columnsROI(dataset,feature=i,layout=layout_derivatives)
                         final = time.perf_counter()
                         print('TIME FEATHER ROI:::::::::::::::::::'+ dataset['input_path']+ m + dataset['layout']['task'], final-start)
                    
@@ -1,15 +1,25 @@
 import mne
 import os
+import numpy as np
 from sovaflow.utils import cfg_logger
-from sovaharmony.preprocessing import get_derivative_path
-from sovaharmony.preprocessing import write_json
-from bids import BIDSLayout
-from sovaharmony.metrics.features import get_derivative
+from sovaharmony.preprocessing import get_derivative_path,fif_path
+from sovaharmony.preprocessing import write_json,DERIVATIVE_WRITERS
+from sovaharmony.layout import get_layout
+from sovaharmony.utils import load_txt
+from sovaharmony.metrics.features import project_signal,compute_derivative,FEATURE_VERSIONS
+from sovaharmony.metrics.bands import BandCache
 from sovaharmony.spatial import get_spatial_filter
+from sovaharmony.manifest import RunManifest,hash_config
+from sovaharmony.data_structure.feature_store import FeatureStore
+from sovaharmony.data_structure.query_derivatives import derivative_row
 import time
 import traceback
 
-def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_select=None,OVERWRITE = False,bands=dict):
+# Arguments of the features that only change how they are scheduled, not their values,
+# they are left out of the configuration hash of the manifest
+SCHEDULING_KWARGS = ('n_jobs','executor','chunk_size')
+
+def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_select=None,OVERWRITE = False,bands=dict,layout=None,band_cache_dir=None,derivative_format='.txt',feature_store=False,dtype=None):
     '''
      - THE_DATASET
      - def_spatial_filter: str
@@ -17,7 +27,31 @@ def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_sel
      - montage_select: str
      - OVERWRITE: boolean
         Ojo con esta variable, es para obligar a sobreescribir los archivos en general deberia estar en False
+     - layout: BIDSLayout
+        Layout of the dataset, if None it is obtained with sovaharmony.layout.get_layout (cached)
+     - band_cache_dir: str
+        Folder to memory-map the band-filtered signals shared by sl, entropy and crossfreq,
+        if None they are kept in memory (see sovaharmony.metrics.bands.BandCache)
+     - derivative_format: str
+        '.txt' (indented json) or '.npz' (numpy arrays, see preprocessing.write_npz),
+        both are read by sovaharmony.utils.load_txt
+     - feature_store: boolean
+        Append the row of each derivative to the feature store as it is written, the touched
+        partitions are compacted at the end (see sovaharmony.data_structure.feature_store).
+        A failure of the store is logged but does not mark the derivative as failed.
+     - dtype: numpy dtype
+        Precision of the features (e.g. np.float32), None for float64
+        (see sovaharmony.metrics.features.compute_derivative)
+
+    Features already computed with the same input and configuration are skipped
+    according to the run manifest (see sovaharmony.manifest), derivatives written before the
+    manifest existed are adopted if they can be read, unless the values of the feature changed
+    since (see metrics.features.FEATURE_VERSIONS). Each file is read once,
+    projected once per spatial filter and shared by all the features of features_tuples.
     '''
+    if derivative_format not in DERIVATIVE_WRITERS:
+        raise ValueError(f'Unknown derivative format {derivative_format}')
+    write_derivative = DERIVATIVE_WRITERS[derivative_format]
     
     if THE_DATASET.get('spatial_filter',def_spatial_filter):
         spatial_filter = get_spatial_filter(THE_DATASET.get('spatial_filter',def_spatial_filter),portables=portables,montage_select=montage_select)
@@ -27,7 +61,8 @@ def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_sel
     archivosconerror = []
     # Static Params
     pipelabel = '['+THE_DATASET.get('run-label', '')+']'
-    layout = BIDSLayout(input_path)
+    if layout is None:
+        layout = get_layout(input_path)
     bids_root = layout.root
     eegs = layout.get(**layout_dict)
     pipeline = 'sovaharmony'
@@ -35,6 +70,10 @@ def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_sel
     log_path = os.path.join(derivatives_root,'code')
     os.makedirs(log_path, exist_ok=True)
     logger,currentdt = cfg_logger(log_path)
+    manifest = RunManifest(derivatives_root,bids_root)
+    band_cache = BandCache(memmap_dir=band_cache_dir)
+    store = FeatureStore(bids_root) if feature_store else None
+    touched = set() # partitions of the store with new part files
     desc_pipeline = "sovaharmony, a harmonization eeg pipeline using the bids standard"
     num_files = len(eegs)
     for i,eeg_file in enumerate(eegs):
@@ -49,57 +88,111 @@ def features(THE_DATASET, def_spatial_filter='54x10',portables=False,montage_sel
         #('absPower',{'bands':bands,'normalize':False})
         features_tuples=[
             #('power',{'bands':bands,'irasa':False}),
+            #('power',{'bands':bands,'irasa':False,'multitaper':True}), # all spaces at once, see metrics.multitaper
             ('power_osc',{'bands':bands,'irasa':True,'descomposition':True}),
             #('sl',{'bands':bands}),
             #('cohfreq',{'window':3,'bands':bands}),
             #('entropy',{'bands':bands,'D':3}),
+            #('entropy_wpe',{'bands':bands,'D':3}),
+            #('entropy_complexity',{'bands':bands,'D':3}),
             #('crossfreq',{'bands':bands}),
         ]
         times_strings = []
-        for feature,kwargs in features_tuples:
-            try:
-                #for sf in [None]: #Channels
-                #for sf in [None, spatial_filter]: # Channels and Components
-                for sf in [spatial_filter]: # Only components
-                    #for norm_ in [True,False]: # Only with huber and without huber
-                    for norm_ in [False]: # Only without huber
-                        if sf is not None:
-                            sf_label = f'ics[{spatial_filter["name"]}]'
-                        else:
-                            sf_label = 'sensors'
-                        print(norm_)
-                        feature_suffix = f'space-{sf_label}_norm-{norm_}_{feature}'
-                        feature_path = get_derivative_path(layout,eeg_file,pipelabel,feature_suffix,'.txt',bids_root,derivatives_root)
+        #for norm_ in [True,False]: # Only with huber and without huber
+        for norm_ in [False]: # Only without huber
+            input_stage,signal_path = ('huber'+pipelabel,norm_path) if norm_ else ('reject'+pipelabel,reject_path)
+            signal = None # each file is read once and shared by every spatial filter and feature
+            #for sf in [None]: #Channels
+            #for sf in [None, spatial_filter]: # Channels and Components
+            for sf in [spatial_filter]: # Only components
+                if sf is not None:
+                    sf_label = f'ics[{spatial_filter["name"]}]'
+                else:
+                    sf_label = 'sensors'
+                pending = []
+                for feature,kwargs in features_tuples:
+                    feature_suffix = f'space-{sf_label}_norm-{norm_}_{feature}'
+                    feature_path = get_derivative_path(layout,eeg_file,pipelabel,feature_suffix,derivative_format,bids_root,derivatives_root)
+                    try:
                         os.makedirs(os.path.split(feature_path)[0], exist_ok=True)
-
-                        if OVERWRITE or not os.path.isfile(feature_path):
-                            if norm_:
-                                signal = mne.read_epochs(norm_path)
-                            else:
-                                signal = mne.read_epochs(reject_path)
-                            start = time.perf_counter()
-                            val_dict = get_derivative(signal,feature=feature,kwargs=kwargs,spatial_filter=sf,portables=portables)
-                            final = time.perf_counter()
-                            tstring = f'TIME {feature_suffix}:::::::::::::::::::{final-start}'
-                            times_strings.append(tstring)
-                            logger.info(tstring)
-                            print(tstring)
-                            write_json(val_dict,feature_path)
-                            write_json(json_dict,feature_path.replace('.txt','.json'))
+                        feature_input = manifest.output_hash(input_stage,eeg_file)
+                        if feature_input is None: # derivative not produced through the manifest
+                            feature_input = manifest.file_hash(fif_path(signal_path))
+                        version = FEATURE_VERSIONS.get(feature,1)
+                        feature_config = hash_config(feature,{k:v for k,v in kwargs.items() if k not in SCHEDULING_KWARGS},sf_label,portables,montage_select,*(() if dtype is None else (np.dtype(dtype).name,)),*(() if version == 1 else (f'v{version}',)))
+                        adoptable = feature_path if version == 1 else None # the files without record have the values of version 1
+                        if OVERWRITE or not manifest.is_done(feature_suffix+pipelabel,eeg_file,feature_input,feature_config,adoptable,load_txt):
+                            pending.append((feature,kwargs,feature_suffix,feature_path,feature_input,feature_config))
                         else:
                             msg = f'{feature_path}) already existed, skipping...'
                             logger.info(msg)
                             print(msg)
-            except Exception as error:
-                e+=1
-                logger.exception(f'Error for {eeg_file}-{feature_path}')
-                archivosconerror.append((eeg_file,feature_path))
-                print(error)
-                print(traceback.format_exc())
-                logger.exception(error)
-                logger.exception(traceback.format_exc())
-                pass
+                    except Exception as error:
+                        e+=1
+                        logger.exception(f'Error for {eeg_file}-{feature_path}')
+                        archivosconerror.append((eeg_file,feature_path))
+                        print(error)
+                        print(traceback.format_exc())
+                if not pending:
+                    continue
+                try:
+                    if signal is None:
+                        signal = mne.read_epochs(fif_path(signal_path))
+                    start = time.perf_counter()
+                    projected,space = project_signal(signal,spatial_filter=sf,portables=portables)
+                    final = time.perf_counter()
+                    tstring = f'TIME space-{sf_label}_norm-{norm_} projection:::::::::::::::::::{final-start}'
+                    times_strings.append(tstring)
+                    logger.info(tstring)
+                except Exception as error:
+                    e+=len(pending)
+                    logger.exception(f'Error for {eeg_file}-{signal_path}')
+                    archivosconerror += [(eeg_file,x[3]) for x in pending]
+                    print(error)
+                    print(traceback.format_exc())
+                    continue
+                for feature,kwargs,feature_suffix,feature_path,feature_input,feature_config in pending:
+                    try:
+                        print(norm_)
+                        start = time.perf_counter()
+                        val_dict = compute_derivative(projected,feature,kwargs,space,band_cache=band_cache.scope(signal_path,sf_label),dtype=dtype)
+                        final = time.perf_counter()
+                        tstring = f'TIME {feature_suffix}:::::::::::::::::::{final-start}'
+                        times_strings.append(tstring)
+                        logger.info(tstring)
+                        print(tstring)
+                        write_derivative(val_dict,feature_path)
+                        write_json(json_dict,os.path.splitext(feature_path)[0]+'.json')
+                        manifest.record(feature_suffix+pipelabel,eeg_file,feature_input,feature_config,feature_path,final-start)
+                    except Exception as error:
+                        e+=1
+                        logger.exception(f'Error for {eeg_file}-{feature_path}')
+                        archivosconerror.append((eeg_file,feature_path))
+                        print(error)
+                        print(traceback.format_exc())
+                        logger.exception(error)
+                        logger.exception(traceback.format_exc())
+                        continue
+                    if store is not None:
+                        try:
+                            row = derivative_row(val_dict,feature_path,feature,THE_DATASET.get('group_regex',None),None if sf is None else sf['name'])
+                            partition = (THE_DATASET.get('name',None),layout_dict.get('task',None),feature,sf_label)
+                            store.append(row,*partition,norm_,feature_path)
+                            touched.add(partition)
+                        except Exception as error: # the derivative is written and recorded, only its row is missing from the store
+                            logger.exception(f'Error appending {feature_path} to the feature store')
+                            print(error)
+                del projected
+            del signal
+        band_cache.clear() # the bands of a file are not used by the next ones
         [print(x) for x in times_strings]
         [logger.info(x) for x in times_strings]
+    manifest.close()
+    for partition in sorted(touched,key=str):
+        try:
+            store.compact(*partition)
+        except Exception as error:
+            logger.exception(f'Error compacting the feature store partition {partition}')
+            print(error)
     return
 
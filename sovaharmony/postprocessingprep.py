@@ -1,7 +1,7 @@
 from sovaflow.utils import cfg_logger
 from sovaharmony.preprocessing import get_derivative_path
 from sovaharmony.preprocessing import write_json
-from bids import BIDSLayout
+from sovaharmony.layout import get_layout
 import mne
 import os
 from sovaharmony.metrics.features import get_derivative
@@ -14,7 +14,7 @@ import numpy as np
 from sovareject.tools import format_data
 OVERWRITE = False # Ojo con esta variable, es para obligar a sobreescribir los archivos
 # en general deberia estar en False
-def features(THE_DATASET):
+def features(THE_DATASET,layout=None):
     # Inputs not dataset dependent
     def_spatial_filter='54x10'
     bands ={'delta':(1.5,6),
@@ -33,7 +33,8 @@ def features(THE_DATASET):
     archivosconerror = []
     # Static Params
     pipelabel = '['+THE_DATASET.get('run-label', '')+']'
-    layout = BIDSLayout(input_path)
+    if layout is None:
+        layout = get_layout(input_path)
     bids_root = layout.root
     eegs = layout.get(**layout_dict)
     pipeline = 'sovaharmony'
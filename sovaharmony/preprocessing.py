@@ -5,12 +5,16 @@ from sovaViolin.functions_postprocessing_channels import compare_nD_power
 import mne
 import json
 import os
-from bids import BIDSLayout
+import glob
+import shutil
+import tempfile
+from sovaharmony.layout import get_layout
 from bids.layout import parse_file_entities
 from datetime import datetime
 import numpy as np
 import pandas as pd
 from sovaharmony.info import info as info_dict
+from sovaharmony.manifest import RunManifest,hash_config
 import statsmodels.api as sm
 import pandas as pd
 from astropy.stats import mad_std
@@ -19,6 +23,11 @@ from matplotlib import pyplot as plt
 import numpy as np
 from sovaflow.utils import createRaw
 from scipy import stats as st
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+import multiprocessing
+import logging
+import logging.handlers
+import time
 
 
 def get_derivative_path(layout,eeg_file,output_entity,suffix,output_extension,bids_root,derivatives_root):
@@ -39,16 +48,334 @@ def default(obj):
             return obj.item()
     raise TypeError('Unknown type:', type(obj))
 
+def _tmp_path(filepath):
+    """Temporary sibling of filepath, unique per process and keeping the original suffix."""
+    folder,fname = os.path.split(filepath)
+    return os.path.join(folder,f'.tmp{os.getpid()}_{fname}')
+
 def write_json(data,filepath,mode=None):
     if mode=='a':
         with open(filepath, 'a') as fp:
             json.dump(data, fp,indent=4,default=default)
     else:
-        with open(filepath, 'w') as fp:
+        tmp_path = _tmp_path(filepath)
+        with open(tmp_path, 'w') as fp:
             json.dump(data, fp,indent=4,default=default)
+        os.replace(tmp_path,filepath)
+
+def write_npz(data,filepath):
+    """Write a derivative dict (metadata, values...) as .npz atomically.
+
+    Numeric entries are stored as arrays, any other entry (metadata, fit_params) as a
+    json string, so utils.load_txt gives back the same schema as with write_json.
+    """
+    arrays = {}
+    for key,value in data.items():
+        try:
+            array = np.asarray(value)
+        except ValueError: # ragged lists
+            array = None
+        if array is not None and array.dtype.kind in 'biufc':
+            arrays[key] = array
+        else:
+            arrays[key] = np.array(json.dumps(value,default=default))
+    tmp_path = _tmp_path(filepath)
+    with open(tmp_path, 'wb') as fp:
+        np.savez(fp,**arrays)
+    os.replace(tmp_path,filepath)
+
+DERIVATIVE_WRITERS = {'.txt':write_json,'.npz':write_npz}
+
+def _split_name(filepath,part='01'):
+    """Name given by mne to a part of a split fif (split_naming='bids'), part can be a glob pattern."""
+    folder,name = os.path.split(filepath)
+    root,ext = os.path.splitext(name)
+    base,suffix = root.rsplit('_',1)
+    return os.path.join(folder,f'{base}_split-{part}_{suffix}{ext}')
+
+def fif_path(filepath):
+    """Path to read a fif derivative: filepath, or its first part if mne split it (above 2 GB)."""
+    if not os.path.isfile(filepath) and os.path.isfile(_split_name(filepath)):
+        return _split_name(filepath)
+    return filepath
+
+def save_fif(signal,filepath):
+    """Save a mne object atomically, returns the path of the (first) file written.
+
+    The object is written to a temporary folder next to filepath and its files are then moved,
+    so a crash or a parallel worker never leaves a half-written .fif at filepath. Above 2 GB mne
+    splits the file (split_naming='bids'): the parts keep the names that link them, the first one
+    is returned (see fif_path) and the files left by a previous save of the other layout are removed.
+    """
+    folder,name = os.path.split(filepath)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp',dir=folder or '.')
+    try:
+        signal.save(os.path.join(tmp_dir,name),split_naming='bids',overwrite=True)
+        written = sorted(os.listdir(tmp_dir))
+        for fname in written:
+            os.replace(os.path.join(tmp_dir,fname),os.path.join(folder,fname))
+        previous = [filepath] + glob.glob(glob.escape(_split_name(filepath,'SPLIT')).replace('SPLIT','[0-9]*'))
+        for path in previous:
+            if os.path.basename(path) not in written and os.path.isfile(path):
+                os.remove(path)
+    finally:
+        shutil.rmtree(tmp_dir,ignore_errors=True)
+    return os.path.join(folder,written[0])
+
+def huber_scale(signal,h_freq=20,float32=False,chunk_size=2**24):
+    """Huber scale of an mne.Epochs object, used to normalize the eeg amplitude.
+
+    The epochs are low-passed (without modifying signal), the robust std (mad_std) of each
+    channel is computed over all of its epochs and the Huber location of those stds is returned.
+
+    signal: mne.Epochs, preloaded
+    h_freq: low-pass frequency applied before computing the stds (def 20)
+    float32: keep the low-passed copy in single precision, halving its memory
+    chunk_size: approximate number of float64 samples filtered at once
+
+    The low-pass is mne.filter.filter_data with pad='edge', the padding of mne.Epochs.filter
+    used before (signal.copy().filter(None,h_freq,fir_design='firwin')), so the scale is the same
+    for eeg-only epochs. Unlike Epochs.filter every channel of signal._data is filtered.
+    mne only filters float64, so the channels are filtered a few at a time and written into the
+    (channels, epochs*times) copy, the float64 data of only one group is alive besides it.
+    """
+    epochs,channels,times = signal._data.shape
+    data_cont = np.empty((channels,epochs*times),dtype=np.float32 if float32 else np.float64) # as np.concatenate(data_lp,axis=-1)
+    step = max(1,chunk_size//(epochs*times))
+    for start in range(0,channels,step):
+        data_lp = mne.filter.filter_data(signal._data[:,start:start+step],signal.info['sfreq'],None,h_freq,fir_design='firwin',pad='edge',verbose=False)
+        data_cont[start:start+step] = data_lp.transpose(1,0,2).reshape(-1,epochs*times)
+        del data_lp
+    std_ch = mad_std(data_cont,axis=1)
+    huber = sm.robust.scale.Huber() 
+    k = huber(np.asarray(std_ch,dtype=np.float64))[0] # o np.median(np.array(std_ch)) o np.mean(np.array(std_ch))
+    return k
+
+def huber_normalize(signal,h_freq=20,float32=False):
+    """Divide in place an mne.Epochs object by its Huber scale (see huber_scale), returns the signal and the scale."""
+    k = huber_scale(signal,h_freq=h_freq,float32=float32)
+    signal._data /= k
+    return signal,k
+
+def _persist(persister,signal,path,jsons):
+    """Write a fif derivative and its json files, in the background if a persister executor is given.
+
+    Returns the future of the write, or None if it was written synchronously.
+    """
+    def write():
+        save_fif(signal,path)
+        for data,json_path in jsons:
+            write_json(data,json_path)
+    if persister is None:
+        write()
+        return None
+    return persister.submit(write)
 
+def _record_pending(manifest,eeg_file,pending):
+    """Wait for the pending writes of a file and register them in the manifest, in stage order."""
+    for future,stage,input_hash,upstream,config_hash,path,duration in pending:
+        if future is not None:
+            future.result()
+        if input_hash is None:
+            input_hash = manifest.output_hash(upstream,eeg_file)
+        manifest.record(stage,eeg_file,input_hash,config_hash,fif_path(path),duration)
 
-def harmonize(THE_DATASET,fast_mode=False):
+def _read_raw(path):
+    """Header read of a fif Raw, used to check that a derivative without record can be adopted by the manifest."""
+    return mne.io.read_raw(fif_path(path),preload=False,verbose=False)
+
+def _read_epochs(path):
+    """Header read of a fif Epochs, used to check that a derivative without record can be adopted by the manifest."""
+    return mne.read_epochs(fif_path(path),preload=False,verbose=False)
+
+def _harmonize_file(eeg_file,paths,THE_DATASET,channels,fast_mode,bids_root,manifest,logger,fused=False):
+    """Run the preprocessing stages (prep/wica, reject and huber) over a single eeg file.
+
+    Whether a stage is skipped is decided by the run manifest: the stage must have been
+    recorded with the same input hash and configuration hash. Derivatives written before
+    the manifest existed are adopted if they can be read. Once a stage is recomputed
+    all the following ones are recomputed too.
+
+    With fused=True the Raw/Epochs produced by a stage are handed in memory to the next one,
+    the derivatives are written by a background thread and are not read back from disk.
+    Normalization does not wait for the reject write: while it is running the huber stage
+    divides a copy of the epochs and the original ones are freed when the write finishes.
+    """
+    pipelabel = '['+THE_DATASET.get('run-label', '')+']'
+    desc_pipeline = "sovaharmony, a harmonization eeg pipeline using the bids standard"
+    wica_path = paths['wica']
+    prep_path = paths['prep']
+    stats_path = paths['stats']
+    power_path = paths['power']
+    huber_path = paths['huber']
+    reject_path = paths['reject']
+    os.makedirs(os.path.split(power_path)[0], exist_ok=True)
+
+    json_dict = {"Description":desc_pipeline,"RawSources":[eeg_file.replace(bids_root,'')],"Configuration":THE_DATASET}
+    json_dict["Sources"]=wica_path.replace(bids_root,'')
+
+    persister = ThreadPoolExecutor(max_workers=1) if fused else None
+    pending = [] # (future,stage,input_hash,upstream stage,config_hash,output path,duration)
+    recomputed = False
+    wica_signal = None
+    reject_signal = None
+    reject_future = None
+    try:
+        prep_input = manifest.file_hash(eeg_file)
+        prep_config = hash_config(THE_DATASET.get('args',{}),channels,fast_mode)
+        if manifest.is_done('prep',eeg_file,prep_input,prep_config,fif_path(prep_path),_read_raw) and manifest.is_done('wica',eeg_file,prep_input,prep_config,fif_path(wica_path),_read_raw):
+            logger.info(f'{prep_path} and {wica_path} already existed, skipping...')
+        else:
+            start = time.perf_counter()
+            raw = mne.io.read_raw(eeg_file,preload=True)
+            signal,prep_signal,stats=preflow(raw,correct_montage=channels,fast_mode=fast_mode,**THE_DATASET.get('args',{}))
+            
+            del raw
+            
+            prep_future = _persist(persister,prep_signal,prep_path,[
+                (json_dict,prep_path.replace('.fif','.json')),
+                (json_dict,stats_path.replace('label','prep').replace('.txt','.json')),
+                (stats.get('prep',{}),stats_path.replace('label','prep'))])
+            del prep_signal
+            
+            wica_future = _persist(persister,signal,wica_path,[
+                (json_dict,wica_path.replace('.fif','.json')),
+                (json_dict,stats_path.replace('label','wica').replace('.txt','.json')),
+                (stats.get('wica',{}),stats_path.replace('label','wica'))])
+            duration = time.perf_counter()-start
+            pending.append((prep_future,'prep',prep_input,None,prep_config,prep_path,duration))
+            pending.append((wica_future,'wica',prep_input,None,prep_config,wica_path,duration))
+            recomputed = True
+            if fused:
+                wica_signal = signal.copy() # the object being written must not be modified by the next stages
+            del signal
+        
+
+        if THE_DATASET.get('events_to_keep', None) is not None:
+            events_file = os.path.splitext(eeg_file)[0].replace('_eeg','_events.tsv')
+            events_raw=pd.read_csv(events_file,sep='\t')
+            samples = events_raw['sample'].tolist()
+            values = events_raw['value'].tolist()
+            events = list(zip(values,samples))
+            events_to_keep = THE_DATASET.get('events_to_keep', None)
+        else:
+            events = None
+            events_to_keep = None
+
+        reject_config = hash_config(THE_DATASET.get('epoch_length', 5),events_to_keep)
+        if not recomputed and manifest.is_done('reject'+pipelabel,eeg_file,manifest.output_hash('wica',eeg_file),reject_config,fif_path(reject_path),_read_epochs):    
+            logger.info(f'{reject_path} already existed, skipping...')
+        else:
+            start = time.perf_counter()
+            if wica_signal is not None:
+                signal = wica_signal
+                wica_signal = None
+            else:
+                signal = mne.io.read_raw(fif_path(wica_path),preload=True)
+            signal = crop_raw_data(signal,events, events_to_keep)
+            signal,reject_info = run_reject(signal, THE_DATASET.get('epoch_length', 5))
+            reject_future = _persist(persister,signal,reject_path,[
+                (json_dict,reject_path.replace('.fif','.json')),
+                (json_dict,stats_path.replace('label','reject'+pipelabel).replace('.txt','.json')),
+                (reject_info,stats_path.replace('label','reject'+pipelabel))])
+            pending.append((reject_future,'reject'+pipelabel,None,'wica',reject_config,reject_path,time.perf_counter()-start))
+            recomputed = True
+            if fused:
+                reject_signal = signal
+            del signal
+        
+        huber_config = hash_config('huber',20,False)
+        if not recomputed and manifest.is_done('huber'+pipelabel,eeg_file,manifest.output_hash('reject'+pipelabel,eeg_file),huber_config,fif_path(huber_path),_read_epochs):
+            logger.info(f'{huber_path}) already existed, skipping...')
+        else: 
+            start = time.perf_counter()
+            if reject_signal is not None:
+                signal = reject_signal
+                reject_signal = None
+            else:
+                signal = mne.read_epochs(fif_path(reject_path))
+            k = huber_scale(signal)
+            if reject_future is not None and not reject_future.done():
+                # the reject epochs are still being written, the huber epochs are divided over their own copy
+                signal = signal.copy()
+            signal._data /= k
+           
+            huber_future = _persist(persister,signal,huber_path,[(json_dict,huber_path.replace('.fif','.json'))])
+            pending.append((huber_future,'huber'+pipelabel,None,'reject'+pipelabel,huber_config,huber_path,time.perf_counter()-start))
+    finally:
+        # Everything that was produced is registered, even if a later stage failed
+        try:
+            _record_pending(manifest,eeg_file,pending)
+        finally:
+            if persister is not None:
+                persister.shutdown(wait=True)
+
+_WORKER_LOGGER = 'sovaharmony.worker'
+
+_THREAD_VARS = ['OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS','NUMEXPR_NUM_THREADS','VECLIB_MAXIMUM_THREADS']
+
+def _init_worker(queue,threads=1):
+    """Route the log records of a worker process to the queue listened by the main process
+    and cap its BLAS/OpenMP threads, so n_jobs workers do not oversubscribe the cores.
+
+    The environment variables only reach the libraries loaded after them, the pools already
+    loaded (numpy, scipy) are limited with threadpoolctl when it is installed.
+    """
+    for var in _THREAD_VARS:
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        threadpool_limits(threads)
+    logger = logging.getLogger(_WORKER_LOGGER)
+    logger.handlers = [logging.handlers.QueueHandler(queue)]
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+def _run_tasks(worker,tasks,n_jobs,logger):
+    """Apply worker(task,logger) to each task, serially or over n_jobs processes. Returns the results in order.
+
+    Workers log through a queue, a listener in this process writes to the handlers of logger (the cfg_logger file).
+    Each worker gets cpu_count//n_jobs BLAS/OpenMP threads (see _init_worker).
+    """
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if not n_jobs or n_jobs == 1 or len(tasks) < 2:
+        return [worker(task,logger) for task in tasks]
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    handlers = logger.handlers or logging.getLogger().handlers
+    listener = logging.handlers.QueueListener(queue,*handlers,respect_handler_level=True)
+    listener.start()
+    workers = min(n_jobs,len(tasks))
+    threads = max(1,(os.cpu_count() or 1)//workers)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,initargs=(queue,threads)) as executor:
+            return list(executor.map(worker,tasks))
+    finally:
+        listener.stop()
+        manager.shutdown()
+
+def _harmonize_worker(task,logger=None):
+    """Process one file catching its errors, returns the file path if it failed, else None."""
+    i,num_files,eeg_file,paths,THE_DATASET,channels,fast_mode,fused,bids_root,derivatives_root = task
+    if logger is None:
+        logger = logging.getLogger(_WORKER_LOGGER)
+    manifest = RunManifest(derivatives_root,bids_root)
+    try:
+        logger.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {eeg_file}")
+        _harmonize_file(eeg_file,paths,THE_DATASET,channels,fast_mode,bids_root,manifest,logger,fused=fused)
+    except Exception as error:
+        logger.exception(f'Error for {eeg_file}')
+        print(error)
+        return eeg_file
+    finally:
+        manifest.close()
+    return None
+
+def harmonize(THE_DATASET,fast_mode=False,n_jobs=1,fused=False,layout=None):
     """Process a single bids dataset.
     
     Inputs:
@@ -67,6 +394,15 @@ def harmonize(THE_DATASET,fast_mode=False):
     'H_FREQ' : low-pass frequency (def 50)
     'epoch_length': length of epoching in seconds (def 5)
     }
+
+    fast_mode: bool, passed to sovaflow.preflow
+    n_jobs: int, number of worker processes used to spread the files (def 1, serial). -1 uses all the cores.
+    fused: bool, pass the in-memory Raw/Epochs from one stage to the next instead of reading back the
+        derivatives, which are then written in the background (def False).
+    layout: BIDSLayout of the dataset, if None it is obtained with sovaharmony.layout.get_layout (cached)
+
+    The stages already computed are skipped according to the run manifest in derivatives/sovaharmony/code
+    (see sovaharmony.manifest), they are recomputed if their input or their configuration changed.
     
     Example:
     THE_DATASET = {
@@ -96,7 +432,8 @@ def harmonize(THE_DATASET,fast_mode=False):
     # Static Params
     pipeline = 'sovaharmony'
     pipelabel = '['+THE_DATASET.get('run-label', '')+']'
-    layout = BIDSLayout(input_path)
+    if layout is None:
+        layout = get_layout(input_path)
     bids_root = layout.root
     output_path = os.path.join(bids_root,'derivatives',pipeline)
 
@@ -106,103 +443,89 @@ def harmonize(THE_DATASET,fast_mode=False):
     log_path = os.path.join(derivatives_root,'code')
     os.makedirs(log_path, exist_ok=True)
     logger,currentdt = cfg_logger(log_path)
-    e = 0
-    archivosconerror = []
     description = layout.get_dataset_description()
-    desc_pipeline = "sovaharmony, a harmonization eeg pipeline using the bids standard"
     description['GeneratedBy']=[info_dict]
     write_json(description,os.path.join(derivatives_root,'dataset_description.json'))
     num_files = len(eegs)
+    tasks = []
     for i,eeg_file in enumerate(eegs):
-        #process=str(i)+'/'+str(num_files)
-        try:
-            logger.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {eeg_file}")
+        paths = {
+            'wica':get_derivative_path(layout,eeg_file,'wica','eeg','.fif',bids_root,derivatives_root),
+            'prep':get_derivative_path(layout,eeg_file,'prep','eeg','.fif',bids_root,derivatives_root),
+            'stats':get_derivative_path(layout,eeg_file,'label','stats','.txt',bids_root,derivatives_root),
+            'power':get_derivative_path(layout,eeg_file,'channel'+pipelabel,'powers','.txt',bids_root,derivatives_root),
+            'huber':get_derivative_path(layout,eeg_file,'huber'+pipelabel,'eeg','.fif',bids_root,derivatives_root),
+            'reject':get_derivative_path(layout,eeg_file,'reject'+pipelabel,'eeg','.fif',bids_root,derivatives_root),
+        }
+        tasks.append((i,num_files,eeg_file,paths,THE_DATASET,channels,fast_mode,fused,bids_root,derivatives_root))
 
-            wica_path = get_derivative_path(layout,eeg_file,'wica','eeg','.fif',bids_root,derivatives_root)
-            prep_path = get_derivative_path(layout,eeg_file,'prep','eeg','.fif',bids_root,derivatives_root)
-            stats_path = get_derivative_path(layout,eeg_file,'label','stats','.txt',bids_root,derivatives_root)
-            power_path = get_derivative_path(layout,eeg_file,'channel'+pipelabel,'powers','.txt',bids_root,derivatives_root)
-            huber_path = get_derivative_path(layout,eeg_file,'huber'+pipelabel,'eeg','.fif',bids_root,derivatives_root)
-            reject_path = get_derivative_path(layout,eeg_file,'reject'+pipelabel,'eeg','.fif',bids_root,derivatives_root)
-            os.makedirs(os.path.split(power_path)[0], exist_ok=True)
+    results = _run_tasks(_harmonize_worker,tasks,n_jobs,logger)
+    archivosconerror = [x for x in results if x is not None]
+    return archivosconerror
 
-            json_dict = {"Description":desc_pipeline,"RawSources":[eeg_file.replace(bids_root,'')],"Configuration":THE_DATASET}
-            json_dict["Sources"]=wica_path.replace(bids_root,'')
+def _huber_worker(task,logger=None):
+    """Huber-normalize one reject derivative catching its errors, returns the file path if it failed, else None."""
+    i,num_files,eeg_file,reject_path,huber_path,json_dict,pipelabel,OVERWRITE,float32,bids_root,derivatives_root = task
+    if logger is None:
+        logger = logging.getLogger(_WORKER_LOGGER)
+    manifest = RunManifest(derivatives_root,bids_root)
+    try:
+        logger.info(f"File {i+1} of {num_files} ({(i+1)*100/num_files}%) : {reject_path}")
+        huber_input = manifest.output_hash('reject'+pipelabel,eeg_file)
+        if huber_input is None: # derivative not produced through the manifest
+            huber_input = manifest.file_hash(fif_path(reject_path))
+        huber_config = hash_config('huber',20,float32)
+        if not OVERWRITE and manifest.is_done('huber'+pipelabel,eeg_file,huber_input,huber_config,fif_path(huber_path),_read_epochs):
+            logger.info(f'{huber_path}) already existed, skipping...')
+            return None
+        start = time.perf_counter()
+        signal = mne.read_epochs(fif_path(reject_path),verbose=False)
+        huber_normalize(signal,float32=float32)
+        written = save_fif(signal,huber_path)
+        write_json(json_dict,huber_path.replace('.fif','.json'))
+        manifest.record('huber'+pipelabel,eeg_file,huber_input,huber_config,written,time.perf_counter()-start)
+    except Exception as error:
+        logger.exception(f'Error for {reject_path}')
+        print(error)
+        return eeg_file
+    finally:
+        manifest.close()
+    return None
 
-            if os.path.isfile(wica_path) and os.path.isfile(prep_path):
-                logger.info(f'{prep_path} and {wica_path} already existed, skipping...')
-            else:
-                raw = mne.io.read_raw(eeg_file,preload=True)
-                signal,prep_signal,stats=preflow(raw,correct_montage=channels,fast_mode=fast_mode,**THE_DATASET.get('args',{}))
-                
-                del raw
-                
-                prep_signal.save(prep_path ,split_naming='bids', overwrite=True)
-                del prep_signal
-                
-                signal.save(wica_path ,split_naming='bids', overwrite=True)
-                
-                write_json(json_dict,wica_path.replace('.fif','.json'))
-                write_json(json_dict,prep_path.replace('.fif','.json'))
-
-                write_json(json_dict,stats_path.replace('label','prep').replace('.txt','.json'))
-                write_json(json_dict,stats_path.replace('label','wica').replace('.txt','.json'))
-                
-                write_json(stats.get('prep',{}),stats_path.replace('label','prep'))
-                write_json(stats.get('wica',{}),stats_path.replace('label','wica'))
-            
+def renormalize(THE_DATASET,n_jobs=1,OVERWRITE=False,float32=False,layout=None):
+    """Huber-normalize the existing reject derivatives of a bids dataset (without running the rest of harmonize).
 
-            if THE_DATASET.get('events_to_keep', None) is not None:
-                events_file = os.path.splitext(eeg_file)[0].replace('_eeg','_events.tsv')
-                events_raw=pd.read_csv(events_file,sep='\t')
-                samples = events_raw['sample'].tolist()
-                values = events_raw['value'].tolist()
-                events = list(zip(values,samples))
-                events_to_keep = THE_DATASET.get('events_to_keep', None)
-            else:
-                events = None
-                events_to_keep = None
+    THE_DATASET: dictionary of the dataset, see harmonize
+    n_jobs: int, number of worker processes (def 1, serial). -1 uses all the cores.
+    OVERWRITE: bool, recompute the huber derivatives even if the manifest says they are up to date
+    float32: bool, compute the Huber scale in single precision (see huber_scale)
+    layout: BIDSLayout of the dataset, if None it is obtained with sovaharmony.layout.get_layout (cached)
 
-            if os.path.isfile(reject_path):    
-                logger.info(f'{reject_path} already existed, skipping...')
-            else:
-                signal = mne.io.read_raw(wica_path,preload=True)
-                signal = crop_raw_data(signal,events, events_to_keep)
-                signal,reject_info = run_reject(signal, THE_DATASET.get('epoch_length', 5))
-                signal.save(reject_path ,split_naming='bids', overwrite=True)
-                write_json(json_dict,reject_path.replace('.fif','.json'))
-                write_json(json_dict,stats_path.replace('label','reject'+pipelabel).replace('.txt','.json'))
-                write_json(reject_info,stats_path.replace('label','reject'+pipelabel))    
-            
-            if os.path.isfile(huber_path):
-                logger.info(f'{huber_path}) already existed, skipping...')
-            else: 
-                signal = mne.read_epochs(reject_path)
-                signal2=signal.copy()
-                signal_lp = signal.filter(None,20,fir_design='firwin')
-                (e, c, t) = signal._data.shape
-                signal_data = signal_lp.get_data()
-                da_eeg_cont = np.concatenate(signal_data,axis=-1)
-                for e in range(signal_data.shape[0]):
-                    for c in range(signal_data.shape[1]):
-                        assert np.all(signal_data[e,c,:] == da_eeg_cont[c,e*t:(e+1)*t])
-                signal_ch = createRaw(da_eeg_cont,signal_lp.info['sfreq'],ch_names=signal_lp.info['ch_names']) #Fro SRM signal_lp.info['ch_names']
-                std_ch = []
-                for ch in signal_ch._data:
-                    std_ch.append(mad_std(ch))
-                
-                huber = sm.robust.scale.Huber() 
-                k = huber(np.array(std_ch))[0] # o np.median(np.array(std_ch)) o np.mean(np.array(std_ch))
-                signal2._data=signal2._data/k
-               
-                signal2.save(huber_path ,split_naming='bids', overwrite=True)
-                write_json(json_dict,huber_path.replace('.fif','.json'))
-        
-        except Exception as error:
-            e+=1
-            logger.exception(f'Error for {eeg_file}')
-            archivosconerror.append(eeg_file)
-            print(error)
-            pass
-
-    return
+    Output:
+
+    list of str, filepaths of files with errors
+    """
+    input_path = THE_DATASET.get('input_path',None)
+    layout_dict = THE_DATASET.get('layout',None)
+    pipeline = 'sovaharmony'
+    pipelabel = '['+THE_DATASET.get('run-label', '')+']'
+    if layout is None:
+        layout = get_layout(input_path)
+    bids_root = layout.root
+    eegs = layout.get(**layout_dict)
+    derivatives_root = os.path.join(layout.root,'derivatives',pipeline)
+    log_path = os.path.join(derivatives_root,'code')
+    os.makedirs(log_path, exist_ok=True)
+    logger,currentdt = cfg_logger(log_path)
+    desc_pipeline = "sovaharmony, a harmonization eeg pipeline using the bids standard"
+    num_files = len(eegs)
+    tasks = []
+    for i,eeg_file in enumerate(eegs):
+        reject_path = get_derivative_path(layout,eeg_file,'reject'+pipelabel,'eeg','.fif',bids_root,derivatives_root)
+        huber_path = get_derivative_path(layout,eeg_file,'huber'+pipelabel,'eeg','.fif',bids_root,derivatives_root)
+        json_dict = {"Description":desc_pipeline,"RawSources":[eeg_file.replace(bids_root,'')],"Configuration":THE_DATASET}
+        json_dict["Sources"]=get_derivative_path(layout,eeg_file,'wica','eeg','.fif',bids_root,derivatives_root).replace(bids_root,'')
+        tasks.append((i,num_files,eeg_file,reject_path,huber_path,json_dict,pipelabel,OVERWRITE,float32,bids_root,derivatives_root))
+    results = _run_tasks(_huber_worker,tasks,n_jobs,logger)
+    archivosconerror = [x for x in results if x is not None]
+    return archivosconerror
@@ -3,7 +3,13 @@ import sovaflow.utils as us
 import matplotlib.pyplot as plt
 import os
 import numpy as np
-from sovaharmony.metrics.features import channels_reduction
+from sovaflow.flow import fit_spatial_filter
+
+channels_reduction={'cresta':['F3','F4','C3','C4','P3','P4','O1','O2'],
+                    'openBCI':['FP1','FP2','C3','C4','P7','P8','O2','O1'],# #https://docs.openbci.com/Deprecated/UltracortexMark3_NovaDep/
+                    'paper':['F3','F4','C3','C4','TP7','TP8','O1','O2'] # En el paper esta T3 y T4, lo cambiamos por TP7 y TP8
+                    # Quantitative electroencephalography in mild cognitive impairment: longitdinal changes and possible prediction of ALzheimer's disease
+                    }
 
 F = ['FP1', 'FPZ', 'FP2', 'AF3', 'AF4', 'F7', 'F5', 'F3', 'F1', 'FZ', 'F2', 'F4', 'F6', 'F8'] 
 T = ['FT7', 'FC5', 'FC6', 'FT8', 'T7', 'C5', 'C6', 'T8', 'TP7', 'CP5', 'CP6', 'TP8']
@@ -13,6 +19,10 @@ ROIs = [F,C,PO,T]
 
 # A ROI COULD BE A SPATIAL FILTER
 
+# Spatial filters and adapted demixing matrices already computed by this process
+_SPATIAL_FILTERS = {}
+_W_ADAPTED = {}
+
 # TODO: Pass spatial filters to sovaharmony
 
 def get_spatial_filter(name='62x19',portables=False,montage_select=None):
@@ -40,11 +50,18 @@ def get_spatial_filter(name='62x19',portables=False,montage_select=None):
     Returns:
         sf: dictionary 
             A, W, Mixing and Demixing Matrices of the default spatial filter of the module.
-        
+            Each filter is loaded once per process, A and W are read-only.
     
     """
     if name is None:
         return None
+    key = (name,bool(portables),montage_select if portables else None)
+    if key not in _SPATIAL_FILTERS:
+        _SPATIAL_FILTERS[key] = _load_spatial_filter(name,portables,montage_select)
+    sf = _SPATIAL_FILTERS[key]
+    return dict(sf,ch_names=list(sf['ch_names']))
+
+def _load_spatial_filter(name,portables=False,montage_select=None):
     # How sure are we that the order of the channels of matlab is the same as of python?
     mat_contents = loadmat(os.path.join(os.path.dirname(os.path.abspath(__file__)),'spatial_filters','spatial_filter__'+name+'.mat'))
     W = mat_contents['W']
@@ -63,9 +80,30 @@ def get_spatial_filter(name='62x19',portables=False,montage_select=None):
         W=W[[comp_select],:] # Select components, columns
         W=np.squeeze(W)
         sf={'A':A,'W':W,'ch_names':channels_reduction[montage_select],'name':montage_select}
-        return sf
-    else:   
-        return sf
+    sf['A'].flags.writeable = False
+    sf['W'].flags.writeable = False
+    return sf
+
+def adapted_demixing(spatial_filter,ch_names):
+    """
+    Demixing matrix of a spatial filter restricted to the channels of a signal.
+
+    The channels are taken in the order of the spatial filter, so the result does not depend
+    on the order of ch_names, and the matrix is computed once per process for each set of channels.
+
+    Returns:
+        W_adapted: numpy array (components, channels), read-only
+        intersection_chs: list, channels of the signal W_adapted applies to, in its order
+    """
+    spatial_filter_chs = spatial_filter['ch_names']
+    signal_chs = set(ch_names)
+    intersection_chs = [ch for ch in spatial_filter_chs if ch in signal_chs]
+    key = (spatial_filter['name'],tuple(spatial_filter_chs),tuple(intersection_chs))
+    if key not in _W_ADAPTED:
+        W_adapted = np.array(fit_spatial_filter(spatial_filter['W'],spatial_filter_chs,intersection_chs,mode='demixing'))
+        W_adapted.flags.writeable = False
+        _W_ADAPTED[key] = W_adapted
+    return _W_ADAPTED[key],intersection_chs
 
 def plot_spatial_filter(name='62x19'):
     #ch_names = [us.chn_name_mapping(x) for x in ch_names]
@@ -13,21 +13,28 @@ import collections
 import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+import re
 import errno
 import glob 
+from concurrent.futures import ProcessPoolExecutor
 def load_txt(file):
   '''
   Function that reads txt files
 
   Parameters
   ----------
-    file: extend .txt 
+    file: extend .txt or .npz (see preprocessing.write_npz)
 
   Returns
   -------
     data: 
-      Contains the information that was stored in the txt file
+      Contains the information that was stored in the txt file,
+      for .npz files the numeric entries are numpy arrays
   '''
+  if os.path.splitext(file)[1] == '.npz':
+    with np.load(file, allow_pickle=False) as npz:
+      data = {key:json.loads(str(npz[key])) if npz[key].dtype.kind == 'U' else npz[key] for key in npz.files}
+    return data
   with open(file, 'r') as f:
     data=json.load(f)
   return data
@@ -59,65 +66,173 @@ def concat_df(path):
     data_concat=pd.concat((data))
     return data_concat
 
+# Level of the _verify_* checks of the axes of the data:
+#   'off': no check (production runs)
+#   'sampled': a few random (epoch,space) pairs
+#   'full': every epoch and space
+# The default can be set with the environment variable SOVAHARMONY_VALIDATION.
+# The sampled pairs are drawn with the seed SOVAHARMONY_VALIDATION_SEED (a new one per check
+# if it is not set), a failed check reports its seed so it can be reproduced.
+VALIDATION_LEVELS = ['off','sampled','full']
+_VALIDATION = {'level':'sampled','samples':8,
+               'seed':int(os.environ['SOVAHARMONY_VALIDATION_SEED']) if os.environ.get('SOVAHARMONY_VALIDATION_SEED') else None}
+
+def set_validation_level(level,samples=None,seed=None):
+    '''Sets the level of the _verify_* checks ('off', 'sampled' or 'full'), the pairs checked when sampled and their seed.'''
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(f'Validation level should be one of {VALIDATION_LEVELS}')
+    _VALIDATION['level'] = level
+    if samples is not None:
+        _VALIDATION['samples'] = samples
+    if seed is not None:
+        _VALIDATION['seed'] = seed
+
+if os.environ.get('SOVAHARMONY_VALIDATION'):
+    if os.environ['SOVAHARMONY_VALIDATION'] not in VALIDATION_LEVELS:
+        raise ValueError(f"SOVAHARMONY_VALIDATION should be one of {VALIDATION_LEVELS}, got {os.environ['SOVAHARMONY_VALIDATION']!r}")
+    set_validation_level(os.environ['SOVAHARMONY_VALIDATION'])
+
+def get_validation_level():
+    return _VALIDATION['level']
+
+def _sample_pairs(epochs,spaces,seed=None):
+    '''Random (epoch,space) pairs to check, always including the first and the last ones.
+
+    Returns the epochs, the spaces and the seed used (the validation seed, or a new one if it is None).'''
+    if seed is None:
+        seed = _VALIDATION['seed']
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    n = min(_VALIDATION['samples'],epochs*spaces)
+    flat = np.random.default_rng(seed).choice(epochs*spaces,size=n,replace=False)
+    flat = np.unique(np.concatenate([flat,[0,epochs*spaces-1]]))
+    return flat // spaces, flat % spaces, seed
+
 def _verify_epochs_axes(epochs_spaces_times,spaces_times_epochs,max_epochs=None):
     """
+    Checks that spaces_times_epochs is epochs_spaces_times with the axes (spaces,times,epochs),
+    according to the validation level (see set_validation_level).
     """
+    level = _VALIDATION['level']
+    if level == 'off':
+        return True
     epochs,spaces,times = epochs_spaces_times.shape
-    if max_epochs is None:
-        max_epochs = epochs
-    for e in range(np.max([epochs,max_epochs])):
-        for c in range(spaces):
-            assert np.all(epochs_spaces_times[e,c,:] == spaces_times_epochs[c,:,e])
+    if level == 'full':
+        assert np.array_equal(epochs_spaces_times[:epochs],np.transpose(spaces_times_epochs[:,:,:epochs],(2,0,1)))
+    else:
+        e,c,seed = _sample_pairs(epochs,spaces)
+        assert np.all(epochs_spaces_times[e,c,:] == spaces_times_epochs[c,:,e]), f'Axes mismatch in the sampled (epoch,space) pairs, SOVAHARMONY_VALIDATION_SEED={seed}'
     return True
 
 def _verify_epoch_continuous(data,spaces_times,data_axes,max_epochs=None):
+    """
+    Checks that spaces_times is data with its epochs concatenated in time,
+    according to the validation level (see set_validation_level).
+    """
     epochs_idx = data_axes.index('epochs')
     spaces_idx = data_axes.index('spaces')
     times_idx = data_axes.index('times')
     epochs,spaces,times = data.shape[epochs_idx],data.shape[spaces_idx],data.shape[times_idx]
     if not epochs_idx in [0,2]:
         raise ValueError('Axes should be either epochs,spaces,times or spaces,times,epochs')
-    if max_epochs is None:
-        max_epochs = epochs
-    for e in range(np.max([epochs,max_epochs])):
-        for c in range(spaces):
-            if epochs_idx==0:
-                assert np.all(data[e,c,:] == spaces_times[c,e*times:(e+1)*times])
-            elif epochs_idx==2:
-                assert np.all(data[c,:,e] == spaces_times[c,e*times:(e+1)*times])
+    level = _VALIDATION['level']
+    if level == 'off':
+        return True
+    continuous = spaces_times[:,:epochs*times].reshape((spaces,epochs,times))
+    if level == 'full':
+        segments = data[:epochs].transpose((1,0,2)) if epochs_idx==0 else data[:,:,:epochs].transpose((0,2,1))
+        assert np.array_equal(segments,continuous)
+    else:
+        e,c,seed = _sample_pairs(epochs,spaces)
+        segments = data[e,c,:] if epochs_idx==0 else data[c,:,e]
+        assert np.all(segments == continuous[c,e,:]), f'Concatenation mismatch in the sampled (epoch,space) pairs, SOVAHARMONY_VALIDATION_SEED={seed}'
     return True
 
+def bounded_map(fn,iterable,n_jobs=1,executor=None,max_pending=None):
+    """
+    Ordered map of fn over iterable, serially or concurrently with bounded memory.
+
+    fn: callable of one argument, picklable (module level) if processes are used
+    iterable: tasks, consumed lazily so only max_pending of them are alive at once
+    n_jobs: int, number of worker processes if executor is None (def 1, serial). -1 uses all the cores.
+    executor: concurrent.futures.Executor to use instead of creating one (it is not shut down)
+    max_pending: int, maximum number of submitted tasks not yet consumed (def 2 per worker)
+
+    Yields the results in the order of iterable.
+    """
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if executor is None and (not n_jobs or n_jobs == 1):
+        for task in iterable:
+            yield fn(task)
+        return
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    if max_pending is None:
+        max_pending = 2*getattr(executor,'_max_workers',n_jobs or 1)
+    pending = collections.deque()
+    try:
+        for task in iterable:
+            pending.append(executor.submit(fn,task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # on an error or an early close, the tasks not started are dropped (shutdown(cancel_futures=True) is 3.9+)
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+
 
 
 "Functions to save dataframes for graphics"
 
+DATA_DEM = ['participant_id', 'visit', 'group', 'condition', 'database']
+
+# Names of the columns of the wide tables (see data_structure.query_derivatives):
+# {feature}_{space}_{Band} and, for crossfreq, {feature}_{space}_M{band}_{Band}
+_COLUMN = re.compile(r'^(?P<feature>.+)_(?P<space>[^_]+)_(?P<band>[^_]+)$')
+_CROSS_COLUMN = re.compile(r'^(?P<feature>.+)_(?P<space>[^_]+)_(?P<mband>M[^_]+)_(?P<band>[^_]+)$')
+
+def _wide_to_long(data,type,columns,space,cross=False,order=None):
+    '''
+    Long table of the feature columns of a wide dataframe in a single melt.
+
+    Parameters
+    ----------
+        data: wide dataframe with the DATA_DEM columns
+        type: name of the column of the values
+        columns: feature columns to reshape
+        space: name of the column of the space label ('ROI' or 'Component')
+        cross: the columns have a modulating band (crossfreq), given in the 'M_Band' column
+        order: order of the label columns, by default ['Band',space] (+ ['M_Band'])
+
+    Returns
+    -------
+        DataFrame with DATA_DEM + [type] + order, the rows of each column one after the other
+    '''
+    columns = list(columns)
+    parser = _CROSS_COLUMN if cross else _COLUMN
+    labels = pd.Series(columns,dtype=object).str.extract(parser)
+    if labels['band'].isna().any():
+        raise ValueError(f'Unknown column names {[c for c,b in zip(columns,labels["band"].isna()) if b]}')
+    if order is None:
+        order = ['Band',space] + (['M_Band'] if cross else [])
+    long = data.melt(id_vars=DATA_DEM,value_vars=columns,value_name=type,ignore_index=True)
+    codes = np.repeat(np.arange(len(columns)),len(data))
+    parsed = {'Band':labels['band'],space:labels['space']}
+    if cross:
+        parsed['M_Band'] = labels['mband']
+    for column in order:
+        long[column] = parsed[column].to_numpy()[codes]
+    return long[DATA_DEM+[type]+order]
+
 def dataframe_long_roi(data,type,columns,name,path):
     '''Function used to convert a dataframe to be used for graphing by ROIs'''
-    #demographic data and neuropsychological test columns
-    #data_dem=['participant_id', 'visit', 'group', 'condition', 'database','age', 'sex', 'education', 'MM_total', 'FAS_F', 'FAS_A', 'FAS_S']
-    data_dem=['participant_id', 'visit', 'group', 'condition', 'database']
-    columns_df=data_dem+[type, 'Band', 'ROI']
-    data_new=pd.DataFrame(columns=columns_df)
-    #Frequency bands
-    bandas=['Delta','Theta','Alpha-1','Alpha-2','Beta1','Beta2','Beta3','Gamma']
-    #ROIs 
-    roi=['F', 'C','PO', 'T_']
-    for i in columns:
-        '''The column of interest is taken with its respective demographic data and added to the new dataframe'''
-        data_x=data_dem.copy()
-        data_x.append(i)
-        d_sep=data.loc[:,data_x] 
-        for j in bandas:
-            if j in i:
-                band=j
-        for c in roi:
-            if c in i:
-                r=c
-        d_sep['Band']=[band]*len(d_sep)
-        d_sep['ROI']=[r]*len(d_sep)
-        d_sep= d_sep.rename(columns={i:type})
-        data_new=data_new.append(d_sep,ignore_index = True) #Uno el dataframe 
-    data_new['ROI']=data_new['ROI'].replace({'T_':'T'}, regex=True)#Quito el _ y lo reemplazo con '' 
+    data_new = _wide_to_long(data,type,columns,'ROI')
     try:
         path="{input_path}\data_long\ROI".format(input_path=path).replace('\\','/')
         os.makedirs(path)
@@ -129,37 +244,7 @@ def dataframe_long_roi(data,type,columns,name,path):
 
 def dataframe_long_components(data,type,columns,name,path,spatial_matrix='54x10'):
     '''Function used to convert a wide dataframe into a long one to be used for graphing by IC'''
-    #demographic data and neuropsychological test columns
-    #data_dem=['participant_id', 'visit', 'group', 'condition', 'database','age', 'sex', 'education', 'MM_total', 'FAS_F', 'FAS_A', 'FAS_S']
-    data_dem=['participant_id', 'visit', 'group', 'condition', 'database']
-    columns_df=data_dem+[type, 'Band', 'Component']
-    data_new=pd.DataFrame(columns=columns_df)
-    #Frequency bands
-    bandas=['Delta','Theta','Alpha-1','Alpha-2','Beta1','Beta2','Beta3','Gamma']
-    #Components
-    if spatial_matrix=='58x25':
-        componentes =['C14', 'C15','C18', 'C20', 'C22','C23', 'C24', 'C25']
-    elif spatial_matrix=='54x10':
-        componentes =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10']
-    elif spatial_matrix=='cresta' or spatial_matrix=='openBCI' or spatial_matrix=='paper':
-        componentes =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
-    
-    for i in columns:
-        '''The column of interest is taken with its respective demographic data and added to the new dataframe'''
-        data_x=data_dem.copy()
-        data_x.append(i)
-        d_sep=data.loc[:,data_x] 
-        for j in bandas:
-            if j in i:
-                band=j
-        for c in componentes:
-            if c in i:
-                componente=c
-        d_sep['Band']=[band]*len(d_sep)
-        d_sep['Component']=[componente]*len(d_sep)
-        d_sep= d_sep.rename(columns={i:type})
-        data_new=pd.concat((data_new,d_sep),ignore_index = True)
-        #data_new=data_new.append(d_sep,ignore_index = True) #Uno el dataframe 
+    data_new = _wide_to_long(data,type,columns,'Component')
     try:
         path="{input_path}\data_long\IC".format(input_path=path).replace('\\','/')
         os.makedirs(path)
@@ -171,38 +256,7 @@ def dataframe_long_components(data,type,columns,name,path,spatial_matrix='54x10'
 
 def dataframe_long_cross_roi(data,type,columns,name,path):
     '''Function used to convert a dataframe to be used for graphing by ROIs'''
-    #demographic data and neuropsychological test columns
-    #data_dem=['participant_id', 'visit', 'group', 'condition', 'database','age', 'sex', 'education', 'MM_total', 'FAS_F', 'FAS_A', 'FAS_S']
-    
-    data_dem=['participant_id', 'visit', 'group', 'condition', 'database']
-    columns_df=data_dem+[type, 'Band', 'ROI']
-    data_new=pd.DataFrame(columns=columns_df)
-    #Frequency bands 
-    bandas=['_Delta','_Theta','_Alpha-1','_Alpha-2','_Beta1','_Beta2','_Beta3','_Gamma']
-    m_bandas=['Mdelta','Mtheta','Malpha-1','Malpha-2','Mbeta1','Mbeta2','Mbeta3','Mgamma']
-    #ROIs 
-    roi=['F', 'C','PO', 'T_']
-    for i in columns:
-        '''The column of interest is taken with its respective demographic data and added to the new dataframe'''
-        data_x=data_dem.copy()
-        data_x.append(i)
-        d_sep=data.loc[:,data_x] 
-        for j in bandas:
-            if j in i:
-                band=j
-        for m in m_bandas:
-            if m in i:
-                bandm=m
-        for c in roi:
-            if c in i:
-                r=c
-        d_sep['Band']=[band]*len(d_sep)
-        d_sep['ROI']=[r]*len(d_sep)
-        d_sep['M_Band']=[bandm]*len(d_sep)
-        d_sep= d_sep.rename(columns={i:type})
-        data_new=data_new.append(d_sep,ignore_index = True) #Uno el dataframe 
-    data_new['ROI']=data_new['ROI'].replace({'T_':'T'}, regex=True)#Quito el _ y lo reemplazo con '' 
-    data_new['Band']=data_new['Band'].replace({'_':''}, regex=True)#Quito el _ y lo reemplazo con ''
+    data_new = _wide_to_long(data,type,columns,'ROI',cross=True)
     try:
         path="{input_path}\data_long\ROI".format(input_path=path).replace('\\','/')
         os.makedirs(path)
@@ -214,41 +268,7 @@ def dataframe_long_cross_roi(data,type,columns,name,path):
 
 def dataframe_long_cross_ic(data,type='Cross Frequency',columns=None,name=None,path=None,spatial_matrix='54x10'):
     '''Function used to convert a dataframe to be used for graphing.'''
-    #demographic data and neuropsychological test columns
-    #data_dem=['participant_id', 'visit', 'group', 'condition', 'database','age', 'sex', 'education', 'MM_total', 'FAS_F', 'FAS_A', 'FAS_S']
-    data_dem=['participant_id', 'visit', 'group', 'condition', 'database']
-    columns_df=data_dem+[type, 'Band','M_Band', 'Component']
-    data_new=pd.DataFrame(columns=columns_df)
-    #Frequency bands
-    bandas=['_Delta','_Theta','_Alpha-1','_Alpha-2','_Beta1','_Beta2','_Beta3','_Gamma']
-    m_bandas=['Mdelta','Mtheta','Malpha-1','Malpha-2','Mbeta1','Mbeta2','Mbeta3','Mgamma']
-    if spatial_matrix=='58x25':
-        componentes =['C14', 'C15','C18', 'C20', 'C22','C23', 'C24', 'C25']
-    elif spatial_matrix=='54x10':
-        componentes =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10']
-    elif spatial_matrix=='cresta' or spatial_matrix=='openBCI' or spatial_matrix=='paper':
-        componentes =['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8']
-    for i in columns:
-        '''The column of interest is taken with its respective demographic data and added to the new dataframe'''
-        data_x=data_dem.copy()
-        data_x.append(i)
-        d_sep=data.loc[:,data_x] 
-        for j in bandas:
-            if j in i:
-                band=j 
-        for m in m_bandas:
-            if m in i:
-                bandm=m
-        for c in componentes:
-            if c in i:
-                componente=c
-
-        d_sep['Band']=[band]*len(d_sep)
-        d_sep['M_Band']=[bandm]*len(d_sep)
-        d_sep['Component']=[componente]*len(d_sep)
-        d_sep= d_sep.rename(columns={i:type})
-        data_new=data_new._append(d_sep,ignore_index = True) #Uno el dataframe 
-    data_new['Band']=data_new['Band'].replace({'_':''}, regex=True)#Quito el _ y lo reemplazo con ''
+    data_new = _wide_to_long(data,type,columns,'Component',cross=True,order=['Band','M_Band','Component'])
     try:
         path="{input_path}\data_long\IC".format(input_path=path).replace('\\','/')
         os.makedirs(path)
@@ -276,46 +296,38 @@ def dataframe_componentes_deseadas(data,columnas):
 def removing_outliers(data,columns):
     '''
     Function used to return a dataframe without outliers, where it is verified that no more than 5$%$ of the data is lost per database.
+
+    A value is atypical if it is out of [Q1-1.5*IQR, Q3+1.5*IQR] of its column in its database.
+    The subjects with more than i atypical values are removed, with i >= 3 the smallest threshold
+    that removes at most 5% of the subjects of the database.
     '''
-    data['index'] = data.index #It was necessary to create a column labeled "index" to take the indexes in an easy way
-    data_copy=data.copy()
+    columns = list(columns)
     databases=data['database'].unique()
+    values = data[columns].to_numpy(dtype=float)
+    groups = data[columns].groupby(data['database'],sort=False)
+    quantiles = groups.quantile([0.25,0.75],interpolation='midpoint')
+    with_nan = data[columns].isna().groupby(data['database'],sort=False).any() # np.percentile gives nan, no outliers
+    Q1 = quantiles.xs(0.25,level=-1).mask(with_nan)
+    Q3 = quantiles.xs(0.75,level=-1).mask(with_nan)
+    IQR = Q3 - Q1
+    upper = (Q3+1.5*IQR).reindex(data['database']).to_numpy()
+    lower = (Q1-1.5*IQR).reindex(data['database']).to_numpy()
+    # Cuantas veces un sujeto tiene un dato atipico, en una banda de una componente
+    repeticiones = np.sum(values >= upper,axis=1) + np.sum(values <= lower,axis=1)
+
+    keep = np.ones(len(data),dtype=bool)
     for db in databases:
-        datos_db=data[data['database']==db] 
-        indices_db=[]
-        for com in columns:
-            Q1 = np.percentile(datos_db[com], 25, interpolation = 'midpoint')
-            Q3 = np.percentile(datos_db[com], 75,interpolation = 'midpoint')
-            IQR = Q3 - Q1 
-            dataupper=datos_db[datos_db[com] >= (Q3+1.5*IQR)]#Valores atipicos superiores
-            if dataupper.empty:
-                upper=[]
-            else:
-                upper=dataupper.index.tolist() #lista de indices del dataframe que son valores atipicos
-            datalower=datos_db[datos_db[com] <= (Q1-1.5*IQR)]#Valores atipicos inferiores
-            if datalower.empty:
-                lower=[]
-            else:
-                lower=datalower.index.tolist()#lista de indices del dataframe que son valores atipicos
-            indices=upper+lower #union de upper y lower de indices del dataframe que son valores atipicos
-            indices_db.extend(indices) #Se tiene una lista de indices por cada base de datos
-    
-        repeticiones=collections.Counter(indices_db) #Diccionario que contiene cuantas veces un indice(sujeto) tiene un dato atipico, en una banda de una componente
-        bandera=True
-        
-        i=2
-        while(bandera):#Mientras no se encuentre el porcentaje de perdida requerido
-            i+=1 #se aumenta cada que se entra al while
-            data_prueba=data.copy()#  copia de data frame para no borrar datos del dataframe original,se crea cada que se entra al while
-            index_to_delete=list(dict(filter(lambda x: x[1] > i, repeticiones.items())).keys()) # se crea una lista de los indices cuyas repeticiones de datos atipicos es mayor a i
-            data_prueba.drop(index_to_delete, inplace = True)#Se borran los indices del dataframe de prueba para saber el porcentaje de datos borrados
-            porcentaje=100-data_prueba[data_prueba['database']==db].shape[0]*100/data[data['database']==db].shape[0]#porcentaje de datos borrados
+        mask = (data['database']==db).to_numpy()
+        n = mask.sum()
+        conteos = np.sort(repeticiones[mask])
+        # the number of removed subjects only changes at the counts, scan them from i=3
+        for i in [3]+[c for c in np.unique(conteos) if c > 3]:
+            borrados = n - np.searchsorted(conteos,i,side='right')
+            porcentaje = 100-(n-borrados)*100/n
             if porcentaje<=5:
-                #Si el procentaje borrado por primera vez es menor o igual a 5, se borra del dataframe copia los indices que dan el resultado deseado
-                data_copy.drop(index_to_delete, inplace = True)
-                bandera=False #se cambia la bandera para que no entre mas al while
-                #print(porcentaje)
-    data_copy=data_copy.drop(columns='index')
+                break
+        keep[mask] = repeticiones[mask] <= i
+    data_copy = data[keep]
     #Para observar un resumen de los datos antes y despues de eliminar sujetos con mayor cantidad de datos atipicos
     for db in databases:
         print('\nBase de datos '+db)
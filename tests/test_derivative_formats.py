@@ -0,0 +1,36 @@
+"""Round trip of the feature derivatives through .npz (preprocessing.write_npz, utils.load_txt) and .txt."""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('sovaflow')
+from sovaharmony.preprocessing import write_json, write_npz
+from sovaharmony.utils import load_txt
+
+@pytest.fixture
+def derivative():
+    rng = np.random.default_rng(0)
+    return {
+        'metadata':{'type':'power','kwargs':{'bands':{'alpha':(8.5,12.5)}},'axes':{'bands':['alpha','beta'],'spaces':['C14','C15','C18']}},
+        'values':rng.standard_normal((2,3)),
+        'fit_params':{'values':rng.standard_normal((3,2)).tolist(),'axes':['Intercept','Slope']},
+    }
+
+def test_npz_round_trip(tmp_path, derivative):
+    npz_path = os.path.join(tmp_path,'sub-01_power.npz')
+    txt_path = os.path.join(tmp_path,'sub-01_power.txt')
+    write_npz(derivative,npz_path)
+    write_json(derivative,txt_path)
+    from_npz = load_txt(npz_path)
+    from_txt = load_txt(txt_path)
+    assert isinstance(from_npz['values'],np.ndarray)
+    np.testing.assert_array_equal(from_npz['values'],derivative['values']) # bit exact
+    np.testing.assert_allclose(from_txt['values'],derivative['values'],rtol=1e-15)
+    assert from_npz['metadata'] == from_txt['metadata']
+    assert from_npz['fit_params'] == from_txt['fit_params']
+    assert sorted(os.listdir(tmp_path)) == ['sub-01_power.npz','sub-01_power.txt'] # no temporary files left
+
+def test_ragged_values(tmp_path):
+    path = os.path.join(tmp_path,'ragged.npz')
+    write_npz({'metadata':{},'values':[[1,2],[3]]},path)
+    assert load_txt(path)['values'] == [[1,2],[3]]
@@ -0,0 +1,44 @@
+"""Lehmer-code permutation entropy (metrics.entropy) against a tuple-counting reference."""
+import itertools
+import math
+import numpy as np
+import pytest
+from sovaharmony.metrics.entropy import codigos_Lehmer, permutation_entropy
+
+def permutation_entropy_loop(serie, D, tau=1):
+    """Counts the argsort tuple of every embedded vector, as Entropia_Permutacion (normalized by log2(D!))."""
+    permutations = list(itertools.permutations(range(D)))
+    counts = np.zeros(len(permutations))
+    numero_vectores = len(serie) - (D - 1)*tau
+    for i in range(numero_vectores):
+        counts[permutations.index(tuple(np.argsort(serie[i:i + (D - 1)*tau + 1:tau])))] += 1
+    p = counts[counts > 0]/numero_vectores
+    return float(-np.sum(p*np.log2(p))/np.log2(math.factorial(D)))
+
+@pytest.mark.parametrize('D', [3, 4, 5])
+def test_lehmer_codes_are_itertools_ranks(D):
+    permutations = np.array(list(itertools.permutations(range(D))))
+    np.testing.assert_array_equal(codigos_Lehmer(permutations), np.arange(math.factorial(D)))
+
+@pytest.mark.parametrize('D,tau', [(3, 1), (4, 1), (3, 2)])
+def test_matches_loop(D, tau):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((3, 400, 2)) # channels, points, epochs
+    data[0, :, 0] = np.round(data[0, :, 0]) # ties
+    values = permutation_entropy(data, D, tau=tau, axis=1)
+    assert values.shape == (3, 2)
+    for c in range(3):
+        for e in range(2):
+            assert values[c, e] == pytest.approx(permutation_entropy_loop(data[c, :, e], D, tau), abs=1e-12)
+
+def test_chunks_and_bounds():
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((5, 300))
+    values = permutation_entropy(data, 3)
+    np.testing.assert_allclose(permutation_entropy(data, 3, chunk_size=1), values, atol=1e-15)
+    assert np.all((values > 0.9) & (values <= 1)) # white noise is close to the maximum
+    assert permutation_entropy(np.arange(100.)[None, :], 3)[0] == 0 # a single pattern
+
+def test_invalid_tau():
+    with pytest.raises(ValueError):
+        permutation_entropy(np.zeros((1, 10)), 3, tau=0)
@@ -0,0 +1,58 @@
+"""Deviation of the float32 compute mode from the float64 results, kernel by kernel."""
+import numpy as np
+import pytest
+import mne
+from sovaharmony.metrics.bands import FilterBank
+from sovaharmony.metrics.coh import get_coherence
+from sovaharmony.metrics.multitaper import multitaper_psd
+from sovaharmony.metrics.sl import sl, sl_config
+from sovaharmony.metrics.entropy import permutation_entropy
+
+SFREQ = 250.
+BANDS = [(1.5,6),(8.5,10.5),(30,45)]
+
+@pytest.fixture
+def data():
+    """(epochs, spaces, times) in volts, 1/f background with an alpha rhythm."""
+    rng = np.random.default_rng(0)
+    x = np.cumsum(rng.standard_normal((4,8,1000)),axis=-1)*1e-6
+    return x + 1e-6*np.sin(2*np.pi*10*np.arange(1000)/SFREQ)
+
+def relative(x, reference):
+    return np.max(np.abs(x-reference))/np.max(np.abs(reference))
+
+@pytest.mark.parametrize('design', ['epochs','continuous'])
+def test_filterbank(data, design):
+    bank = FilterBank.get(SFREQ,BANDS,design)
+    bands = bank.apply(data.astype(np.float32))
+    assert bands.dtype == np.float32
+    assert relative(bands,bank.apply(data)) < 5e-6
+
+def test_coherence(data):
+    epochs = mne.EpochsArray(data,mne.create_info(8,SFREQ,'eeg'),verbose=False)
+    bands = {'delta':(1.5,6),'alpha':(8.5,10.5)}
+    _, coherence = get_coherence(epochs,bands,1,dtype=np.float32)
+    assert coherence.dtype == np.float32
+    np.testing.assert_allclose(coherence,get_coherence(epochs,bands,1)[1],atol=5e-6)
+
+def test_multitaper(data):
+    x = np.transpose(data,(1,2,0)) # spaces times epochs
+    _, psd = multitaper_psd(x.astype(np.float32),SFREQ)
+    assert psd.dtype == np.float32
+    np.testing.assert_allclose(psd,multitaper_psd(x,SFREQ)[1],rtol=1e-4)
+
+def test_sl(data):
+    x = data[0].T # samples channels
+    np.testing.assert_allclose(sl(x.astype(np.float32),sl_config()),sl(x,sl_config()),atol=1e-6)
+
+def test_permutation_entropy(data):
+    np.testing.assert_allclose(permutation_entropy(data.astype(np.float32),axis=-1),permutation_entropy(data,axis=-1),atol=1e-6)
+
+def test_pme_streaming(data):
+    pytest.importorskip('sovaflow')
+    from sovaharmony.metrics.pme import Modulation_Energy_Streaming
+    x = np.transpose(data,(1,2,0)) # spaces times epochs
+    energy = Modulation_Energy_Streaming(x.astype(np.float32),SFREQ,Bands=BANDS)
+    assert energy.dtype == np.float32
+    reference = Modulation_Energy_Streaming(x,SFREQ,Bands=BANDS)
+    assert relative(energy,reference) < 1e-4
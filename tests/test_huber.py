@@ -0,0 +1,28 @@
+"""The Huber scale of preprocessing equals the computation over mne.Epochs.filter it replaced."""
+import numpy as np
+import pytest
+
+pytest.importorskip('sovaflow')
+mne = pytest.importorskip('mne')
+sm = pytest.importorskip('statsmodels.api')
+from astropy.stats import mad_std
+from sovaharmony.preprocessing import huber_scale
+
+def test_huber_scale_padding():
+    rng = np.random.default_rng(0)
+    epochs = mne.EpochsArray(rng.standard_normal((20, 8, 1250)) * 1e-5, mne.create_info(8, 250., 'eeg'), verbose=False)
+    low_passed = epochs.copy().filter(None, 20, fir_design='firwin', verbose=False)
+    data = np.concatenate(low_passed.get_data(), axis=-1)
+    expected = sm.robust.scale.Huber()(np.array([mad_std(ch) for ch in data]))[0]
+    assert huber_scale(epochs) == pytest.approx(expected, rel=1e-12)
+    assert huber_scale(epochs, float32=True) == pytest.approx(expected, rel=1e-5)
+
+def test_huber_scale_float32():
+    rng = np.random.default_rng(1)
+    epochs = mne.EpochsArray(rng.standard_normal((20, 8, 1250)) * 1e-5, mne.create_info(8, 250., 'eeg'), verbose=False)
+    before = epochs.get_data()
+    scale = huber_scale(epochs)
+    assert huber_scale(epochs, chunk_size=1) == scale # one channel at a time
+    assert huber_scale(epochs, float32=True) == pytest.approx(scale, rel=1e-5)
+    assert huber_scale(epochs, float32=True, chunk_size=1) == huber_scale(epochs, float32=True)
+    np.testing.assert_array_equal(epochs.get_data(), before)
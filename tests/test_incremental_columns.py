@@ -0,0 +1,40 @@
+"""Incremental wide tables (query_derivatives._load_rows): same table as a full load, keys in the sidecar index."""
+import json
+import os
+import pandas as pd
+from sovaharmony.data_structure.query_derivatives import _load_rows, _write_columns, _index_path
+
+def write_derivative(folder, i, value):
+    path = os.path.join(folder, f'sub-{i}.txt')
+    with open(path, 'w') as f:
+        json.dump({'value': value}, f)
+    return path
+
+def test_incremental_matches_full(tmp_path):
+    folder = str(tmp_path)
+    feather_path = os.path.join(folder, 'columns.feather')
+    loaded = []
+    def build_row(data, path):
+        loaded.append(path)
+        return {'participant_id': os.path.basename(path), 'value': data['value']}
+    paths = [write_derivative(folder, i, i) for i in range(4)]
+    df, index = _load_rows(paths, folder, 'DB', build_row, feather_path, incremental=True)
+    _write_columns(df, feather_path, index)
+    assert list(pd.read_feather(feather_path).columns) == ['participant_id', 'value', 'database']
+
+    # one derivative modified, one removed and one added
+    os.remove(paths[0])
+    paths = paths[1:3] + [write_derivative(folder, 3, 30), write_derivative(folder, 9, 9)]
+    os.utime(paths[2], ns=(0, 0))
+    loaded.clear()
+    df, index = _load_rows(paths, folder, 'DB', build_row, feather_path, incremental=True)
+    _write_columns(df, feather_path, index)
+    assert sorted(loaded) == sorted(paths[2:])
+    assert list(index['derivative_path']) == [os.path.basename(x) for x in paths]
+    full, _ = _load_rows(paths, folder, 'DB', build_row)
+    pd.testing.assert_frame_equal(df, full)
+    pd.testing.assert_frame_equal(pd.read_feather(feather_path), full)
+
+    # a full rebuild removes the index, it no longer describes the table
+    _write_columns(full, feather_path)
+    assert not os.path.isfile(_index_path(feather_path))
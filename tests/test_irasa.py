@@ -0,0 +1,29 @@
+"""IRASA over all the spaces at once (qeeg_psd_irasa_batch) against the per-channel qeeg_psd_irasa."""
+import numpy as np
+import pytest
+
+pytest.importorskip('yasa')
+pytest.importorskip('sovaflow')
+pytest.importorskip('sovachronux')
+from sovaharmony.metrics.features import qeeg_psd_irasa, qeeg_psd_irasa_batch
+
+SFREQ = 250.
+BANDS = {'delta':(1.5,6),'theta':(6,8.5),'alpha':(8.5,12.5),'beta':(12.5,30),'gamma':(30,45)}
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    t = np.arange(int(60*SFREQ))/SFREQ
+    data = np.cumsum(rng.standard_normal((4, len(t))), axis=1)*0.1 # 1/f background
+    data += np.array([1, 2, 0, 3])[:, None]*np.sin(2*np.pi*10*t)
+    return data
+
+@pytest.mark.parametrize('descomposition', [True, False])
+@pytest.mark.parametrize('chunk_size', [None, 1, 3])
+def test_batch_matches_per_channel(data, descomposition, chunk_size):
+    values, fit_values, fit_axes = qeeg_psd_irasa_batch(data, SFREQ, BANDS, descomposition, chunk_size=chunk_size)
+    assert values.shape == (len(BANDS), data.shape[0])
+    for space in range(data.shape[0]):
+        expected, fit_params = qeeg_psd_irasa(data[space], SFREQ, BANDS, None, descomposition)
+        np.testing.assert_allclose(values[:, space], np.ravel([expected[b] for b in BANDS]), rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(fit_values[space], fit_params[fit_axes].to_numpy()[0], rtol=1e-9)
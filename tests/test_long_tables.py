@@ -0,0 +1,53 @@
+"""_wide_to_long (utils) against the per-column loop of the original dataframe_long_* functions."""
+import numpy as np
+import pandas as pd
+import pytest
+from sovaharmony.utils import DATA_DEM, _wide_to_long
+
+BANDS = ['Delta','Theta','Alpha-1','Alpha-2','Beta1','Beta2','Beta3','Gamma']
+M_BANDS = ['Mdelta','Mtheta','Malpha-1','Malpha-2','Mbeta1','Mbeta2','Mbeta3','Mgamma']
+COMPONENTS = ['C14','C15','C18','C20','C22','C23','C24','C25']
+ROIS = ['F','C','PO','T']
+
+def wide(columns, n=5):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'participant_id':[f'sub-{i}' for i in range(n)],'visit':'V0','group':['G1','G2']*(n//2)+['G1']*(n%2),
+                         'condition':'OE','database':'DB'})
+    values = pd.DataFrame({column:rng.standard_normal(n) for column in columns})
+    return pd.concat([data,values],axis=1)
+
+def long_loop(data, type, columns, labels):
+    """One block per column with its labels found by substring, as the original functions."""
+    blocks = []
+    for column in columns:
+        block = data.loc[:, DATA_DEM + [column]].rename(columns={column:type})
+        for name, options in labels.items():
+            block[name] = [x.strip('_') for x in options if x in column][-1]
+        blocks.append(block)
+    return pd.concat(blocks, ignore_index=True)
+
+def test_components():
+    columns = [f'power_{c}_{b}' for c in COMPONENTS for b in BANDS]
+    data = wide(columns)
+    expected = long_loop(data, 'Power', columns, {'Band':[f'_{b}' for b in BANDS], 'Component':[f'_{c}_' for c in COMPONENTS]})
+    pd.testing.assert_frame_equal(_wide_to_long(data, 'Power', columns, 'Component').reset_index(drop=True), expected, check_dtype=False)
+
+def test_roi():
+    columns = [f'sl_{r}_{b}' for r in ROIS for b in BANDS]
+    data = wide(columns)
+    expected = long_loop(data, 'SL', columns, {'Band':[f'_{b}' for b in BANDS], 'ROI':[f'_{r}_' for r in ROIS]})
+    pd.testing.assert_frame_equal(_wide_to_long(data, 'SL', columns, 'ROI').reset_index(drop=True), expected, check_dtype=False)
+
+def test_cross_components():
+    columns = [f'crossfreq_{c}_{m}_{b}' for c in COMPONENTS[:3] for m in M_BANDS for b in BANDS]
+    data = wide(columns)
+    expected = long_loop(data, 'Cross Frequency', columns,
+                         {'Band':[f'_{b}' for b in BANDS], 'M_Band':M_BANDS, 'Component':[f'_{c}_' for c in COMPONENTS]})
+    result = _wide_to_long(data, 'Cross Frequency', columns, 'Component', cross=True, order=['Band','M_Band','Component'])
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected, check_dtype=False)
+
+def test_unknown_column():
+    data = wide(['power_C14_Delta'])
+    data['power'] = 1.
+    with pytest.raises(ValueError):
+        _wide_to_long(data, 'Power', ['power_C14_Delta', 'power'], 'Component')
@@ -0,0 +1,86 @@
+"""
+Equivalence of metrics.multitaper with the Chronux mtspectrumc path.
+
+Settings checked: DPSS tapers with NW=3, K=5 (Chronux default [3 5]) scaled by sqrt(sfreq),
+J = fft(data*tapers, nfft)/sfreq with nfft the next power of 2 (pad=0), spectrum averaged
+over tapers and trials, one-sided grid rfftfreq(nfft, 1/sfreq).
+Tolerance: rtol=1e-10 against the per-trial, per-taper reference below and rtol=1e-6 on the
+relative band powers against sovachronux (skipped when it is not installed).
+Without any reference, the power of a sinusoid of known amplitude and the level of white noise
+are checked on the scale of mtspectrumc (two-sided density over the one-sided grid).
+"""
+import numpy as np
+import pytest
+from scipy.signal.windows import dpss
+from sovaharmony.metrics.multitaper import multitaper_psd, qeeg_psd_multitaper, band_masks
+
+SFREQ = 250.
+BANDS = {'delta':(1.5,6),'theta':(6,8.5),'alpha':(8.5,12.5),'beta':(12.5,30),'gamma':(30,45)}
+
+def mtspectrumc(data, sfreq, NW=3, K=5):
+    """Loop transcription of Chronux mtspectrumc for data (times, trials), trialave=1, pad=0."""
+    times, trials = data.shape
+    nfft = int(max(2**np.ceil(np.log2(times)), times))
+    tapers = dpss(times, NW, K).T * np.sqrt(sfreq) # times tapers, as dpsschk
+    S = np.zeros(nfft)
+    for trial in range(trials):
+        for k in range(K):
+            J = np.fft.fft(data[:, trial] * tapers[:, k], nfft) / sfreq
+            S += np.abs(J)**2
+    S /= trials * K
+    f = np.arange(nfft) * sfreq / nfft
+    keep = f <= sfreq / 2
+    return f[keep], S[keep]
+
+@pytest.fixture
+def signal():
+    rng = np.random.default_rng(0)
+    t = np.arange(1250) / SFREQ
+    data = rng.standard_normal((4, 1250, 6)) # spaces times epochs
+    data += 3 * np.sin(2 * np.pi * 10 * t)[None, :, None]
+    return data
+
+def test_psd_matches_mtspectrumc(signal):
+    freqs, psd = multitaper_psd(signal, SFREQ)
+    for space in range(signal.shape[0]):
+        f, S = mtspectrumc(signal[space], SFREQ)
+        np.testing.assert_allclose(freqs, f, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(psd[space], S, rtol=1e-10)
+
+def test_psd_chunks(signal):
+    _, psd = multitaper_psd(signal, SFREQ)
+    _, psd_chunked = multitaper_psd(signal, SFREQ, chunk_size=1)
+    np.testing.assert_allclose(psd_chunked, psd, rtol=1e-12)
+
+def test_relative_band_powers(signal):
+    values = qeeg_psd_multitaper(signal, SFREQ, BANDS)
+    assert values.shape == (len(BANDS), signal.shape[0])
+    np.testing.assert_allclose(values.sum(axis=0), 1, rtol=1e-12)
+    assert np.all(np.argmax(values, axis=0) == list(BANDS).index('alpha'))
+    f, S = mtspectrumc(signal[0], SFREQ)
+    power = band_masks(f, BANDS) @ S
+    np.testing.assert_allclose(values[:, 0], power / power.sum(), rtol=1e-10)
+
+def test_matches_sovachronux(signal):
+    chronux = pytest.importorskip('sovachronux.qeeg_psd_chronux')
+    values = qeeg_psd_multitaper(signal, SFREQ, BANDS)
+    for space in range(signal.shape[0]):
+        expected = chronux.qeeg_psd_chronux(signal[space], SFREQ, BANDS)
+        np.testing.assert_allclose(values[:, space], [expected[b] for b in BANDS], rtol=1e-6)
+
+def test_sinusoid_power():
+    # A*cos over the one-sided grid holds half of its power A**2/2, within the band of the tapers
+    sfreq, A = 256., 3.
+    t = np.arange(1024) / sfreq
+    data = np.tile(A * np.cos(2 * np.pi * 10 * t + 0.3)[None, :, None], (1, 1, 2))
+    freqs, psd = multitaper_psd(data, sfreq)
+    band = np.logical_and(8 <= freqs, freqs <= 12)
+    assert freqs[np.argmax(psd[0])] == 10
+    np.testing.assert_allclose(psd[0, band].sum() * (freqs[1] - freqs[0]), A**2 / 4, rtol=1e-3)
+
+def test_white_noise_level():
+    # the two-sided density of white noise of variance sigma**2 is sigma**2/sfreq
+    sfreq, sigma = 256., 2.
+    data = sigma * np.random.default_rng(1).standard_normal((1, 1024, 200))
+    _, psd = multitaper_psd(data, sfreq)
+    np.testing.assert_allclose(psd[0, 1:-1].mean(), sigma**2 / sfreq, rtol=0.02)
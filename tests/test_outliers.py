@@ -0,0 +1,34 @@
+"""removing_outliers (utils) against a per-database, per-column loop of the documented rule."""
+import numpy as np
+import pandas as pd
+from sovaharmony.utils import removing_outliers
+
+def removing_outliers_loop(data, columns):
+    keep = []
+    for db in data['database'].unique():
+        data_db = data[data['database']==db]
+        repeticiones = np.zeros(len(data_db),dtype=int)
+        for column in columns:
+            x = data_db[column].to_numpy()
+            Q1 = np.percentile(x,25,method='midpoint')
+            Q3 = np.percentile(x,75,method='midpoint')
+            IQR = Q3 - Q1
+            repeticiones += (x >= Q3+1.5*IQR) + (x <= Q1-1.5*IQR)
+        i = 3
+        while 100*np.sum(repeticiones > i)/len(data_db) > 5:
+            i += 1
+        keep.append(data_db[repeticiones <= i])
+    return pd.concat(keep).sort_index().reset_index(drop=True)
+
+def test_removing_outliers():
+    rng = np.random.default_rng(0)
+    columns = [f'power_C{c}_{b}' for c in range(8) for b in ['Delta','Theta','Alpha-1','Gamma']]
+    data = pd.DataFrame(rng.standard_normal((300,len(columns))),columns=columns)
+    # heavy tails so that several subjects pass the first thresholds
+    data.iloc[:60] *= rng.exponential(3,(60,1))
+    data['database'] = rng.choice(['DB1','DB2','DB3'],300)
+    data['participant_id'] = [f'sub-{i:03d}' for i in range(300)]
+    result = removing_outliers(data,columns)
+    expected = removing_outliers_loop(data,columns)
+    assert len(result) < len(data)
+    pd.testing.assert_frame_equal(result,expected)
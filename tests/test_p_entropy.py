@@ -0,0 +1,43 @@
+"""Array-native ordinal patterns, p_entropy and complexity (metrics.p_entropy) against the scalar versions."""
+import numpy as np
+import pytest
+from sovaharmony.metrics.p_entropy import (ordinal_patterns, weighted_ordinal_patterns, p_entropy, complexity,
+    ordinal_patterns_array, weighted_ordinal_patterns_array, p_entropy_array, complexity_array)
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((3, 500, 2)) # channels, times, epochs
+    data[1, :, 1] = np.cumsum(data[1, :, 1]) # a less random series
+    return data
+
+def test_ordinal_patterns(data):
+    op = ordinal_patterns_array(data, 3, 1, axis=1)
+    assert op.shape == (3, 2, 6)
+    np.testing.assert_array_equal(op.sum(axis=-1), 500 - 2)
+    for c in range(3):
+        for e in range(2):
+            np.testing.assert_array_equal(np.sort(op[c, e]), np.sort(ordinal_patterns(data[c, :, e], 3, 1)))
+
+@pytest.mark.parametrize('embdim', [3, 4])
+def test_p_entropy_and_complexity(data, embdim):
+    op = ordinal_patterns_array(data, embdim, 1, axis=1)
+    pe = p_entropy_array(op)
+    cx = complexity_array(op)
+    for c in range(3):
+        for e in range(2):
+            scalar = ordinal_patterns(data[c, :, e], embdim, 1)
+            assert pe[c, e] == pytest.approx(p_entropy(scalar), abs=1e-12)
+            assert cx[c, e] == pytest.approx(complexity(scalar), abs=1e-12)
+
+def test_weighted(data):
+    wop = weighted_ordinal_patterns_array(data, 3, 1, axis=1)
+    for c in range(3):
+        for e in range(2):
+            scalar = weighted_ordinal_patterns(data[c, :, e], 3, 1) # every pattern is present in 500 samples
+            np.testing.assert_allclose(np.sort(wop[c, e]), np.sort(scalar), rtol=1e-12)
+            assert p_entropy_array(wop[c, e]) == pytest.approx(p_entropy(scalar), abs=1e-12)
+            assert complexity_array(wop[c, e]) == pytest.approx(complexity(scalar), abs=1e-12)
+
+def test_chunks(data):
+    np.testing.assert_array_equal(ordinal_patterns_array(data, 3, 1, axis=1, chunk_size=1), ordinal_patterns_array(data, 3, 1, axis=1))
@@ -0,0 +1,31 @@
+"""project_signal (features) against the per-epoch product of the adapted demixing matrix."""
+import numpy as np
+import pytest
+
+pytest.importorskip('sovaflow')
+pytest.importorskip('sovachronux')
+import mne
+from sovaharmony.metrics.features import project_signal
+from sovaharmony.spatial import adapted_demixing
+
+def test_project_signal():
+    rng = np.random.default_rng(0)
+    filter_chs = ['FP1','FP2','F3','F4','C3','C4','P3','P4','O1','O2']
+    spatial_filter = {'A':rng.standard_normal((len(filter_chs),5)),'W':rng.standard_normal((5,len(filter_chs))),
+                      'ch_names':filter_chs,'name':'test_project_signal'}
+    # other order, a channel out of the filter and a channel of the filter missing
+    signal_chs = ['O2','C3','FZ','F4','FP1','P4','C4','F3','P3','O1']
+    info = mne.create_info(signal_chs,250.,ch_types='eeg')
+    epochs = mne.EpochsArray(rng.standard_normal((6,len(signal_chs),500)),info,verbose=False)
+    before = epochs.get_data().copy()
+
+    signal,space = project_signal(epochs,spatial_filter)
+
+    W_adapted,intersection_chs = adapted_demixing(spatial_filter,signal_chs)
+    assert 'FZ' not in intersection_chs and 'FP2' not in intersection_chs
+    idx = [signal_chs.index(ch) for ch in intersection_chs]
+    expected = np.stack([W_adapted @ x[idx] for x in before])
+    np.testing.assert_allclose(signal.get_data(),expected,rtol=1e-12,atol=1e-12)
+    assert signal.ch_names == ['C1','C2','C3','C4','C5']
+    assert space['space'] == 'ics' and space['W_channels'] == intersection_chs
+    np.testing.assert_array_equal(epochs.get_data(),before)
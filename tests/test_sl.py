@@ -0,0 +1,49 @@
+"""The vectorized hit counts of metrics.sl.synchronization against a per-reference-point loop."""
+import math
+import numpy as np
+import pytest
+from sovaharmony.metrics.sl import synchronization, sl, sl_config
+
+def synchronization_loop(data, config, num_it, speed):
+    """Reference point by reference point, as the original synchronization (hit matrix summed over i)."""
+    samples, channels = data.shape
+    time_delay, dimensions, w1, w2, pref = config[:5]
+    positions = np.arange(1, samples - time_delay*(dimensions - 1) + 1)
+    delays = time_delay*np.arange(dimensions)
+    hits = np.zeros((channels, channels))
+    for i in positions[positions % speed == 0][:num_it]:
+        valid = np.where(np.logical_and(np.fabs(i - positions) > w1, np.fabs(i - positions) < w2))[0]
+        rows = valid[:, None] + delays
+        euclid = np.sqrt(np.sum((data[(i - 1) + delays, :][None, :, :] - data[rows, :])**2, axis=1)).T # channels, valid
+        epsilon = np.sort(euclid, axis=1)[:, math.ceil(pref*len(valid)) - 1]
+        hit = (euclid <= epsilon[:, None]).astype(int)
+        hits += hit @ hit.T
+    return hits
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((1000, 4))
+    x[:, 1] += 0.8*x[:, 0] # a coupled pair
+    return x
+
+def num_iterations(samples, config, speed=16):
+    return int(np.floor((samples - config[0]*(config[1] - 1))/speed) - np.ceil(1/speed) + 1)
+
+@pytest.mark.parametrize('batch_size', [None, 1, 7])
+def test_hits_match_loop(data, batch_size):
+    config = sl_config()
+    num_it = num_iterations(data.shape[0], config)
+    expected = synchronization_loop(data, config, num_it, 16)
+    np.testing.assert_array_equal(synchronization(data, config, num_it, 16, batch_size=batch_size), expected)
+
+def test_short_windows(data):
+    config = sl_config(time_delay=2, w1=3, w2=40, pref=0.1)
+    num_it = num_iterations(300, config)
+    np.testing.assert_array_equal(synchronization(data[:300], config, num_it, 16), synchronization_loop(data[:300], config, num_it, 16))
+
+def test_sl_values(data):
+    values = sl(data, sl_config())
+    np.testing.assert_allclose(values, values.T)
+    np.testing.assert_allclose(np.diag(values), 1)
+    assert values[0, 1] > values[0, 2] # the coupled pair is more synchronized